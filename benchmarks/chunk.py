@@ -0,0 +1,73 @@
+"""Compare wall time and peak memory of the chunking engines
+
+Every run is a fresh process, so peak memory is not inherited from earlier
+runs::
+
+    python benchmarks/chunk.py --haps example.haps.gz --sample example.sample.gz \
+        --map genetic_map.txt --repeat 3
+"""
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from tempfile import TemporaryDirectory
+
+import click
+
+from relatepy.io import read_sample
+from relatepy.pipeline.chunk import ENGINES, chunk
+from relatepy.utils import peak_rss
+
+
+def run(engine: str, haps: Path, sample: Path, genetic_map: Path, memory: float):
+    with TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        chunk(
+            haps,
+            sample,
+            genetic_map,
+            Path(tmp) / "output",
+            memory_limit=memory,
+            engine=engine,
+        )
+        elapsed = time.perf_counter() - start
+        num_chunks = sum(1 for _ in (Path(tmp) / "output").glob("chunk_*.hap"))
+    return elapsed, peak_rss(), num_chunks
+
+
+@click.command()
+@click.option("--haps", required=True, type=click.Path(exists=True, path_type=Path))
+@click.option("--sample", required=True, type=click.Path(exists=True, path_type=Path))
+@click.option(
+    "--map", "genetic_map", required=True, type=click.Path(exists=True, path_type=Path)
+)
+@click.option("--memory", default=5.0, help="Memory allowance in GB.")
+@click.option("--repeat", default=3, help="Runs per engine.")
+@click.option(
+    "--engine", "engines", multiple=True, default=ENGINES, type=click.Choice(ENGINES)
+)
+def main(haps, sample, genetic_map, memory, repeat, engines):
+    N = len(read_sample(sample).ids)
+    click.echo(f"{haps.name}: {N} haplotypes, {repeat} runs per engine")
+    click.echo(
+        f"{'engine':<8}{'best (s)':>10}{'mean (s)':>10}{'peak RSS (MB)':>15}{'chunks':>8}"
+    )
+    context = multiprocessing.get_context("spawn")
+    for engine in engines:
+        results = []
+        for _ in range(repeat):
+            with ProcessPoolExecutor(1, mp_context=context) as executor:
+                results.append(
+                    executor.submit(
+                        run, engine, haps, sample, genetic_map, memory
+                    ).result()
+                )
+        times = [elapsed for elapsed, _, _ in results]
+        click.echo(
+            f"{engine:<8}{min(times):>10.3f}{sum(times) / len(times):>10.3f}"
+            f"{max(rss for _, rss, _ in results) / 1e6:>15.1f}{results[0][2]:>8}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,26 @@
-from .io import read_coal, read_haps
+from .io import (
+    CoalescenceRates,
+    read_anc,
+    read_coal,
+    read_coal_rates,
+    read_haps,
+    read_mut,
+    read_poplabels,
+    read_vcf,
+)
 from .pipeline import all_pipeline
+from .trees import LocalTrees, estimate_coal
 
-__all__ = ("read_coal", "read_haps", "all_pipeline")
+__all__ = (
+    "CoalescenceRates",
+    "LocalTrees",
+    "estimate_coal",
+    "read_coal",
+    "read_coal_rates",
+    "read_anc",
+    "read_mut",
+    "read_poplabels",
+    "read_haps",
+    "read_vcf",
+    "all_pipeline",
+)
@@ -1,10 +1,24 @@
 import logging
+import os
+from contextlib import nullcontext
 from pathlib import Path
 
 import click
 import click_log
+import numpy as np
 
-from .pipeline import all_pipeline, chunk_pipeline, paint_pipeline
+from .io import read_poplabels
+from .memory import MemoryModel, read_telemetry
+from .pipeline import (
+    all_pipeline,
+    chunk_pipeline,
+    paint_pipeline,
+    read_sweep,
+    sweep_pipeline,
+)
+from .pipeline.progress import LogProgress
+from .trees import estimate_coal as estimate_coal_rates
+from .utils import PROFILE, PROFILE_MEMORY
 
 
 class NotRequiredIf(click.Option):
@@ -150,9 +164,60 @@ GLOBAL_OPTIONS = dict(
             type=float,
         ),
     ),
+    memory_model=(
+        "--memory-model",
+        dict(
+            help="Filename of memory model fitted by `fit-memory-model`. If specified, windows are sized to fill --memory-limit according to it.",
+            type=PathType,
+        ),
+    ),
+    engine=(
+        "--engine",
+        dict(
+            default="rust",
+            help="Implementation of chunking. VCF files are always chunked by the Python one.",
+            type=click.Choice(("rust", "python")),
+        ),
+    ),
+    resume=(
+        "--resume",
+        dict(
+            is_flag=True,
+            default=False,
+            help="Resume an interrupted run, skipping stages whose outputs are intact.",
+        ),
+    ),
 )
 
 
+def set_environ(name: str):
+    def callback(ctx, param, value):
+        if isinstance(value, Path):
+            # stages change the working directory
+            os.environ[name] = str(value.absolute())
+        elif value:
+            os.environ[name] = "1"
+
+    return callback
+
+
+def profile_options(func):
+    func = click.option(
+        "--profile-memory",
+        is_flag=True,
+        expose_value=False,
+        callback=set_environ(PROFILE_MEMORY),
+        help="Also report allocations per stage with tracemalloc, which is slow.",
+    )(func)
+    return click.option(
+        "--profile",
+        help="Directory to write a cProfile `.pstats` file per stage and chunk into.",
+        expose_value=False,
+        callback=set_environ(PROFILE),
+        type=click.Path(file_okay=False, path_type=Path),
+    )(func)
+
+
 def global_options(*options, **option_args):
     def wrap(func):
         for o in options + tuple(option_args.keys()):
@@ -164,9 +229,10 @@ def global_options(*options, **option_args):
                 _args = []
             else:
                 *_args, _kwargs = _kwargs
-            kwargs.update(_kwargs)
+            # overrides only apply to this command
+            kwargs = {**kwargs, **_kwargs}
             func = click.option(*args, *_args, **kwargs)(func)
-        return click_log.simple_verbosity_option(logger)(func)
+        return click_log.simple_verbosity_option(logger)(profile_options(func))
 
     return wrap
 
@@ -196,6 +262,9 @@ Relate
     "chunk_index",
     "use_transitions",
     "memory_limit",
+    "memory_model",
+    "resume",
+    "engine",
 )
 @click.option(
     "--theta",
@@ -219,6 +288,48 @@ Relate
     help="Seed for MCMC in branch lengths estimation.",
     type=int,
 )
+@click.option(
+    "--incremental-finalize",
+    is_flag=True,
+    default=False,
+    help="Append every chunk to the final output as soon as it is finished and remove its temporary files.",
+)
+@click.option(
+    "--tmpdir",
+    help="Directory for temporary files, e.g. on node-local disc. Defaults to the directory of --output.",
+    type=click.Path(exists=True, file_okay=False, path_type=Path),
+)
+@click.option(
+    "--scratch-limit",
+    help="Maximum size in GB of temporary files. Painting of a chunk waits until it fits.",
+    type=float,
+)
+@click.option(
+    "--cleanup",
+    is_flag=True,
+    default=False,
+    help="Remove temporary files as soon as no later stage reads them, and the temporary directory when done.",
+)
+@click.option(
+    "--telemetry",
+    help="Append peak memory of painting and building topology per chunk to this file, used by `fit-memory-model`.",
+    type=click.Path(path_type=Path),
+)
+@click.option(
+    "--pipeline-memory",
+    help="Memory allowance in GB for painting the next chunk while the current one is processed. Pipelining is off if unset or if two chunks do not fit.",
+    type=float,
+)
+@click.option(
+    "--scheduler",
+    help="Address of a dask.distributed scheduler whose workers run the chunks, requires the `distributed` extra.",
+)
+@click.option(
+    "--progress",
+    is_flag=True,
+    default=False,
+    help="Log painting progress every minute, and SNPs per second of long-running stages.",
+)
 def all(
     haps: Path,
     sample: Path,
@@ -237,45 +348,212 @@ def all(
     rho: float = 1,
     ancestral_state: bool = True,
     seed: int | None = None,
+    memory_model: Path | None = None,
+    resume: bool = False,
+    incremental_finalize: bool = False,
+    telemetry: Path | None = None,
+    tmpdir: Path | None = None,
+    scratch_limit: float | None = None,
+    cleanup: bool = False,
+    engine: str = "rust",
+    pipeline_memory: float | None = None,
+    scheduler: str | None = None,
+    progress: bool = False,
+):
+    cluster = nullcontext()
+    if scheduler is not None:
+        try:
+            from distributed import Client
+        except ImportError as e:
+            raise click.UsageError(
+                "--scheduler requires `pip install relatepy[distributed]`."
+            ) from e
+        cluster = Client(scheduler)
+    with cluster as client:
+        all_pipeline(
+            haps,
+            sample,
+            genetic_map,
+            output,
+            mutation_rate,
+            effective_population_size,
+            sample_ages,
+            dist,
+            annotation,
+            coal,
+            chunk_index,
+            use_transitions,
+            memory_limit,
+            theta,
+            rho,
+            ancestral_state,
+            seed,
+            resume,
+            memory_model,
+            telemetry,
+            incremental_finalize,
+            tmpdir,
+            scratch_limit,
+            cleanup,
+            engine,
+            pipeline_memory,
+            client,
+            LogProgress() if progress else None,
+        )
+
+
+@relate.command
+@global_options(
+    "haps",
+    "sample",
+    "genetic_map",
+    "output",
+    "effective_populate_size",
+    "sample_ages",
+    "dist",
+    "annotation",
+    "use_transitions",
+    "memory_limit",
+    "memory_model",
+    "resume",
+    "engine",
+    output=dict(help="Filename of the shared topology without file extension."),
+)
+@click.option(
+    "--points",
+    required=True,
+    help="Tab separated file with columns output, mutation_rate and optionally effective_population_size, coal and seed, one row per point.",
+    type=PathType,
+)
+@click.option(
+    "--theta",
+    default=0.001,
+    type=float,
+)
+@click.option(
+    "--rho",
+    default=1.0,
+    type=float,
+)
+@click.option(
+    "--anc_allele_unknown",
+    "ancestral_state",
+    help="Specify if ancestral allele is unknown.",
+    is_flag=True,
+    default=True,
+)
+@click.option(
+    "--seed",
+    help="Seed for building topology, and for MCMC of points without seed.",
+    type=int,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Points estimated in parallel. Defaults to the number of CPUs.",
+    type=int,
+)
+@click.option(
+    "--cleanup",
+    is_flag=True,
+    default=False,
+    help="Remove the shared topology and the temporary files of every point when done.",
+)
+def sweep(
+    haps: Path,
+    sample: Path,
+    genetic_map: Path,
+    output: Path,
+    effective_population_size: float | None,
+    sample_ages: Path | None,
+    points: Path,
+    dist: Path | None = None,
+    annotation: Path | None = None,
+    use_transitions: bool = True,
+    memory_limit: float = 5,
+    memory_model: Path | None = None,
+    resume: bool = False,
+    engine: str = "rust",
+    theta: float = 0.001,
+    rho: float = 1,
+    ancestral_state: bool = True,
+    seed: int | None = None,
+    jobs: int | None = None,
+    cleanup: bool = False,
 ):
-    all_pipeline(
+    """Build the topology once and estimate branch lengths for every point."""
+    sweep_pipeline(
         haps,
         sample,
         genetic_map,
         output,
-        mutation_rate,
+        read_sweep(points),
         effective_population_size,
         sample_ages,
         dist,
         annotation,
-        coal,
-        chunk_index,
         use_transitions,
         memory_limit,
         theta,
         rho,
         ancestral_state,
         seed,
+        resume,
+        memory_model,
+        engine,
+        jobs,
+        cleanup,
     )
 
 
 @relate.command
 @global_options(
-    "haps", "sample", "genetic_map", "output", "dist", "use_transitions", "memory_limit"
+    "haps",
+    "sample",
+    "genetic_map",
+    "output",
+    "dist",
+    "use_transitions",
+    "memory_limit",
+    "memory_model",
+    "engine",
+    haps=dict(required=False),
+    sample=dict(required=False),
+)
+@click.option(
+    "--vcf",
+    help="Filename of phased VCF file, plain or bgzipped. Replaces --haps and --sample.",
+    type=PathType,
 )
 def chunk(
-    haps: Path,
-    sample: Path,
+    haps: Path | None,
+    sample: Path | None,
     genetic_map: Path,
     output: Path,
     dist: Path | None = None,
     use_transitions: bool = True,
     memory_limit: float = 5.0,
+    memory_model: Path | None = None,
+    vcf: Path | None = None,
+    engine: str = "rust",
 ) -> None:
     """Chunk the input data."""
+    if vcf is not None and (haps is not None or sample is not None):
+        raise click.UsageError("--vcf can not be used with --haps or --sample.")
+    if vcf is None and (haps is None or sample is None):
+        raise click.UsageError("Either --vcf or both --haps and --sample are required.")
     try:
         chunk_pipeline(
-            haps, sample, genetic_map, output, dist, use_transitions, memory_limit
+            haps,
+            sample,
+            genetic_map,
+            output,
+            dist,
+            use_transitions,
+            memory_limit,
+            None if memory_model is None else MemoryModel.load(memory_model),
+            vcf,
+            engine,
         )
     except FileExistsError as e:
         raise click.FileError(
@@ -300,5 +578,121 @@ def paint(output: Path, chunk_index: int, theta: float, rho: float):
     paint_pipeline(output=output, chunk_index=chunk_index, theta=theta, rho=rho)
 
 
+@relate.command
+@click.argument("telemetry", nargs=-1, required=True, type=PathType)
+@click.option(
+    "--output",
+    "-o",
+    required=True,
+    help="Filename of the fitted memory model.",
+    type=click.Path(path_type=Path),
+)
+@click_log.simple_verbosity_option(logger)
+@profile_options
+def fit_memory_model(telemetry: tuple[Path, ...], output: Path):
+    """Fit the memory model used for chunking on telemetry of previous runs."""
+    records = read_telemetry(*telemetry)
+    model = MemoryModel.fit(records)
+    model.save(output)
+    logger.info(f"Fitted {model} on {len(records)} records.")
+
+
+@relate.command
+@click.option(
+    "--input",
+    "-i",
+    "prefix",
+    required=True,
+    help="Filename of `.anc` and `.mut` files without file extension.",
+    type=click.Path(path_type=Path),
+)
+@click.option(
+    "--output",
+    "-o",
+    required=True,
+    help="Directory of the dataset, partitioned by chromosome.",
+    type=click.Path(file_okay=False, path_type=Path),
+)
+@click.option(
+    "--format",
+    default="parquet",
+    show_default=True,
+    type=click.Choice(["parquet", "arrow"]),
+)
+@click.option(
+    "--chromosome",
+    default="1",
+    show_default=True,
+    help="Chromosome of the input, its partition is replaced.",
+)
+@click_log.simple_verbosity_option(logger)
+@profile_options
+def export(prefix: Path, output: Path, format: str, chromosome: str):
+    """Export trees and mutations to columnar Parquet or Arrow files."""
+    try:
+        from .export import export as export_dataset
+    except ImportError as e:
+        raise click.UsageError(
+            "export requires `pip install relatepy[parquet]`."
+        ) from e
+    export_dataset(prefix, output, format=format, chromosome=chromosome)
+
+
+@relate.command
+@click.option(
+    "--input",
+    "-i",
+    "prefix",
+    required=True,
+    help="Filename of `.anc` and `.mut` files without file extension.",
+    type=click.Path(path_type=Path),
+)
+@click.option(
+    "--output",
+    "-o",
+    required=True,
+    help="Filename of the `.coal` file.",
+    type=click.Path(dir_okay=False, path_type=Path),
+)
+@click.option(
+    "--bins",
+    default="3,7,0.25",
+    show_default=True,
+    help="Epochs as `lower,upper,step` in log10 generations, after one from 0.",
+)
+@click.option(
+    "--poplabels",
+    help="File with a POP column, one row per diploid sample. All haplotypes are in one group if not given.",
+    type=PathType,
+)
+@click.option(
+    "--jobs",
+    "-j",
+    help="Processes estimating in parallel. Defaults to the number of CPUs.",
+    type=int,
+)
+@click_log.simple_verbosity_option(logger)
+@profile_options
+def estimate_coal(
+    prefix: Path,
+    output: Path,
+    bins: str,
+    poplabels: Path | None = None,
+    jobs: int | None = None,
+):
+    """Estimate pairwise coalescence rates per epoch into a `.coal` file."""
+    lower, upper, step = map(float, bins.split(","))
+    epochs = np.append(0.0, 10 ** np.arange(lower, upper + step / 2, step))
+    rates = estimate_coal_rates(
+        f"{prefix}.anc",
+        f"{prefix}.mut",
+        epochs,
+        None if poplabels is None else read_poplabels(poplabels),
+        jobs=jobs,
+    )
+    rates.write(output)
+    logger.info(f"Wrote coalescence rates of {', '.join(rates.groups)} to {output}.")
+
+
 if __name__ == "__main__":
     relate()
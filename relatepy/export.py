@@ -0,0 +1,201 @@
+"""Columnar export of ``.anc``/``.mut`` files to Parquet or Arrow
+
+Requires ``pyarrow``, i.e. ``pip install relatepy[parquet]``. A dataset has
+the tables ``mutations`` (one row per SNP) and ``trees`` (one row per node of
+every tree), both partitioned by chromosome::
+
+    <output>/mutations/chromosome=<chromosome>/part-00000.parquet
+    <output>/trees/chromosome=<chromosome>/part-00000.parquet
+
+Parts hold consecutive positions and are written while the text files are
+read, so memory is bounded by a part. Row groups keep the minimum and maximum
+of ``pos``, or ``start`` and ``end`` of trees, so region queries skip the
+rest of a file.
+"""
+import itertools
+import os
+import pathlib
+import shutil
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from .io import anc_header, mutation_columns, scan_mut, tree_bounds, tree_columns
+from .utils import logger
+
+FORMATS = {"parquet": "parquet", "arrow": "feather"}
+TABLES = ("mutations", "trees")
+ROWS_PER_FILE = 1 << 22
+ROW_GROUP_SIZE = 1 << 16
+COMPRESSION = "zstd"
+
+
+def _write(table: pa.Table, directory: pathlib.Path, part: int, format: str) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    if format == "parquet":
+        pq.write_table(
+            table,
+            directory / f"part-{part:05d}.parquet",
+            row_group_size=ROW_GROUP_SIZE,
+            compression=COMPRESSION,
+        )
+    else:
+        feather.write_feather(
+            table,
+            directory / f"part-{part:05d}.arrow",
+            compression=COMPRESSION,
+            chunksize=ROW_GROUP_SIZE,
+        )
+
+
+def _strings(column: np.ndarray) -> pa.Array:
+    return pa.array(column, type=pa.binary()).cast(pa.string())
+
+
+def export_mutations(
+    mut: os.PathLike,
+    directory: pathlib.Path,
+    format: str = "parquet",
+    rows_per_file: int = ROWS_PER_FILE,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Stream a ``.mut`` file into parts in ``directory``
+
+    Returns the index and position of every SNP, which place the trees.
+    """
+    snp, pos = [], []
+    for part, table in enumerate(scan_mut(mut, chunksize=rows_per_file)):
+        columns = mutation_columns(table)
+        snp.append(columns["snp"])
+        pos.append(columns["pos"])
+        branches = pa.ListArray.from_arrays(
+            pa.array(columns.pop("branch_indptr"), type=pa.int32()),
+            pa.array(columns.pop("branches"), type=pa.int32()),
+        )
+        arrays = {
+            name: _strings(column) if column.dtype.kind == "S" else pa.array(column)
+            for name, column in columns.items()
+        }
+        arrays["branches"] = branches
+        _write(pa.table(arrays), directory, part, format)
+    return np.concatenate(snp), np.concatenate(pos)
+
+
+def export_trees(
+    anc: os.PathLike,
+    snp: np.ndarray,
+    pos: np.ndarray,
+    directory: pathlib.Path,
+    format: str = "parquet",
+    rows_per_file: int = ROWS_PER_FILE,
+) -> int:
+    """Stream an ``.anc`` file into parts in ``directory``, return the tree count.
+
+    Trees are placed by `tree_bounds` on the SNPs ``snp`` at ``pos`` of the
+    ``.mut`` file, as by `LocalTrees`.
+    """
+    num_trees = 0
+    with open(anc, "rb") as f:
+        N, _ = anc_header(f)
+        num_nodes = 2 * N - 1
+        trees_per_file = max(1, rows_per_file // num_nodes)
+        lines = list(itertools.islice(f, trees_per_file))
+        for part in itertools.count():
+            if not b"".join(lines).strip():
+                break
+            columns = tree_columns(b"".join(lines), N)
+            tree_snp = columns.pop("snp")
+            num = len(tree_snp)
+            # the first tree of the next part ends the last one of this part
+            lines = list(itertools.islice(f, trees_per_file))
+            if lines and lines[0].strip():
+                tree_snp = np.append(tree_snp, int(lines[0][: lines[0].index(b":")]))
+            starts, ends = tree_bounds(tree_snp, snp, pos)
+            tree = np.arange(num_trees, num_trees + num, dtype=np.int32)
+            table = pa.table(
+                dict(
+                    tree=np.repeat(tree, num_nodes),
+                    start=np.repeat(starts[:num], num_nodes),
+                    end=np.repeat(ends[:num], num_nodes),
+                    node=np.tile(np.arange(num_nodes, dtype=np.int32), num),
+                    **{name: column.ravel() for name, column in columns.items()},
+                )
+            )
+            _write(table, directory, part, format)
+            num_trees += num
+    return num_trees
+
+
+def export(
+    prefix: os.PathLike,
+    output: os.PathLike,
+    format: str = "parquet",
+    chromosome: str = "1",
+    rows_per_file: int = ROWS_PER_FILE,
+) -> None:
+    """Export ``<prefix>.anc`` and ``<prefix>.mut`` of a chromosome
+
+    Parameters
+    ----------
+    prefix : os.PathLike
+        Filename of Relate's output without file extension.
+    output : os.PathLike
+        Directory of the dataset, other chromosomes in it are kept.
+    format : str, optional
+        "parquet" or "arrow", by default "parquet".
+    chromosome : str, optional
+        Partition written, replaced if it exists, by default "1".
+    rows_per_file : int, optional
+        Rows of a part, by default `ROWS_PER_FILE`.
+    """
+    if format not in FORMATS:
+        raise ValueError(
+            f"Unknown format `{format}`, expected one of {tuple(FORMATS)}."
+        )
+    prefix, output = os.fspath(prefix), pathlib.Path(output)
+    directories = {
+        table: output / table / f"chromosome={chromosome}" for table in TABLES
+    }
+    for directory in directories.values():
+        if directory.exists():
+            shutil.rmtree(directory)
+    snp, pos = export_mutations(
+        f"{prefix}.mut", directories["mutations"], format, rows_per_file
+    )
+    num_trees = export_trees(
+        f"{prefix}.anc", snp, pos, directories["trees"], format, rows_per_file
+    )
+    logger.info(
+        f"Exported {len(snp)} SNPs and {num_trees} trees of chromosome "
+        f"{chromosome} to {output}."
+    )
+
+
+def dataset(output: os.PathLike, table: str, format: str = "parquet") -> ds.Dataset:
+    """Open a table of an exported dataset, see `export`."""
+    return ds.dataset(
+        pathlib.Path(output) / table,
+        format=FORMATS[format],
+        partitioning=ds.partitioning(
+            pa.schema([("chromosome", pa.string())]), flavor="hive"
+        ),
+    )
+
+
+def read_region(
+    output: os.PathLike,
+    table: str,
+    chromosome: str,
+    start: int,
+    end: int,
+    format: str = "parquet",
+) -> pa.Table:
+    """Rows of SNPs, or nodes of trees, overlapping positions [start, end)."""
+    data = dataset(output, table, format)
+    if table == "mutations":
+        overlap = (ds.field("pos") >= start) & (ds.field("pos") < end)
+    else:
+        overlap = (ds.field("start") < end) & (ds.field("end") > start)
+    return data.to_table(filter=(ds.field("chromosome") == chromosome) & overlap)
@@ -1,39 +1,61 @@
+import gzip
+import hashlib
+import json
 import os
 import pathlib
 import warnings
 from dataclasses import dataclass
 from functools import cached_property
+from typing import Literal, Sequence
 
 import anndata as ad
 import dask.dataframe as dd
 import numpy as np
 import pandas as pd
 
-from relatepy.utils import logger
+from relatepy.memory import MemoryModel
+from relatepy.relatepy import dump_chunks
+from relatepy.utils import logger, profiled
 
 LOWER_BOUND = 1e-10
+VAR_COLUMNS = ("CHR", "ID", "bp_pos", "ancestral", "alternative")
+BLOCK_SIZE = 65536  # SNPs read at a time from backed files
+# painters writing a file per window keep them all open
+WINDOWS_PER_SECTION = 500
+# haplotypes and section boundaries of the chunks in a directory
+CHUNKS_MANIFEST = "chunks.json"
 
 warnings.filterwarnings("ignore", category=ad.ImplicitModificationWarning)
 
 
-def pair(p: str | pd.Series) -> str | pd.Series:
-    match p:
-        case "A":
-            return "G"
-        case "C":
-            return "T"
-        case "G":
-            return "A"
-        case "T":
-            return "C"
-        case s if isinstance(s, pd.Series):
-            return s.replace({"A": "G", "C": "T", "G": "A", "T": "A"})
-        case _:
-            raise ValueError
+ALLELES = "ACGT"
+OTHER_ALLELE = np.uint8(len(ALLELES))
+# transition partner of every allele code, any other allele has no partner
+PAIRS = np.array([2, 3, 0, 1, OTHER_ALLELE], dtype="u1")
+IS_TRANSITION = np.zeros((len(PAIRS), len(PAIRS)), dtype=bool)
+IS_TRANSITION[np.arange(len(ALLELES)), PAIRS[: len(ALLELES)]] = True
 
 
-def is_paired(a: str | pd.Series, b: str | pd.Series) -> bool | pd.Series:
-    return pair(a) == b
+def encode_alleles(alleles) -> np.ndarray:
+    """Encode alleles as A=0, C=1, G=2, T=3 and anything else 4."""
+    codes = pd.Categorical(alleles, categories=list(ALLELES)).codes
+    return np.where(codes < 0, OTHER_ALLELE, codes).astype("u1")
+
+
+def pair(p: str | np.ndarray) -> str | np.ndarray:
+    """Allele forming a transition with ``p``, either a nucleotide or codes."""
+    if isinstance(p, str):
+        if p not in ALLELES:
+            raise ValueError(f"Allele `{p}` has no transition pair.")
+        return ALLELES[PAIRS[ALLELES.index(p)]]
+    return PAIRS[p]
+
+
+def is_paired(a: str | np.ndarray, b: str | np.ndarray) -> bool | np.ndarray:
+    """Whether alleles, either nucleotides or codes, differ by a transition."""
+    if isinstance(a, str) and isinstance(b, str):
+        return bool(IS_TRANSITION[encode_alleles([a])[0], encode_alleles([b])[0]])
+    return IS_TRANSITION[a, b]
 
 
 def pack_props(row: pd.Series):
@@ -51,7 +73,7 @@ class HapsFile:
     """Oxford phased haplotype file"""
 
     section_boundaries = ()
-    window_boundaries = []
+    window_boundaries: list[np.ndarray] = []
 
     def __init__(
         self,
@@ -59,6 +81,8 @@ class HapsFile:
         sample_path: os.PathLike,
         dist_path: os.PathLike | None = None,
         use_transition: bool = True,
+        region: tuple[int, int] | None = None,
+        samples: Sequence[str] | None = None,
     ) -> None:
         """
         Parameters
@@ -66,27 +90,50 @@ class HapsFile:
         self : HapsFile
         haps_path : os.PathLike
         sample_path : os.PathLike
+        region : tuple[int, int] | None, optional
+            Only load SNPs at ``start <= bp_pos <= end``, by default None
+        samples : Sequence[str] | None, optional
+            Only load haplotypes of these individuals, by default None
         """
         haps_path = pathlib.Path(haps_path)
         sample = read_sample(sample_path)
-        df: dd.DataFrame = dd.read_csv(
-            haps_path,
-            sep=r"\s+",
-            assume_missing=True,
-            na_values=".",
-            blocksize=None,
-            names=("CHR", "ID", "bp_pos", "ancestral", "alternative", *sample.ids),
-        )
-        adata = ad.AnnData(
-            df[sample.ids].values.T,
-            dtype="u1",
-            var=df.drop(columns=sample.ids).compute(),
-        )
+        if region is None and samples is None:
+            df: dd.DataFrame = dd.read_csv(
+                haps_path,
+                sep=r"\s+",
+                assume_missing=True,
+                na_values=".",
+                blocksize=None,
+                names=np.concatenate((VAR_COLUMNS, sample.ids)),
+            )
+            adata = ad.AnnData(
+                df.iloc[:, len(VAR_COLUMNS) :].values.T,
+                dtype="u1",
+                var=df.iloc[:, : len(VAR_COLUMNS)].compute(),
+            )
+        else:
+            haplotypes = None if samples is None else sample.haplotypes(samples)
+            var, X = scan_haps(haps_path, len(sample.ids), region, haplotypes)
+            if len(var) == 0:
+                raise ValueError(f"No SNPs of `{haps_path}` in region {region}.")
+            adata = ad.AnnData(X, dtype="u1", var=var)
+        self._init_data(adata, dist_path, use_transition)
+
+    def _init_data(
+        self,
+        adata: ad.AnnData,
+        dist_path: os.PathLike | None,
+        use_transition: bool,
+    ) -> None:
         adata.var["bp_pos"] = adata.var["bp_pos"].astype("u4")
         adata.var["ID"] = adata.var["ID"].astype(str)
+        for allele in ("ancestral", "alternative"):
+            adata.var[f"{allele}_code"] = encode_alleles(adata.var[allele])
+            adata.var[allele] = adata.var[allele].astype("category")
         self.data = adata
         self._update_dist(dist_path)
         self.rpos = np.zeros(self.L + 1)
+        self.r = np.zeros(self.L)
         self.use_transitions = use_transition
 
     @cached_property
@@ -105,23 +152,33 @@ class HapsFile:
         return np.append(self.data.var["bp_pos"], self.data.var["bp_pos"][-1:] + 1)
 
     @property
-    def r(self):
-        if "recombination_distance" not in self.data.var:
-            self.data.var["recombination_distance"] = np.zeros(self.L)
-        return self.data.var["recombination_distance"]
+    def r(self) -> np.ndarray:
+        return self.data.var["recombination_distance"].to_numpy()
 
     @r.setter
     def r(self, value):
         self.data.var["recombination_distance"] = value
 
     @property
-    def dist(self):
-        return self.data.var["dist"]
+    def dist(self) -> np.ndarray:
+        return self.data.var["dist"].to_numpy()
 
     @dist.setter
     def dist(self, value):
         self.data.var["dist"] = value
 
+    @cached_property
+    def state(self) -> np.ndarray:
+        """1 for SNPs used in branch length estimation, sliced by `DataChunk`."""
+        if self.use_transitions:
+            return np.ones(self.L, dtype="u4")
+        var = self.data.var
+        return (
+            ~is_paired(
+                var["ancestral_code"].to_numpy(), var["alternative_code"].to_numpy()
+            )
+        ).astype("u4")
+
     @cached_property
     def chunks(self):
         return [
@@ -133,15 +190,24 @@ class HapsFile:
         if dist_path is None:
             dist = np.append(np.diff(self.data.var["bp_pos"]), np.uint32(1))
         else:
-            dist = pd.read_csv(dist_path, sep=r"\s+", skiprows=1, names=("bp", "dist"))[
-                "dist"
-            ].astype("u4")
+            dist = pd.read_csv(dist_path, sep=r"\s+", skiprows=1, names=("bp", "dist"))
+            if len(dist) == self.L:
+                dist = dist["dist"]
+            else:
+                # only a region of the haps file was loaded
+                dist = dist.set_index("bp")["dist"].reindex(
+                    self.data.var["bp_pos"].to_numpy()
+                )
+                if dist.isna().any():
+                    raise ValueError(f"SNPs missing in `{dist_path}`.")
+            dist = dist.to_numpy().astype("u4")
         if (dist <= 0).any():
             raise ValueError(
                 "SNPs are not sorted by bp or more than one SNP at same position."
             )
         self.data.var["dist"] = dist
 
+    @profiled
     def make_chunks(
         self,
         file_out: pathlib.Path,
@@ -149,21 +215,50 @@ class HapsFile:
         filename_dist: pathlib.Path | None = None,
         use_transitions: bool = True,
         min_memory: float = 5.0,
+        memory_model: MemoryModel | None = None,
+        windows_per_section: int | None = WINDOWS_PER_SECTION,
     ):
+        """Write parameters and chunk files into ``file_out``
+
+        Parameters
+        ----------
+        file_out : pathlib.Path
+        filename_map : pathlib.Path
+        filename_dist : pathlib.Path | None, optional
+            by default None
+        use_transitions : bool, optional
+            by default True
+        min_memory : float, optional
+            Memory allowance in GB, by default 5.0
+        memory_model : MemoryModel | None, optional
+            by default None, i.e. Relate's approximation
+        windows_per_section : int | None, optional
+            Cap on windows of a chunk, by default `WINDOWS_PER_SECTION`. None
+            for no cap, when paintings are written to a `PaintingContainer`,
+            which is only supported through the API, see there.
+        """
         if filename_dist is not None:
             self._update_dist(dist_path=filename_dist)
         self.use_transitions = use_transitions
-        min_memory_size = min_memory * 1e9 / 4.0 - (2 * self.N**2 + 3 * self.N)
+        self.window_boundaries = []
+        # chunks are views of the previous chunking, states depend on transitions
+        self.__dict__.pop("chunks", None)
+        self.__dict__.pop("state", None)
+        if memory_model is None:
+            memory_model = MemoryModel()
+        min_memory_size = memory_model.window_budget(self.N, min_memory)
         actual_min_memory_size = 0.0
         if min_memory_size <= 0:
             raise MemoryError("Need larger memory allowance.")
-        # this is the number of open files, needs to be less than 500
-        windows_per_section = 500
         max_windows_per_section = 0
         overlap = 20000
-        max_chunk_size = min(self.L + 1, min_memory_size // self.N)
+        max_chunk_size = min(self.L + 1, min_memory_size // (4 * self.N))
         if min_memory >= 100:
             max_chunk_size = 2500000
+        if windows_per_section is None:
+            # windows have more than 10 SNPs, so this is never reached
+            windows_per_section = int(max_chunk_size) + overlap
+        snp_memory_size = memory_model.snp_cost(self.N, self.derived_counts())
 
         snp = 0
         window_boundaries = np.zeros(windows_per_section + 1, dtype=np.uint32)
@@ -186,10 +281,11 @@ class HapsFile:
 
                 window_boundaries_overlap[0] = snp_section_begin
                 _window_boundaries = window_boundaries[:num_windows]
-                num_windows_overlap = len(_window_boundaries) + 1
-                window_boundaries_overlap[1:num_windows_overlap] = _window_boundaries[
+                _window_boundaries = _window_boundaries[
                     _window_boundaries > snp_section_begin
                 ]
+                num_windows_overlap = len(_window_boundaries) + 1
+                window_boundaries_overlap[1:num_windows_overlap] = _window_boundaries
                 assert num_windows_overlap < windows_per_section - 1
 
             snp_begin: int = snp
@@ -199,19 +295,14 @@ class HapsFile:
             window_boundaries[0] = snp_begin
             num_windows = 1
             snps_in_window: int = 0
-            it_p: int = 0
 
             while (
                 num_windows + num_windows_overlap < windows_per_section
                 and chunk_size < max_chunk_size
                 and snp < self.L
             ):
-                num_derived: int = self.data.X[:, it_p].sum()
-
-                window_memory_size += num_derived * (self.N + 1)
-                # 73 comes from  ((N+1+2*Node)*x + N^2 + 3*N) which
-                # I am using as an approximation of memory usage
-                # I am also assuming one tree in 100 SNPs on average
+                # see `MemoryModel` for the approximation of memory usage
+                window_memory_size += snp_memory_size[snp]
                 if window_memory_size >= min_memory_size and snps_in_window > 10:
                     if actual_min_memory_size < window_memory_size:
                         actual_min_memory_size = window_memory_size
@@ -220,7 +311,6 @@ class HapsFile:
                     window_boundaries[num_windows] = snp
                     num_windows += 1
 
-                it_p += 1
                 snp += 1
                 snps_in_window += 1
                 chunk_size += 1
@@ -288,8 +378,8 @@ class HapsFile:
             f"{2.0 * (4.0 * self.N ** 2 * (max_windows_per_section + 2.0)) / 2**30}"
             "GB of hard disc."
         )
-        actual_min_memory_size += 2 * self.N**2 + 3 * self.N
-        actual_min_memory_size *= 4.0 / 1e9  # to GB
+        actual_min_memory_size += memory_model.fixed_cost(self.N)
+        actual_min_memory_size /= 1e9  # to GB
         (file_out / "parameters.bin").write_bytes(
             np.array(
                 [
@@ -324,69 +414,191 @@ class HapsFile:
         # what the meaning of magic number 2500?
         self.r = np.clip(np.diff(self.rpos), LOWER_BOUND, None) * 2500
 
+        manifest = dict(
+            haplotypes=self.haplotypes_digest(),
+            section_boundaries=[list(b) for b in self.section_boundaries],
+        )
+        if self._chunked(file_out, manifest):
+            logger.info("Haplotypes of chunks unchanged, only updating SNPs.")
+            self.dump_properties(file_out)
+            return
+        (file_out / CHUNKS_MANIFEST).unlink(missing_ok=True)
         self.dump(file_out)
+        # written last, chunks are only reused once complete
+        (file_out / CHUNKS_MANIFEST).write_text(json.dumps(manifest))
+
+    def _chunked(self, file_out: pathlib.Path, manifest: dict) -> bool:
+        """Whether ``file_out`` has complete ``.hap`` files of these chunks."""
+        path = file_out / CHUNKS_MANIFEST
+        if not path.is_file() or json.loads(path.read_text()) != manifest:
+            return False
+        return all(
+            (file_out / f"chunk_{chunk.id}.hap").is_file()
+            and (file_out / f"chunk_{chunk.id}.hap").stat().st_size
+            == len(chunk.hap_header) + chunk.size * int(self.N)
+            for chunk in self.chunks
+        )
 
-    def dump(self, output: pathlib.Path):
+    def derived_counts(self) -> np.ndarray:
+        """Number of derived alleles of every SNP."""
+        X = self.data.X
+        return np.concatenate(
+            [
+                np.asarray(X[:, start : start + BLOCK_SIZE]).sum(axis=0)
+                for start in range(0, self.L, BLOCK_SIZE)
+            ]
+        )
+
+    def haplotypes_digest(self) -> str:
+        """SHA-1 of the haplotypes, SNP by SNP."""
+        X = self.data.X
+        content = hashlib.sha1(np.uint64(self.N).tobytes())
+        for start in range(0, self.L, BLOCK_SIZE):
+            block = np.asarray(X[:, start : start + BLOCK_SIZE], dtype="u1")
+            content.update(np.ascontiguousarray(block.T).tobytes())
+        return content.hexdigest()
+
+    def save(self, path: os.PathLike, compression: str | None = "gzip") -> None:
+        """Write to an h5ad file, haplotypes are stored as a chunked dataset
+
+        Parameters
+        ----------
+        path : os.PathLike
+        compression : str | None, optional
+            HDF5 filter of the haplotypes, by default "gzip"
+        """
+        uns = self.data.uns
+        # written to the file only, the in-memory ``uns`` is left as it was
+        self.data.uns = {
+            **uns,
+            "rpos": self.rpos,
+            "use_transitions": self.use_transitions,
+        }
+        try:
+            self.data.write_h5ad(path, compression=compression)
+        finally:
+            self.data.uns = uns
+
+    @classmethod
+    def open(
+        cls, path: os.PathLike, backed: Literal["r", "r+"] | None = "r"
+    ) -> "HapsFile":
+        """Open an h5ad file written by `save`
+
+        Parameters
+        ----------
+        path : os.PathLike
+        backed : Literal["r", "r+"] | None, optional
+            Mode of the h5ad file, by default "r". Backed haplotypes stay on
+            disc and are read one block of SNPs at a time, None loads them.
+
+        Returns
+        -------
+        HapsFile
+        """
+        self = cls.__new__(cls)
+        self.data = ad.read_h5ad(path, backed=backed)
+        self.rpos = np.asarray(self.data.uns.pop("rpos"))
+        self.use_transitions = bool(self.data.uns.pop("use_transitions"))
+        return self
+
+    def dump_props(self, output: pathlib.Path):
         props = self.data.var.apply(pack_props, axis=1)
         snp_bytes = props.index.astype(bytes)
         (output / "props.bin").write_bytes(b"".join(snp_bytes + props))
+
+    def dump_properties(self, output: pathlib.Path):
+        """Dump everything but the haplotypes."""
+        self.dump_props(output)
+        for chunk in self.chunks:
+            chunk.dump_properties(output)
+
+    def dump(self, output: pathlib.Path):
+        self.dump_props(output)
+        if isinstance(self.data.X, np.ndarray):
+            # borrowed by Rust without copies, which writes without the GIL
+            dump_chunks(
+                output,
+                np.asarray(self.data.X, dtype="u1"),
+                np.asarray(self.bp_pos, dtype="u4"),
+                np.asarray(self.dist, dtype="u4"),
+                np.asarray(self.rpos, dtype=np.float64),
+                np.asarray(self.r, dtype=np.float64),
+                self.state,
+                [(int(start), int(end)) for start, end in self.section_boundaries],
+            )
+            return
         for chunk in self.chunks:
             chunk.dump(output)
 
 
-@dataclass
 class DataChunk:
-    """Will only support dump for backward compatibility"""
-
-    data: HapsFile
-    id: int
-    boundaries: slice
-    use_transitions: bool = True
-
-    def __getattr__(self, attr):
-        boundaries = (
-            self.boundaries
-            if attr != "rpos"
-            else slice(self.boundaries.start, self.boundaries.stop + 1)
+    """View of a section of `HapsFile`, will only support dump for backward
+    compatibility
+
+    Properties of SNPs are sliced once on construction into NumPy arrays.
+    """
+
+    __slots__ = (
+        "data",
+        "id",
+        "boundaries",
+        "use_transitions",
+        "bp",
+        "dist",
+        "rpos",
+        "r",
+        "state",
+    )
+
+    def __init__(
+        self,
+        data: HapsFile,
+        id: int,
+        boundaries: slice,
+        use_transitions: bool = True,
+    ) -> None:
+        self.data = data
+        self.id = id
+        self.boundaries = boundaries
+        self.use_transitions = use_transitions
+        self.bp: np.ndarray = data.bp_pos[boundaries]
+        self.dist: np.ndarray = data.dist[boundaries]
+        # positions of both ends of every SNP interval
+        self.rpos: np.ndarray = data.rpos[boundaries.start : boundaries.stop + 1]
+        self.r: np.ndarray = data.r[boundaries]
+        self.state: np.ndarray = data.state[boundaries]
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(id={self.id}, boundaries={self.boundaries}, "
+            f"use_transitions={self.use_transitions})"
         )
-        attr = getattr(self.data, attr)[boundaries]
-        if isinstance(attr, pd.Series):
-            attr = attr.values
-        return attr
 
     @property
-    def bp(self):
-        return self.data.bp_pos[self.boundaries]
-
-    @cached_property
     def size(self) -> int:
         return self.boundaries.stop - self.boundaries.start
 
-    @property
-    def state(self):
-        if self.use_transitions:
-            return np.ones(self.size, dtype="u4")
-        else:
-            return (
-                ~is_paired(
-                    self.data.data.var["ancestral"][self.boundaries],
-                    self.data.data.var["alternative"][self.boundaries],
-                )
-            ).astype(int)
-
     @property
     def hap(self):
         return self.data.data.X[:, self.boundaries]
 
-    def dump(self, output: pathlib.Path):
+    @property
+    def hap_header(self) -> bytes:
+        return np.array([self.size, self.data.N], dtype="u8").tobytes()
+
+    def dump_properties(self, output: pathlib.Path):
+        """Dump everything but the haplotypes."""
         stem = output / f"chunk_{self.id}"
         for prop in ("bp", "dist", "rpos", "r", "state"):
             value: np.ndarray = getattr(self, prop)
             content = np.uint32(len(value)).tobytes() + value.tobytes()
             stem.with_suffix("." + prop).write_bytes(content)
-        stem.with_suffix(".hap").write_bytes(
-            np.array([self.size, self.data.N], dtype="u8").tobytes()
-            + (self.hap + 48).astype("u1").tobytes("F")
+
+    def dump(self, output: pathlib.Path):
+        self.dump_properties(output)
+        (output / f"chunk_{self.id}.hap").write_bytes(
+            self.hap_header + (self.hap + 48).astype("u1").tobytes("F")
         )
 
 
@@ -421,16 +633,223 @@ class SampleFile:
         self._data = pd.read_csv(path, sep=r"\s+", skiprows=[1], na_values="NA")
 
     @cached_property
-    def ids(self):
-        results = []
-        for _, row in self._data.iterrows():
-            for i in row[:2]:
-                if i:
-                    if i not in results:
-                        results.append(i)
-                    else:
-                        results.append(i + "(1)")
-        return results
+    def ids(self) -> np.ndarray:
+        """Haplotype IDs, repeated IDs are suffixed with ``(1)``."""
+        ids = pd.Series(self._data.iloc[:, :2].to_numpy().ravel())
+        ids = ids[ids.astype(bool)].astype(str)
+        ids[ids.duplicated()] += "(1)"
+        return ids.to_numpy(dtype=str)
+
+    def haplotypes(self, samples: Sequence[str]) -> np.ndarray:
+        """Indices of both haplotypes of individuals matched by ID_1 or ID_2."""
+        matched = self._data.iloc[:, :2].isin(samples)
+        missing = set(samples).difference(self._data.iloc[:, :2].to_numpy().ravel())
+        if missing:
+            raise ValueError(f"Samples not found: {', '.join(map(str, missing))}.")
+        return np.flatnonzero(np.repeat(matched.any(axis=1).to_numpy(), 2))
+
+
+def scan_haps(
+    haps_path: pathlib.Path,
+    num_haplotypes: int,
+    region: tuple[int, int] | None = None,
+    haplotypes: np.ndarray | None = None,
+) -> tuple[pd.DataFrame, np.ndarray]:
+    """Stream a haps file, keeping SNPs in ``region`` and columns of ``haplotypes``
+
+    Rows are filtered by position before their genotypes are split, and reading
+    stops after the region as haps files are sorted by position.
+
+    Returns
+    -------
+    tuple[pd.DataFrame, np.ndarray]
+        SNP properties and genotypes of shape (haplotypes, SNPs)
+    """
+    start, end = (0, np.inf) if region is None else region
+    if haplotypes is None:
+        haplotypes = np.arange(num_haplotypes)
+    rows, genotypes = [], []
+    opener = gzip.open if haps_path.suffix == ".gz" else open
+    with opener(haps_path, "rb") as f:
+        for line in f:
+            chromosome, snp_id, bp_pos, rest = line.split(maxsplit=3)
+            bp_pos = int(bp_pos)
+            if bp_pos < start:
+                continue
+            if bp_pos > end:
+                break
+            ancestral, alternative, raw = rest.split(maxsplit=2)
+            raw = np.frombuffer(raw.rstrip(), dtype="u1")
+            if len(raw) == 2 * num_haplotypes - 1 and (raw[1::2] == ord(" ")).all():
+                # single characters separated by single spaces
+                values = raw[::2] - ord("0")
+            else:
+                tokens = raw.tobytes().split()
+                if len(tokens) != num_haplotypes:
+                    raise ValueError(
+                        f"SNP {snp_id.decode()} has {len(tokens)} genotypes, "
+                        f"expected {num_haplotypes}."
+                    )
+                try:
+                    values = np.array(tokens, dtype="i8")
+                except ValueError:  # e.g. missing genotypes
+                    values = np.full(num_haplotypes, -1)
+            if ((values < 0) | (values > 1)).any():
+                raise ValueError(
+                    f"SNP {snp_id.decode()} has genotypes other than 0 and 1."
+                )
+            genotypes.append(values[haplotypes].astype("u1"))
+            rows.append((chromosome, snp_id, bp_pos, ancestral, alternative))
+    var = snp_properties(rows)
+    X = (
+        np.vstack(genotypes).T
+        if genotypes
+        else np.zeros((len(haplotypes), 0), dtype="u1")
+    )
+    return var, X
+
+
+def snp_properties(rows: list[tuple]) -> pd.DataFrame:
+    """SNP properties from raw (CHR, ID, bp_pos, ancestral, alternative) rows."""
+    var = pd.DataFrame(rows, columns=VAR_COLUMNS)
+    for column in ("CHR", "ID", "ancestral", "alternative"):
+        var[column] = var[column].str.decode("utf-8")
+    chromosome = pd.to_numeric(var["CHR"], errors="coerce")
+    if chromosome.notna().all():
+        # same as `read_csv(..., assume_missing=True)`
+        var["CHR"] = chromosome.astype(float)
+    return var
+
+
+def _open_vcf(vcf_path: pathlib.Path):
+    if vcf_path.suffix == ".bcf":
+        raise ValueError(
+            f"`{vcf_path}` is BCF, which is not supported, convert it to VCF "
+            "(e.g. `bcftools view -Oz`)."
+        )
+    # bgzip files are gzip files of many members
+    return (
+        gzip.open(vcf_path, "rb") if vcf_path.suffix == ".gz" else open(vcf_path, "rb")
+    )
+
+
+def vcf_samples(vcf_path: pathlib.Path) -> np.ndarray:
+    """Names of the individuals of a VCF file."""
+    with _open_vcf(vcf_path) as f:
+        for line in f:
+            if line.startswith(b"#CHROM"):
+                return np.array(line.rstrip().decode().split("\t")[9:], dtype=str)
+            if not line.startswith(b"##"):
+                break
+    raise ValueError(f"`{vcf_path}` has no header line.")
+
+
+def scan_vcf(vcf_path: pathlib.Path, num_samples: int):
+    """Stream phased biallelic SNPs of a VCF file
+
+    Only the GT field is read, which must be diploid and phased. Other
+    records, e.g. indels and multiallelic sites, are skipped.
+
+    Yields
+    ------
+    tuple[tuple, np.ndarray]
+        Raw (CHR, ID, bp_pos, REF, ALT) and alternative allele indicators of
+        the haplotypes
+    """
+    # "a|b" per sample separated by tabs
+    width = 4 * num_samples - 1
+    with _open_vcf(vcf_path) as f:
+        for line in f:
+            if line.startswith(b"#"):
+                continue
+            chromosome, bp_pos, snp_id, ref, alt, _, _, _, fmt, genotypes = line.split(
+                b"\t", 9
+            )
+            if len(ref) != 1 or len(alt) != 1 or alt == b".":
+                continue
+            genotypes = genotypes.rstrip()
+            if fmt != b"GT":
+                gt = fmt.split(b":").index(b"GT")
+                genotypes = b"\t".join(
+                    g.split(b":")[gt] for g in genotypes.split(b"\t")
+                )
+            location = f"{chromosome.decode()}:{bp_pos.decode()}"
+            if len(genotypes) != width:
+                raise ValueError(f"Genotypes at {location} are not diploid.")
+            raw = np.frombuffer(genotypes + b"\t", dtype="u1").reshape(-1, 4)
+            if (raw[:, 1] != ord("|")).any():
+                raise ValueError(f"Genotypes at {location} are not phased.")
+            haplotypes = raw[:, [0, 2]].ravel() - ord("0")
+            if (haplotypes > 1).any():
+                raise ValueError(
+                    f"Genotypes at {location} are missing or not biallelic."
+                )
+            yield (chromosome, snp_id, int(bp_pos), ref, alt), haplotypes
+
+
+class VcfFile(HapsFile):
+    """Phased VCF file, streamed instead of loaded
+
+    Only SNP properties are kept in memory. The genotypes are read once to
+    count derived alleles and once more by `dump` to write the chunks, so
+    neither a haps file nor the haplotype matrix is ever built. REF and ALT
+    are taken as the ancestral and alternative alleles, as for haps files.
+    """
+
+    def __init__(
+        self,
+        vcf_path: os.PathLike,
+        dist_path: os.PathLike | None = None,
+        use_transition: bool = True,
+    ) -> None:
+        self.vcf_path = pathlib.Path(vcf_path)
+        samples = vcf_samples(self.vcf_path)
+        ids = pd.Series(np.repeat(samples, 2))
+        ids[ids.duplicated()] += "(1)"
+        rows, derived = [], []
+        digest = hashlib.sha1(np.uint64(len(ids)).tobytes())
+        for row, haplotypes in scan_vcf(self.vcf_path, len(samples)):
+            rows.append(row)
+            derived.append(haplotypes.sum())
+            digest.update(haplotypes.tobytes())
+        if not rows:
+            raise ValueError(f"No phased biallelic SNPs in `{self.vcf_path}`.")
+        self._derived = np.array(derived)
+        self._digest = digest.hexdigest()
+        adata = ad.AnnData(obs=pd.DataFrame(index=ids), var=snp_properties(rows))
+        self._init_data(adata, dist_path, use_transition)
+
+    def derived_counts(self) -> np.ndarray:
+        return self._derived
+
+    def haplotypes_digest(self) -> str:
+        return self._digest
+
+    def dump(self, output: pathlib.Path):
+        self.dump_props(output)
+        files = []
+        try:
+            for chunk in self.chunks:
+                chunk.dump_properties(output)
+                f = (output / f"chunk_{chunk.id}.hap").open("wb")
+                files.append(f)
+                f.write(chunk.hap_header)
+            # consecutive chunks overlap, so a SNP goes to at most two files
+            boundaries = self.section_boundaries
+            first = 0
+            records = scan_vcf(self.vcf_path, self.N // 2)
+            for snp, (_, haplotypes) in enumerate(records):
+                while boundaries[first][1] <= snp:
+                    files[first].close()
+                    first += 1
+                row = (haplotypes + 48).tobytes()
+                for i in range(first, len(boundaries)):
+                    if boundaries[i][0] > snp:
+                        break
+                    files[i].write(row)
+        finally:
+            for f in files:
+                f.close()
 
 
 def read_sample(sample_path: os.PathLike) -> SampleFile:
@@ -452,7 +871,10 @@ def read_sample(sample_path: os.PathLike) -> SampleFile:
 
 
 def read_haps(
-    haps_path: os.PathLike, sample_path: os.PathLike | None = None
+    haps_path: os.PathLike,
+    sample_path: os.PathLike | None = None,
+    region: tuple[int, int] | None = None,
+    samples: Sequence[str] | None = None,
 ) -> HapsFile:
     """Read Oxford phased haplotype file
 
@@ -461,6 +883,10 @@ def read_haps(
     haps_path : os.PathLike
     sample_path : os.PathLike | None, optional
         default None
+    region : tuple[int, int] | None, optional
+        Only read SNPs at ``start <= bp_pos <= end``, default None
+    samples : Sequence[str] | None, optional
+        Only read haplotypes of these individuals (ID_1 or ID_2), default None
 
     Returns
     -------
@@ -478,7 +904,36 @@ def read_haps(
                 "it is impossible to guess the sample file path."
             )
         sample_path = haps_path.parent / haps_path.name.replace(".haps", ".sample")
-    return HapsFile(haps_path, sample_path)
+    return HapsFile(haps_path, sample_path, region=region, samples=samples)
+
+
+def read_vcf(
+    vcf_path: os.PathLike,
+    dist_path: os.PathLike | None = None,
+) -> VcfFile:
+    """Read phased VCF file, plain or (b)gzipped
+
+    Parameters
+    ----------
+    vcf_path : os.PathLike
+    dist_path : os.PathLike | None, optional
+        default None
+
+    Returns
+    -------
+    VcfFile
+
+    Raises
+    ------
+    ValueError
+    """
+    return VcfFile(vcf_path, dist_path)
+
+
+def read_poplabels(filename: os.PathLike, column: str = "POP") -> np.ndarray:
+    """Group of every haplotype from a ``.poplabels`` file of diploid samples."""
+    table = pd.read_csv(filename, sep=r"\s+", dtype=str)
+    return np.repeat(table[column].to_numpy(str), 2)
 
 
 def read_coal(filename: os.PathLike) -> pd.DataFrame:
@@ -499,3 +954,359 @@ def read_coal(filename: os.PathLike) -> pd.DataFrame:
         var_name="epoch.start",
         value_name="haploid.coalescence.rate",
     )
+
+
+@dataclass(frozen=True)
+class CoalescenceRates:
+    """Dense coalescence rates of a ``.coal`` file
+
+    Attributes
+    ----------
+    groups : tuple[str, ...]
+    epochs : np.ndarray
+        Start of every epoch, of shape (epochs,)
+    rates : np.ndarray
+        Haploid coalescence rates of shape (groups, groups, epochs), rates of
+        pairs missing in the file are NaN
+    """
+
+    groups: tuple[str, ...]
+    epochs: np.ndarray
+    rates: np.ndarray
+
+    @cached_property
+    def digest(self) -> str:
+        content = hashlib.sha1(" ".join(self.groups).encode())
+        content.update(self.epochs.tobytes())
+        content.update(self.rates.tobytes())
+        return content.hexdigest()
+
+    def write(self, filename: os.PathLike) -> None:
+        """Write in the ``.coal`` format read by `read_coal` and Relate."""
+        with open(filename, "w") as f:
+            f.write(" ".join(self.groups) + " \n")
+            f.write(" ".join(map(repr, self.epochs.tolist())) + " \n")
+            for i in range(len(self.groups)):
+                for j in range(len(self.groups)):
+                    if not np.isnan(self.rates[i, j]).all():
+                        f.write(
+                            f"{i} {j} "
+                            + " ".join(map(repr, self.rates[i, j].tolist()))
+                            + " \n"
+                        )
+
+
+def read_coal_rates(filename: os.PathLike) -> CoalescenceRates:
+    """Read a ``.coal`` file into a dense (groups, groups, epochs) array
+
+    Parameters
+    ----------
+    filename : os.PathLike
+
+    Returns
+    -------
+    CoalescenceRates
+    """
+    with open(filename) as f:
+        groups = tuple(f.readline().split())
+        epochs = np.array(f.readline().split(), dtype=np.float64)
+        coal = np.loadtxt(f, ndmin=2)
+    rates = np.full((len(groups), len(groups), len(epochs)), np.nan)
+    pairs = coal[:, :2].astype(int)
+    rates[pairs[:, 0], pairs[:, 1]] = coal[:, 2 : 2 + len(epochs)]
+    return CoalescenceRates(groups, epochs, rates)
+
+
+NODE_FIELDS = 5  # parent:(branch_length num_mutations snp_begin snp_end)
+MUT_COLUMNS = (
+    "snp",
+    "pos",
+    "dist",
+    "rs_id",
+    "tree_index",
+    "branch_indices",
+    "is_not_mapping",
+    "is_flipped",
+    "age_begin",
+    "age_end",
+    "alleles",
+)
+
+
+def _cache_dir(path: pathlib.Path, cache: bool | os.PathLike) -> pathlib.Path | None:
+    if cache is False:
+        return None
+    return path.parent / f"{path.name}.cache" if cache is True else pathlib.Path(cache)
+
+
+def _load_columns(cache_dir: pathlib.Path | None, path: pathlib.Path) -> dict | None:
+    """Memory-map cached columns of ``path``, None if missing or stale."""
+    if cache_dir is None or not (cache_dir / "meta.json").is_file():
+        return None
+    meta = json.loads((cache_dir / "meta.json").read_text())
+    stat = path.stat()
+    if meta["source"] != [stat.st_size, stat.st_mtime_ns]:
+        return None
+    columns = {
+        name: np.load(cache_dir / f"{name}.npy", mmap_mode="r")
+        for name in meta["columns"]
+    }
+    return {**meta["scalars"], **columns}
+
+
+def _save_columns(
+    cache_dir: pathlib.Path | None, path: pathlib.Path, columns: dict, scalars: dict
+) -> None:
+    if cache_dir is None:
+        return
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    for name, column in columns.items():
+        np.save(cache_dir / f"{name}.npy", column)
+    stat = path.stat()
+    # written last, a cache is only valid once complete
+    (cache_dir / "meta.json").write_text(
+        json.dumps(
+            dict(
+                source=[stat.st_size, stat.st_mtime_ns],
+                columns=list(columns),
+                scalars=scalars,
+            )
+        )
+    )
+
+
+@dataclass(frozen=True)
+class Trees:
+    """Genealogies of an ``.anc`` file, one row per tree and node
+
+    Nodes are numbered as in Relate, leaves first. Node attributes are of
+    shape (trees, 2 * num_haplotypes - 1).
+
+    Attributes
+    ----------
+    num_haplotypes : int
+    sample_ages : np.ndarray
+        Of shape (num_haplotypes,), zero unless given to Relate.
+    snp : np.ndarray
+        First SNP of every tree.
+    parent : np.ndarray
+        Parent of every node, -1 for the root.
+    branch_length : np.ndarray
+        Length in generations of the branch above every node.
+    num_mutations : np.ndarray
+        Number of mutations on the branch above every node.
+    snp_begin, snp_end : np.ndarray
+        SNPs the branch above every node persists over.
+    """
+
+    num_haplotypes: int
+    sample_ages: np.ndarray
+    snp: np.ndarray
+    parent: np.ndarray
+    branch_length: np.ndarray
+    num_mutations: np.ndarray
+    snp_begin: np.ndarray
+    snp_end: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.snp)
+
+    def tree_index(self, snp) -> np.ndarray:
+        """Index of the tree containing every SNP index of ``snp``."""
+        return np.searchsorted(self.snp, snp, side="right") - 1
+
+
+@dataclass(frozen=True)
+class Mutations:
+    """Mutations of a ``.mut`` file, one row per SNP
+
+    Branches of SNP ``i`` are ``branches[branch_indptr[i]:branch_indptr[i + 1]]``,
+    more than one if the SNP does not map to a single branch.
+
+    Attributes
+    ----------
+    snp, pos, tree_index : np.ndarray
+        Index, position in bp, and the tree of every SNP.
+    dist : np.ndarray
+    rs_id, ancestral, alternative : np.ndarray
+        Byte strings.
+    branch_indptr, branches : np.ndarray
+    is_not_mapping, is_flipped : np.ndarray
+    age_begin, age_end : np.ndarray
+        Lower and upper age of every mutation in generations.
+    """
+
+    snp: np.ndarray
+    pos: np.ndarray
+    dist: np.ndarray
+    rs_id: np.ndarray
+    tree_index: np.ndarray
+    branch_indptr: np.ndarray
+    branches: np.ndarray
+    is_not_mapping: np.ndarray
+    is_flipped: np.ndarray
+    age_begin: np.ndarray
+    age_end: np.ndarray
+    ancestral: np.ndarray
+    alternative: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.snp)
+
+    def branches_of(self, i: int) -> np.ndarray:
+        return self.branches[self.branch_indptr[i] : self.branch_indptr[i + 1]]
+
+    def tree_at(self, bp) -> np.ndarray:
+        """Index of the tree at every position of ``bp``, -1 before the first SNP.
+
+        A position between two SNPs belongs to the tree of the SNP on its left.
+        """
+        i = np.searchsorted(self.pos, bp, side="right") - 1
+        return np.where(i >= 0, self.tree_index[np.clip(i, 0, None)], -1)
+
+
+def anc_header(f) -> tuple[int, np.ndarray]:
+    """Number of haplotypes and sample ages of an ``.anc`` file opened in binary."""
+    header = f.readline().split()
+    N = int(header[1])
+    sample_ages = np.array(header[2:], dtype=np.float64)
+    f.readline()  # NUM_TREES
+    return N, sample_ages if len(sample_ages) else np.zeros(N)
+
+
+def tree_columns(lines: bytes, num_haplotypes: int) -> dict[str, np.ndarray]:
+    """Parse whole lines of trees of an ``.anc`` file into the columns of `Trees`."""
+    num_nodes = 2 * num_haplotypes - 1
+    values = np.fromstring(
+        lines.translate(bytes.maketrans(b":()", b"   ")), sep=" "
+    ).reshape(-1, 1 + NODE_FIELDS * num_nodes)
+    nodes = values[:, 1:].reshape(len(values), num_nodes, NODE_FIELDS)
+    return dict(
+        snp=values[:, 0].astype(np.int32),
+        parent=nodes[..., 0].astype(np.int32),
+        branch_length=np.ascontiguousarray(nodes[..., 1]),
+        num_mutations=np.ascontiguousarray(nodes[..., 2]),
+        snp_begin=nodes[..., 3].astype(np.int32),
+        snp_end=nodes[..., 4].astype(np.int32),
+    )
+
+
+def anc_index(filename: os.PathLike) -> tuple[np.ndarray, np.ndarray]:
+    """First SNP and byte offset of every tree of an ``.anc`` file."""
+    snps, offsets = [], []
+    with open(filename, "rb") as f:
+        anc_header(f)
+        offset = f.tell()
+        for line in f:
+            if line.strip():
+                snps.append(int(line[: line.index(b":")]))
+                offsets.append(offset)
+            offset += len(line)
+    return np.array(snps, dtype=np.int32), np.array(offsets, dtype=np.int64)
+
+
+def tree_bounds(
+    tree_snp: np.ndarray, snp: np.ndarray, pos: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    """Start and end position of every tree from the SNPs of a ``.mut`` file
+
+    A tree starts at the position of its first SNP, the last one ends after
+    the last SNP.
+    """
+    pos = np.asarray(pos)
+    first_rows = np.searchsorted(snp, tree_snp)
+    starts = pos[np.clip(first_rows, 0, len(pos) - 1)]
+    return starts, np.append(starts[1:], pos[-1] + 1)
+
+
+def read_anc(filename: os.PathLike, cache: bool | os.PathLike = False) -> Trees:
+    """Read an ``.anc`` file into columnar arrays
+
+    Parameters
+    ----------
+    filename : os.PathLike
+    cache : bool | os.PathLike, optional
+        Directory of a memory-mappable copy, ``<filename>.cache`` if True. It
+        is read instead of the file if up to date, and written otherwise. By
+        default False, i.e. not cached.
+
+    Returns
+    -------
+    Trees
+    """
+    path = pathlib.Path(filename)
+    cache_dir = _cache_dir(path, cache)
+    cached = _load_columns(cache_dir, path)
+    if cached is not None:
+        return Trees(**cached)
+    with open(path, "rb") as f:
+        N, sample_ages = anc_header(f)
+        columns = dict(sample_ages=sample_ages, **tree_columns(f.read(), N))
+    _save_columns(cache_dir, path, columns, dict(num_haplotypes=N))
+    return Trees(num_haplotypes=N, **columns)
+
+
+def read_mut(filename: os.PathLike, cache: bool | os.PathLike = False) -> Mutations:
+    """Read a ``.mut`` file into columnar arrays
+
+    Parameters
+    ----------
+    filename : os.PathLike
+    cache : bool | os.PathLike, optional
+        As of `read_anc`.
+
+    Returns
+    -------
+    Mutations
+    """
+    path = pathlib.Path(filename)
+    cache_dir = _cache_dir(path, cache)
+    cached = _load_columns(cache_dir, path)
+    if cached is not None:
+        return Mutations(**cached)
+    columns = mutation_columns(scan_mut(path))
+    _save_columns(cache_dir, path, columns, {})
+    return Mutations(**columns)
+
+
+def scan_mut(filename: os.PathLike, chunksize: int | None = None):
+    """Table of a ``.mut`` file, or an iterator of tables of ``chunksize`` rows."""
+    return pd.read_csv(
+        filename,
+        sep=";",
+        header=0,
+        names=MUT_COLUMNS,
+        usecols=range(len(MUT_COLUMNS)),
+        dtype={"rs_id": str, "branch_indices": str, "alleles": str},
+        keep_default_na=False,
+        chunksize=chunksize,
+    )
+
+
+def snp_positions(filename: os.PathLike) -> tuple[np.ndarray, np.ndarray]:
+    """SNP indices and positions of a ``.mut`` file."""
+    table = pd.read_csv(
+        filename, sep=";", header=0, usecols=[0, 1], names=["snp", "pos"]
+    )
+    return table["snp"].to_numpy(np.int32), table["pos"].to_numpy(np.int64)
+
+
+def mutation_columns(table: pd.DataFrame) -> dict[str, np.ndarray]:
+    """Columns of `Mutations` from a table read by `scan_mut`."""
+    branches = [np.array(b.split(), dtype=np.int32) for b in table["branch_indices"]]
+    alleles = table["alleles"].str.split("/", expand=True)
+    return dict(
+        snp=table["snp"].to_numpy(np.int32),
+        pos=table["pos"].to_numpy(np.int64),
+        dist=table["dist"].to_numpy(np.float64),
+        rs_id=table["rs_id"].to_numpy("S"),
+        tree_index=table["tree_index"].to_numpy(np.int32),
+        branch_indptr=np.concatenate(([0], np.cumsum([len(b) for b in branches]))),
+        branches=np.concatenate(branches) if branches else np.empty(0, np.int32),
+        is_not_mapping=table["is_not_mapping"].to_numpy(bool),
+        is_flipped=table["is_flipped"].to_numpy(bool),
+        age_begin=table["age_begin"].to_numpy(np.float64),
+        age_end=table["age_end"].to_numpy(np.float64),
+        ancestral=alleles[0].to_numpy("S"),
+        alternative=alleles[1].to_numpy("S"),
+    )
@@ -0,0 +1,163 @@
+import json
+import os
+import pathlib
+from dataclasses import asdict, dataclass
+
+import numpy as np
+
+from relatepy.utils import logger
+
+
+@dataclass(frozen=True)
+class MemoryModel:
+    """Linear model of the peak memory (in bytes) of painting a window and
+    building its topology
+
+    .. math::
+
+        M = c_0 + c_{N^2} N^2 + c_N N + c_d \\sum_w d (N + 1) + c_s L_w N
+
+    where :math:`d` is the number of derived alleles of a SNP and :math:`L_w`
+    is the number of SNPs in the window. The default coefficients are the
+    approximation used by Relate, i.e. ``2 * N**2 + 3 * N`` floats for the
+    distance matrices and ``N + 1`` floats per derived allele.
+    """
+
+    intercept: float = 0.0
+    per_squared_haplotype: float = 8.0
+    per_haplotype: float = 12.0
+    per_derived: float = 4.0
+    per_snp: float = 0.0
+
+    def fixed_cost(self, N: int) -> float:
+        """Memory independent of the window content."""
+        N = float(N)
+        return (
+            self.intercept + self.per_squared_haplotype * N**2 + self.per_haplotype * N
+        )
+
+    def snp_cost(self, N: int, num_derived):
+        """Memory added to a window by a SNP with ``num_derived`` derived alleles."""
+        N = float(N)
+        return self.per_derived * num_derived * (N + 1) + self.per_snp * N
+
+    def predict(self, N: int, window_snps, window_derived):
+        """Peak memory of a window with ``window_derived`` derived alleles in total."""
+        N = float(N)
+        return (
+            self.fixed_cost(N)
+            + self.per_derived * np.asarray(window_derived) * (N + 1)
+            + self.per_snp * np.asarray(window_snps) * N
+        )
+
+    def window_budget(self, N: int, memory_limit: float) -> float:
+        """Memory in bytes left for window content under ``memory_limit`` GB."""
+        return memory_limit * 1e9 - self.fixed_cost(N)
+
+    def equivalent_memory_limit(self, N: int, memory_limit: float) -> float:
+        """Memory allowance making Relate's built-in approximation close windows
+        where this model would.
+
+        The built-in approximation has no per-SNP term, so it is ignored here.
+        """
+        budget = self.window_budget(N, memory_limit) / self.per_derived * 4.0
+        return (budget + MemoryModel().fixed_cost(N)) / 1e9
+
+    @classmethod
+    def fit(cls, records: list[dict]) -> "MemoryModel":
+        """Least squares fit on telemetry records, see `record_telemetry`."""
+        if not records:
+            raise ValueError("No telemetry records to fit.")
+        N = np.array([r["N"] for r in records], dtype=np.double)
+        snps = np.array([r["window_snps"] for r in records], dtype=np.double)
+        derived = np.array([r["window_derived"] for r in records], dtype=np.double)
+        peak = np.array([r["peak_rss"] for r in records], dtype=np.double)
+        design = np.column_stack(
+            (np.ones_like(N), N**2, N, derived * (N + 1), snps * N)
+        )
+        coefficients, *_ = np.linalg.lstsq(design, peak, rcond=None)
+        # negative costs are artifacts of noise or collinearity
+        coefficients = np.clip(coefficients, 0, None)
+        if coefficients[3] == 0:
+            logger.warning(
+                "Telemetry does not determine the cost per derived allele, "
+                "falling back to the default."
+            )
+            coefficients[3] = cls.per_derived
+        return cls(*map(float, coefficients))
+
+    @classmethod
+    def load(cls, path: os.PathLike) -> "MemoryModel":
+        return cls(**json.loads(pathlib.Path(path).read_text()))
+
+    def save(self, path: os.PathLike) -> None:
+        pathlib.Path(path).write_text(json.dumps(asdict(self), indent=2))
+
+
+def window_stats(output: pathlib.Path, chunk_index: int) -> tuple[int, int, int]:
+    """Number of haplotypes, SNPs and derived alleles of the largest window of a chunk
+
+    "Largest" is measured by the number of derived alleles, which dominates
+    the memory usage of painting and building topology.
+    """
+    parameters = np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")
+    N, L_chunk = int(parameters[0]), int(parameters[1])
+    boundaries = np.unique(np.append(parameters[3:], [0, L_chunk]))
+    boundaries = boundaries[boundaries <= L_chunk]
+    hap = np.memmap(
+        output / f"chunk_{chunk_index}.hap",
+        dtype="u1",
+        mode="r",
+        offset=16,
+        shape=(L_chunk, N),
+    )
+    derived = (hap == ord("1")).sum(axis=1)
+    window_derived = np.add.reduceat(derived, boundaries[:-1])
+    largest = int(np.argmax(window_derived))
+    return (
+        N,
+        int(boundaries[largest + 1] - boundaries[largest]),
+        int(window_derived[largest]),
+    )
+
+
+def record_telemetry(
+    telemetry: os.PathLike,
+    output: pathlib.Path,
+    chunk_index: int,
+    stage: str,
+    peak_rss: int,
+    seconds: float | None = None,
+) -> None:
+    """Append the peak memory of a stage on a chunk to a JSON lines file.
+
+    If the duration of the stage is given, the number of SNPs of the chunk and
+    the throughput in SNPs per second are recorded as well.
+    """
+    N, window_snps, window_derived = window_stats(output, chunk_index)
+    record = dict(
+        stage=stage,
+        chunk=chunk_index,
+        N=N,
+        window_snps=window_snps,
+        window_derived=window_derived,
+        peak_rss=peak_rss,
+    )
+    if seconds is not None:
+        parameters = np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")
+        snps = int(parameters[1])
+        record.update(
+            snps=snps,
+            seconds=seconds,
+            snps_per_second=snps / seconds if seconds > 0 else None,
+        )
+    with open(telemetry, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def read_telemetry(*paths: os.PathLike) -> list[dict]:
+    records = []
+    for path in paths:
+        with open(path) as f:
+            records.extend(json.loads(line) for line in f if line.strip())
+    return records
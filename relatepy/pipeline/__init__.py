@@ -1,19 +1,45 @@
+import errno
 import logging
+import shutil
 import struct
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from typing import TYPE_CHECKING, Callable
 
 import click_log
 
 from ..data import RelateData
+from ..io import CoalescenceRates
+from ..memory import MemoryModel, record_telemetry
+from ..utils import peak_rss, prefetch, profile, reset_peak_rss
 from ._build_topology import build_topology
 from ._combine_sections import combine_sections
 from ._finalize import finalize
 from ._find_equivalent_branches import find_equivalent_branches
 from ._get_branch_length import get_branch_length
+from .checkpoint import Checkpoints
+from .incremental import IncrementalFinalizer
+from .progress import ProgressCallback, watch_painting, whole_stage
+from .scratch import ScratchSpace, painting_size
 from .paint import paint as paint_pipeline
 from .chunk import chunk as chunk_pipeline
+from .sweep import SweepPoint, read_sweep, sweep_pipeline
 
-__all__ = ("all_pipeline", "chunk_pipeline", "paint_pipeline")
+if TYPE_CHECKING:
+    from distributed import Client
+
+__all__ = (
+    "all_pipeline",
+    "chunk_pipeline",
+    "paint_pipeline",
+    "sweep_pipeline",
+    "SweepPoint",
+    "read_sweep",
+)
+# stages whose peak memory is modelled by `MemoryModel`
+MEASURED_STAGES = ("paint", "build_topology")
 logger = logging.getLogger(__package__)
 click_log.basic_config(logger)
 
@@ -28,7 +54,7 @@ def all_pipeline(
     sample_ages: list[float],
     dist: Path | None = None,
     annotation: Path | None = None,
-    coal: Path | None = None,
+    coal: Path | CoalescenceRates | None = None,
     chunk_index: int | None = None,
     use_transitions: bool = True,
     memory_limit: float = 5,
@@ -36,7 +62,28 @@ def all_pipeline(
     rho: float = 1,
     ancestral_state: bool = True,
     seed: int | None = None,
+    resume: bool = False,
+    memory_model: Path | None = None,
+    telemetry: Path | None = None,
+    incremental_finalize: bool = False,
+    tmpdir: Path | None = None,
+    scratch_limit: float | None = None,
+    cleanup: bool = False,
+    engine: str = "rust",
+    pipeline_memory: float | None = None,
+    client: "Client | None" = None,
+    progress: ProgressCallback | None = None,
 ):
+    if pipeline_memory is not None or client is not None:
+        # stages change the working directory of their process, and workers
+        # of a cluster have working directories of their own
+        output = output.absolute()
+        if tmpdir is not None:
+            tmpdir = tmpdir.absolute()
+    final_output = output
+    if tmpdir is not None:
+        output = tmpdir / output.name
+    checkpoints = Checkpoints(output)
     if chunk_index is not None:
         logger.info(f"  chunk {chunk_index}")
         fmt = "ii"
@@ -61,17 +108,40 @@ def all_pipeline(
                         f"2Ne = {effective_population_size}"
                         if coal is None
                         else f"coal = {coal}"
+                        if isinstance(coal, Path)
+                        else f"coalescence rates of {', '.join(coal.groups)}"
                     ),
                 )
             )
         )
-        chunk_pipeline(
-            haps, sample, genetic_map, output, dist, use_transitions, memory_limit
-        )
-        fmt = "iiid"
-        N, L, end_chunk, memory_size = struct.unpack(
-            fmt, (output / "parameters.bin").read_bytes()[: struct.calcsize(fmt)]
-        )
+        parameters = output / "parameters.bin"
+        if resume and parameters.is_file() and checkpoints.chunked(
+            read_parameters(output)[2]
+        ):
+            logger.info("Resuming from existing chunks.")
+        else:
+            if resume and output.exists():
+                # never delete work which can not be validated
+                raise FileExistsError(
+                    errno.EEXIST,
+                    "Chunking in the directory is incomplete or was not "
+                    "checkpointed, remove the directory to start over",
+                    str(output),
+                )
+            with checkpoints.stage("chunk"):
+                chunk_pipeline(
+                    haps,
+                    sample,
+                    genetic_map,
+                    output,
+                    dist,
+                    use_transitions,
+                    memory_limit,
+                    None if memory_model is None else MemoryModel.load(memory_model),
+                    engine=engine,
+                )
+            checkpoints.split_chunks(read_parameters(output)[2])
+        N, L, end_chunk, memory_size = read_parameters(output)
         end_chunk -= 1
         start_chunk = 0
     data = RelateData(number_of_sequences=N, number_of_alleles=L)
@@ -81,20 +151,222 @@ def all_pipeline(
     )
     if memory_size is not None:
         logger.info(f"Expected minimum memory usage: {memory_size}Gb.")
-
-    for c in range(start_chunk, end_chunk + 1):
-        logger.info(f"Starting chunk {c} of {end_chunk}.")
-        fmt = "i"
-        (num_sections,) = struct.unpack_from(
-            fmt,
-            (output / f"parameters_c{c}.bin").read_bytes()[: struct.calcsize("iii")],
-            struct.calcsize("ii"),
+    finalizer = None
+    if incremental_finalize and chunk_index is None:
+        if client is not None:
+            logger.warning(
+                "Incremental finalize is not supported on a cluster, "
+                "finalizing after all chunks instead."
+            )
+        elif annotation is not None:
+            logger.warning(
+                "Annotation is not supported by incremental finalize, "
+                "finalizing after all chunks instead."
+            )
+        elif not (resume and checkpoints.is_done("finalize")):
+            finalizer = IncrementalFinalizer(output, end_chunk + 1, resume)
+    if client is not None and telemetry is not None:
+        logger.warning("Telemetry is not recorded on a cluster.")
+        telemetry = None
+    if telemetry is not None and not reset_peak_rss():
+        logger.warning(
+            "Peak memory can not be reset on this platform, "
+            "telemetry of later stages includes earlier ones."
         )
-        num_sections -= 1
-        paint_pipeline(output=output, chunk_index=c, theta=theta, rho=rho)
-        build_topology(
+
+    finalized = chunk_index is None and resume and checkpoints.is_done("finalize")
+    ahead = None
+    if pipeline_memory is not None and client is None:
+        if telemetry is not None:
+            logger.warning(
+                "Telemetry measures one stage at a time, running stages sequentially."
+            )
+        elif memory_size is not None and 2 * memory_size > pipeline_memory:
+            logger.warning(
+                f"Painting ahead needs about {2 * memory_size}Gb, more than the "
+                f"{pipeline_memory}Gb allowed, running stages sequentially."
+            )
+        elif start_chunk < end_chunk:
+            ahead = ThreadPoolExecutor(1, thread_name_prefix="relatepy-paint")
+
+    # painting ahead, other chunk jobs and cluster workers release files
+    scratch = ScratchSpace(
+        output,
+        scratch_limit,
+        shared=chunk_index is not None or client is not None or ahead is not None,
+    )
+
+    def pending_stages(c: int) -> tuple[dict[str, Callable[[], None]], tuple[str, ...]]:
+        stages = chunk_stages(
             output=output,
             chunk_index=c,
+            mutation_rate=mutation_rate,
+            effective_population_size=effective_population_size,
+            sample_ages=sample_ages,
+            coal=coal,
+            theta=theta,
+            rho=rho,
+            ancestral_state=ancestral_state,
+            seed=seed,
+            progress=progress,
+        )
+        if finalizer is not None:
+            stages["finalize"] = partial(finalizer.append, c)
+        pending = checkpoints.pending(c) if resume else tuple(stages)
+        return stages, tuple(stage for stage in pending if stage in stages)
+
+    def run_stage(stage: str, c: int, stages: dict[str, Callable[[], None]]) -> None:
+        if stage == "paint":
+            if resume and (output / f"chunk_{c}").exists():
+                # painting appends to its files, partial results must not be reused
+                shutil.rmtree(output / f"chunk_{c}")
+            scratch.reserve(painting_size(output, c))
+        if stage == "finalize":
+            # the final outputs keep growing, only the removals are recorded;
+            # appending is skipped on resume if the chunk was appended already
+            stages[stage]()
+            checkpoints.mark(stage, c)
+            checkpoints.forget(finalizer.remove(c))
+            return
+        with checkpoints.stage(stage, c), profile(f"{stage}_c{c}"):
+            if telemetry is not None and stage in MEASURED_STAGES:
+                reset_peak_rss()
+                start = time.perf_counter()
+                stages[stage]()
+                record_telemetry(
+                    telemetry,
+                    output,
+                    c,
+                    stage,
+                    peak_rss(),
+                    seconds=time.perf_counter() - start,
+                )
+            else:
+                stages[stage]()
+        if cleanup:
+            checkpoints.forget(scratch.release(stage, c))
+
+    if client is not None:
+        from .cluster import submit_chunks
+
+        client.gather(
+            submit_chunks(
+                client,
+                output,
+                {c: pending_stages(c) for c in range(start_chunk, end_chunk + 1)},
+                {stage: memory_limit for stage in MEASURED_STAGES},
+                finalize=None
+                if chunk_index is not None or finalized
+                else partial(
+                    finalize,
+                    output=output,
+                    sample_ages=sample_ages,
+                    annotation=annotation,
+                ),
+                scratch=scratch,
+                cleanup=cleanup,
+            )
+        )
+    else:
+        painted: Future | None = None
+        try:
+            for c in range(start_chunk, end_chunk + 1):
+                stages, pending = pending_stages(c)
+                if painted is not None:
+                    painted, future = None, painted
+                    future.result()
+                    pending = tuple(stage for stage in pending if stage != "paint")
+                if not pending:
+                    logger.info(
+                        f"Chunk {c} of {end_chunk} already finished, skipping."
+                    )
+                    if finalizer is not None:
+                        # interrupted after appending, before removing
+                        checkpoints.forget(finalizer.remove(c))
+                    continue
+                logger.info(f"Starting chunk {c} of {end_chunk}.")
+                looked_ahead = ahead is None or c == end_chunk
+                for stage in pending:
+                    if stage != "paint" and not looked_ahead:
+                        # painted or resumed, overlap painting of the next chunk
+                        looked_ahead = True
+                        prefetch(output.glob(f"chunk_{c + 1}.*"))
+                        next_stages, next_pending = pending_stages(c + 1)
+                        if "paint" in next_pending:
+                            logger.debug(f"Painting chunk {c + 1} ahead.")
+                            painted = ahead.submit(
+                                run_stage, "paint", c + 1, next_stages
+                            )
+                    if stage == "finalize" and painted is not None:
+                        # final outputs must not grow while painting is checkpointed
+                        painted.result()
+                    run_stage(stage, c, stages)
+        finally:
+            if ahead is not None:
+                ahead.shutdown(cancel_futures=True)
+    if chunk_index is None:
+        if finalized:
+            logger.info("Already finalized, skipping.")
+        elif client is None:
+            with checkpoints.stage("finalize"), profile("finalize"):
+                if finalizer is not None:
+                    finalizer.close()
+                else:
+                    finalize(
+                        output=output, sample_ages=sample_ages, annotation=annotation
+                    )
+        if output != final_output:
+            for result in output.parent.glob(f"{output.name}.*"):
+                shutil.move(result, final_output.parent / result.name)
+        if cleanup:
+            shutil.rmtree(output)
+    logger.info("Done.")
+
+
+def read_parameters(output: Path) -> tuple[int, int, int, float]:
+    """Read number of haplotypes, SNPs, chunks and memory usage of chunking."""
+    fmt = "iiid"
+    return struct.unpack(
+        fmt, (output / "parameters.bin").read_bytes()[: struct.calcsize(fmt)]
+    )
+
+
+def chunk_stages(
+    *,
+    output: Path,
+    chunk_index: int,
+    mutation_rate: float,
+    effective_population_size: float | None,
+    sample_ages: list[float],
+    coal: Path | CoalescenceRates | None = None,
+    theta: float = 0.001,
+    rho: float = 1,
+    ancestral_state: bool = True,
+    seed: int | None = None,
+    progress: ProgressCallback | None = None,
+) -> dict[str, Callable[[], None]]:
+    """Stages run on a single chunk, in order, keyed by checkpoint name.
+
+    If ``progress`` is given, painting, building topology and estimating branch
+    lengths report their progress to it.
+    """
+    fmt = "i"
+    (num_sections,) = struct.unpack_from(
+        fmt,
+        (output / f"parameters_c{chunk_index}.bin").read_bytes()[
+            : struct.calcsize("iii")
+        ],
+        struct.calcsize("ii"),
+    )
+    num_sections -= 1
+    stages = {
+        "paint": partial(
+            paint_pipeline, output=output, chunk_index=chunk_index, theta=theta, rho=rho
+        ),
+        "build_topology": partial(
+            build_topology,
+            output=output,
+            chunk_index=chunk_index,
             first_section=0,
             last_section=num_sections - 1,
             effective_population_size=effective_population_size,
@@ -103,11 +375,14 @@ def all_pipeline(
             seed=seed,
             ancestral_state=ancestral_state,
             sample_ages=sample_ages,
-        )
-        find_equivalent_branches(output=output, chunk_index=c)
-        get_branch_length(
+        ),
+        "find_equivalent_branches": partial(
+            find_equivalent_branches, output=output, chunk_index=chunk_index
+        ),
+        "get_branch_length": partial(
+            get_branch_length,
             output=output,
-            chunk_index=c,
+            chunk_index=chunk_index,
             first_section=0,
             last_section=num_sections - 1,
             mutation_rate=mutation_rate,
@@ -115,12 +390,22 @@ def all_pipeline(
             coal=coal,
             seed=seed,
             sample_ages=sample_ages,
-        )
-        combine_sections(
+        ),
+        "combine_sections": partial(
+            combine_sections,
             output=output,
-            chunk_index=c,
+            chunk_index=chunk_index,
             effective_population_size=effective_population_size,
-        )
-    if chunk_index is None:
-        finalize(output=output, sample_ages=sample_ages, annotation=annotation)
-    logger.info("Done.")
+        ),
+    }
+    if progress is not None:
+        for stage, report in (
+            ("paint", watch_painting),
+            ("build_topology", whole_stage),
+            ("get_branch_length", whole_stage),
+        ):
+            stage_func = stages[stage]
+            stages[stage] = partial(
+                report, stage_func.func, stage, progress, **stage_func.keywords
+            )
+    return stages
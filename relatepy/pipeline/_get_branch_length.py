@@ -1,10 +1,13 @@
 # cython: language_level=3, cpp_locals=True
+import os
+import threading
 from pathlib import Path
 
 import cython
 from cython.cimports.libc.stdlib import free, malloc  # type: ignore
 from cython.cimports.relatepy.pipeline import GetBranchLengths, Options, get_options  # type: ignore
 
+from ..io import CoalescenceRates
 from ..utils import output_working_directory
 
 
@@ -17,10 +20,21 @@ def get_branch_length(
     last_section: int,
     mutation_rate: float,
     effective_population_size: float,
-    coal: Path | None = None,
+    coal: Path | CoalescenceRates | None = None,
     seed: int | None = None,
     sample_ages: Path | None = None,
 ):
+    if isinstance(coal, CoalescenceRates):
+        # Relate reads the rates from a file, write each distinct set once
+        path = output / f"coal_{coal.digest[:16]}.coal"
+        if not path.is_file():
+            # chunks may run concurrently, never expose a partial file
+            tmp = path.with_name(
+                f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+            )
+            coal.write(tmp)
+            os.replace(tmp, path)
+        coal = path
     args = [
         b"relate",
         b"--output",
@@ -0,0 +1,169 @@
+import json
+import os
+import re
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+CHECKPOINT_DIR = ".checkpoints"
+# Stages run for every chunk, in order. "chunk" is the per-chunk view of chunking,
+# "finalize" only runs per chunk when finalizing incrementally.
+STAGES = (
+    "chunk",
+    "paint",
+    "build_topology",
+    "find_equivalent_branches",
+    "get_branch_length",
+    "combine_sections",
+    "finalize",
+)
+CHUNK_ARTIFACT = re.compile(r"^(?:chunk_|parameters_c)(\d+)(?:\.|$)")
+
+
+def chunk_of(path: str) -> int | None:
+    """Index of the chunk a file relative to the output's parent belongs to."""
+    for part in Path(path).parts[1:]:
+        match = CHUNK_ARTIFACT.match(part)
+        if match is not None:
+            return int(match[1])
+    return None
+
+
+class Checkpoints:
+    """Completion markers of pipeline stages
+
+    A marker is written after a stage finished, recording the files the stage
+    created or modified together with their sizes. A stage is considered
+    complete when its marker exists and all of its recorded files are intact.
+
+    Markers are stored in ``<output>/.checkpoints``.
+    """
+
+    def __init__(self, output: Path) -> None:
+        self.output = output
+        self.root = output / CHECKPOINT_DIR
+
+    def _marker(self, stage: str, chunk_index: int | None = None) -> Path:
+        name = stage if chunk_index is None else f"{stage}_c{chunk_index}"
+        return self.root / f"{name}.json"
+
+    def _scan(self) -> dict[str, tuple[int, int]]:
+        paths = list(self.output.parent.glob(f"{self.output.name}.*"))
+        # unlike `rglob`, `os.walk` skips directories removed meanwhile
+        for dirpath, dirnames, filenames in os.walk(self.output):
+            if dirpath == str(self.output) and CHECKPOINT_DIR in dirnames:
+                dirnames.remove(CHECKPOINT_DIR)
+            paths.extend(Path(dirpath) / filename for filename in filenames)
+        files = {}
+        for p in paths:
+            try:
+                if p.is_file():
+                    stat = p.stat()
+                    files[str(p.relative_to(self.output.parent))] = (
+                        stat.st_size,
+                        stat.st_mtime_ns,
+                    )
+            except FileNotFoundError:  # removed by a concurrent stage
+                pass
+        return files
+
+    @contextmanager
+    def stage(self, stage: str, chunk_index: int | None = None):
+        """Run the body as ``stage`` and mark it complete if no exception raised.
+
+        Files of other chunks are not recorded for a chunk's stage, as they
+        may be written by stages running concurrently.
+        """
+        before = self._scan()
+        yield
+        after = self._scan()
+        self.mark(
+            stage,
+            chunk_index,
+            {
+                path: size
+                for path, (size, mtime) in after.items()
+                if before.get(path) != (size, mtime)
+                and (chunk_index is None or chunk_of(path) in (None, chunk_index))
+            },
+        )
+
+    def mark(
+        self,
+        stage: str,
+        chunk_index: int | None = None,
+        artifacts: dict[str, int] | None = None,
+    ) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._write(
+            self._marker(stage, chunk_index),
+            {"stage": stage, "chunk": chunk_index, "artifacts": artifacts or {}},
+        )
+
+    @staticmethod
+    def _write(marker: Path, content: dict) -> None:
+        # markers are read by other threads, never expose a partial one
+        tmp = marker.with_name(
+            f".{marker.name}.{os.getpid()}.{threading.get_ident()}.tmp"
+        )
+        tmp.write_text(json.dumps(content))
+        os.replace(tmp, marker)
+
+    def split_chunks(self, num_chunks: int) -> None:
+        """Split the marker of chunking into a global and per-chunk markers."""
+        artifacts = json.loads(self._marker("chunk").read_text())["artifacts"]
+        per_chunk: list[dict[str, int]] = [{} for _ in range(num_chunks)]
+        common = {}
+        for path, size in artifacts.items():
+            match = CHUNK_ARTIFACT.match(Path(path).name)
+            if match is not None and int(match[1]) < num_chunks:
+                per_chunk[int(match[1])][path] = size
+            else:
+                common[path] = size
+        self.mark("chunk", artifacts=common)
+        for c, chunk_artifacts in enumerate(per_chunk):
+            self.mark("chunk", c, chunk_artifacts)
+
+    def forget(self, paths) -> None:
+        """Drop deliberately removed files from all markers."""
+        removed = {str(Path(p).relative_to(self.output.parent)) for p in paths}
+        if not removed or not self.root.is_dir():
+            return
+        for marker in self.root.glob("*.json"):
+            content = json.loads(marker.read_text())
+            if removed.intersection(content["artifacts"]):
+                content["artifacts"] = {
+                    path: size
+                    for path, size in content["artifacts"].items()
+                    if path not in removed
+                }
+                self._write(marker, content)
+
+    def is_done(self, stage: str, chunk_index: int | None = None) -> bool:
+        marker = self._marker(stage, chunk_index)
+        if not marker.is_file():
+            return False
+        artifacts = json.loads(marker.read_text())["artifacts"]
+        for path, size in artifacts.items():
+            p = self.output.parent / path
+            if not p.is_file() or p.stat().st_size != size:
+                return False
+        return True
+
+    def latest(self, chunk_index: int) -> int | None:
+        """Index in `STAGES` of the last intact stage of a chunk."""
+        for i in reversed(range(len(STAGES))):
+            if self.is_done(STAGES[i], chunk_index):
+                return i
+        return None
+
+    def pending(self, chunk_index: int) -> tuple[str, ...]:
+        """Stages of a chunk which still need to run."""
+        latest = self.latest(chunk_index)
+        return STAGES[(0 if latest is None else latest + 1) :]
+
+    def chunked(self, num_chunks: int) -> bool:
+        """Whether chunking finished and every chunk can be resumed."""
+        return self.is_done("chunk") and all(
+            self.latest(c) is not None for c in range(num_chunks)
+        )
@@ -3,11 +3,14 @@ from pathlib import Path
 
 import click_log
 
+from ..io import HapsFile, read_sample, read_vcf
+from ..memory import MemoryModel
 from ..utils import resource_usage
 from ..relatepy import make_chunks
 
 logger = logging.getLogger(__package__)
 click_log.basic_config(logger)
+ENGINES = ("rust", "python")
 
 
 @resource_usage
@@ -19,6 +22,31 @@ def chunk(
     dist: Path | None = None,
     use_transitions: bool = True,
     memory_limit: float = 5.0,
+    memory_model: MemoryModel | None = None,
+    vcf: Path | None = None,
+    engine: str = "rust",
 ) -> None:
+    if engine not in ENGINES:
+        raise ValueError(f"Unknown engine `{engine}`, expected one of {ENGINES}.")
     logger.debug("Parsing data.")
+    if vcf is not None or engine == "python":
+        # VCF files are only streamed in Python, never held in memory
+        output.mkdir()
+        data = (
+            read_vcf(vcf, dist)
+            if vcf is not None
+            else HapsFile(haps, sample, dist, use_transitions)
+        )
+        data.make_chunks(
+            output,
+            genetic_map,
+            use_transitions=use_transitions,
+            min_memory=memory_limit,
+            memory_model=memory_model,
+        )
+        return
+    if memory_model is not None:
+        N = len(read_sample(sample).ids)
+        memory_limit = memory_model.equivalent_memory_limit(N, memory_limit)
+        logger.debug(f"Memory allowance calibrated to {memory_limit}GB.")
     make_chunks(haps, sample, genetic_map, output, dist, use_transitions, memory_limit)
@@ -0,0 +1,163 @@
+"""Chunk-level scheduling on a dask.distributed cluster
+
+Every stage of every chunk is submitted as a task depending on the previous
+stage of the chunk, and finalizing depends on the last stage of all chunks.
+Workers must share the filesystem of the output directory and run a single
+thread, as the stages change the working directory of their process, e.g.::
+
+    dask scheduler
+    dask worker <scheduler address> --nthreads 1 --resources MEMORY=64
+
+Paths other than the output, e.g. of sample ages, are read by the workers
+and should be absolute.
+
+Stages holding the painting of a chunk in memory require ``MEMORY`` GB of
+the worker, so that a worker runs as many of them as its memory allows.
+"""
+
+import logging
+import shutil
+import uuid
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+import click_log
+
+from ..utils import profile
+from .checkpoint import Checkpoints
+from .scratch import ScratchSpace, painting_size
+
+if TYPE_CHECKING:
+    from distributed import Client, Future
+
+logger = logging.getLogger(__package__)
+click_log.basic_config(logger)
+
+MEMORY = "MEMORY"
+
+
+def run_stage(
+    func: Callable[[], None],
+    output: Path,
+    stage: str,
+    chunk_index: int | None,
+    *after: None,
+    scratch: ScratchSpace | None = None,
+    cleanup: bool = False,
+) -> None:
+    """Run a stage on a worker, ``after`` are the results of its dependencies."""
+    checkpoints = Checkpoints(output)
+    if stage == "paint":
+        if (output / f"chunk_{chunk_index}").exists():
+            # painting appends to its files, partial results must not be reused
+            shutil.rmtree(output / f"chunk_{chunk_index}")
+        if scratch is not None:
+            scratch.reserve(painting_size(output, chunk_index))
+    name = stage if chunk_index is None else f"{stage}_c{chunk_index}"
+    with checkpoints.stage(stage, chunk_index), profile(name):
+        func()
+    if cleanup and scratch is not None and chunk_index is not None:
+        checkpoints.forget(scratch.release(stage, chunk_index))
+
+
+def check_memory(client: "Client", required: float) -> None:
+    """Raise if no worker advertises ``required`` GB of ``MEMORY``.
+
+    Tasks requiring a resource that no worker has stay pending forever.
+    """
+    available = [
+        worker.get("resources", {}).get(MEMORY)
+        for worker in client.scheduler_info()["workers"].values()
+    ]
+    available = [value for value in available if value is not None]
+    if not available:
+        raise ValueError(
+            f"No worker of the cluster advertises the {MEMORY} resource, start "
+            f"workers with e.g. `--resources {MEMORY}={required:g}`."
+        )
+    if max(available) < required:
+        raise ValueError(
+            f"Stages require {MEMORY}={required:g} but workers of the cluster "
+            f"advertise at most {MEMORY}={max(available):g}."
+        )
+
+
+def submit_chunks(
+    client: "Client",
+    output: Path,
+    chunks: dict[int, tuple[dict[str, Callable[[], None]], tuple[str, ...]]],
+    memory: dict[str, float],
+    finalize: Callable[[], None] | None = None,
+    scratch: ScratchSpace | None = None,
+    cleanup: bool = False,
+) -> list["Future"]:
+    """Submit the pending stages of chunks and finalizing to a cluster.
+
+    Parameters
+    ----------
+    client : Client
+        Client of the cluster.
+    output : Path
+        Absolute path of the working directory, shared by all workers.
+    chunks : dict[int, tuple[dict[str, Callable[[], None]], tuple[str, ...]]]
+        Stages and the names of pending stages, keyed by chunk index.
+    memory : dict[str, float]
+        Memory in GB required by stages, other stages require no resources.
+    finalize : Callable[[], None] | None, optional
+        Run after all chunks if given, by default None.
+
+    Returns
+    -------
+    list[Future]
+        Futures of the last task of every chunk, or of finalizing.
+
+    Raises
+    ------
+    ValueError
+        If no worker advertises the ``MEMORY`` required by stages.
+    """
+    required = [
+        memory[stage]
+        for _, pending in chunks.values()
+        for stage in pending
+        if stage in memory
+    ]
+    if required:
+        check_memory(client, max(required))
+    # keys of an earlier run may still be held by the scheduler
+    token = uuid.uuid4().hex[:8]
+    last = []
+    for c, (stages, pending) in chunks.items():
+        previous: tuple["Future", ...] = ()
+        for stage in pending:
+            previous = (
+                client.submit(
+                    run_stage,
+                    stages[stage],
+                    output,
+                    stage,
+                    c,
+                    *previous,
+                    scratch=scratch,
+                    cleanup=cleanup,
+                    key=f"{stage}-{c}-{token}",
+                    resources={MEMORY: memory[stage]} if stage in memory else None,
+                    pure=False,
+                ),
+            )
+        last.extend(previous)
+    logger.info(f"Submitted {len(chunks)} chunks to {client.scheduler.address}.")
+    if finalize is None:
+        return last
+    return [
+        client.submit(
+            run_stage,
+            finalize,
+            output,
+            "finalize",
+            None,
+            *last,
+            key=f"finalize-{token}",
+            pure=False,
+        )
+    ]
@@ -0,0 +1,174 @@
+"""Incremental finalize
+
+Appends the combined output of each chunk (``chunk_<c>.anc`` and
+``chunk_<c>.mut`` in the output directory) to the final ``.anc``/``.mut`` files
+as soon as the chunk is finished, and removes the temporary files of the
+chunk, so that peak disk usage is bounded by about one chunk.
+
+Consecutive chunks overlap, every SNP is emitted once, by the first chunk
+containing it. SNP indices of a chunk are mapped to the chromosome through
+the chunk's ``.bp`` file, which works whether a chunk numbers its SNPs
+locally or globally.
+"""
+import json
+import logging
+import re
+import shutil
+from pathlib import Path
+
+import click_log
+import numpy as np
+
+logger = logging.getLogger(__package__)
+click_log.basic_config(logger)
+
+NUM_TREES_WIDTH = 12
+NODE = re.compile(r"(-?\d+):\(([^ ()]+) ([^ ()]+) (-?\d+) (-?\d+)\)")
+
+
+def read_bp(output: Path, chunk_index: int) -> np.ndarray:
+    content = np.fromfile(output / f"chunk_{chunk_index}.bp", dtype="u4")
+    return content[1 : 1 + content[0]]
+
+
+def chunk_starts(output: Path, num_chunks: int) -> list[int]:
+    """Index of the first SNP of every chunk on the chromosome."""
+    starts = [0]
+    bp = read_bp(output, 0)
+    for c in range(1, num_chunks):
+        next_bp = read_bp(output, c)
+        starts.append(starts[-1] + int(np.searchsorted(bp, next_bp[0])))
+        bp = next_bp
+    return starts
+
+
+class IncrementalFinalizer:
+    """Writer of the final ``.anc``/``.mut`` files, fed one chunk at a time
+
+    Progress is kept in ``<output>/finalize.json``, so an interrupted run can
+    continue after the last appended chunk if ``resume`` is set. Appending a
+    chunk again is a no-op and closing can be repeated.
+    """
+
+    def __init__(self, output: Path, num_chunks: int, resume: bool = False) -> None:
+        self.output = output
+        self.anc = output.parent / f"{output.name}.anc"
+        self.mut = output.parent / f"{output.name}.mut"
+        self._state_file = output / "finalize.json"
+        if resume and self._state_file.is_file():
+            self.state = json.loads(self._state_file.read_text())
+            # drop anything written after the last completed append
+            for path, size in ((self.anc, "anc_size"), (self.mut, "mut_size")):
+                with path.open("r+b") as f:
+                    f.truncate(self.state[size])
+        else:
+            self.state = dict(
+                starts=chunk_starts(output, num_chunks),
+                next_chunk=0,
+                next_snp=0,
+                num_trees=0,
+                num_trees_offset=None,
+                anc_size=0,
+                mut_size=0,
+            )
+            self.anc.unlink(missing_ok=True)
+            self.mut.unlink(missing_ok=True)
+
+    def _save(self) -> None:
+        self.state["anc_size"] = self.anc.stat().st_size
+        self.state["mut_size"] = self.mut.stat().st_size
+        self._state_file.write_text(json.dumps(self.state))
+
+    def append(self, chunk_index: int) -> None:
+        """Append a combined chunk, chunks appended before are skipped."""
+        if chunk_index < self.state["next_chunk"]:
+            return
+        if chunk_index != self.state["next_chunk"]:
+            raise ValueError(
+                f"Chunk {chunk_index} can not be appended before chunk "
+                f"{self.state['next_chunk']}."
+            )
+        start = self.state["starts"][chunk_index]
+        cut = self.state["next_snp"]
+        bp = read_bp(self.output, chunk_index)
+        chunk_anc = self.output / f"chunk_{chunk_index}.anc"
+        chunk_mut = self.output / f"chunk_{chunk_index}.mut"
+
+        with chunk_mut.open() as src, self.mut.open("a") as dst:
+            header = src.readline()
+            if chunk_index == 0:
+                dst.write(header)
+            rows = [line.split(";") for line in src if line.strip()]
+        offset = start
+        if rows:
+            # convert the chunk's SNP numbering to the chromosome's
+            snp, pos = int(rows[0][0]), int(rows[0][1])
+            offset += int(np.searchsorted(bp, pos)) - snp
+
+        with chunk_anc.open() as src, self.anc.open("a") as dst:
+            haplotypes = src.readline()
+            src.readline()  # NUM_TREES
+            if chunk_index == 0:
+                dst.write(haplotypes)
+                dst.write("NUM_TREES ")
+                self.state["num_trees_offset"] = len(
+                    f"{haplotypes}NUM_TREES ".encode()
+                )
+                # placeholder, replaced by the number of trees on `close`
+                dst.write(" " * NUM_TREES_WIDTH + "\n")
+            trees = [line for line in src if line.strip()]
+            tree_starts = [int(t[: t.index(":")]) + offset for t in trees]
+            tree_ends = tree_starts[1:] + [start + len(bp)]
+            first_tree = None
+            for i, tree in enumerate(trees):
+                if tree_ends[i] <= cut:
+                    continue
+                if first_tree is None:
+                    first_tree = i
+                nodes = NODE.sub(
+                    lambda m: f"{m[1]}:({m[2]} {m[3]} "
+                    f"{int(m[4]) + offset} {int(m[5]) + offset})",
+                    tree[tree.index(":") + 1 :],
+                )
+                dst.write(f"{max(tree_starts[i], cut)}:{nodes}")
+        if first_tree is None:
+            first_tree = len(trees)
+        num_kept_trees = len(trees) - first_tree
+
+        with self.mut.open("a") as dst:
+            for row in rows:
+                row[0] = str(int(row[0]) + offset)
+                if int(row[0]) < cut:
+                    continue
+                if int(row[4]) >= 0:
+                    row[4] = str(int(row[4]) - first_tree + self.state["num_trees"])
+                dst.write(";".join(row))
+
+        self.state["num_trees"] += num_kept_trees
+        self.state["next_snp"] = start + len(bp)
+        self.state["next_chunk"] = chunk_index + 1
+        self._save()
+        logger.debug(f"Appended {num_kept_trees} trees of chunk {chunk_index}.")
+
+    def remove(self, chunk_index: int) -> list[Path]:
+        """Delete the temporaries of an appended chunk, which are returned."""
+        if chunk_index >= self.state["next_chunk"]:
+            raise ValueError(f"Chunk {chunk_index} has not been appended.")
+        removed = [
+            p
+            for p in self.output.glob(f"chunk_{chunk_index}*")
+            if p.name == f"chunk_{chunk_index}"
+            or p.name.startswith(f"chunk_{chunk_index}.")
+        ]
+        for p in removed:
+            if p.is_dir():
+                shutil.rmtree(p)
+            else:
+                p.unlink()
+        return removed
+
+    def close(self) -> None:
+        """Write the total number of trees into the header, in place."""
+        with self.anc.open("r+b") as f:
+            f.seek(self.state["num_trees_offset"])
+            f.write(str(self.state["num_trees"]).ljust(NUM_TREES_WIDTH).encode())
@@ -1,18 +1,34 @@
+import io
 import pathlib
 import warnings
 
 import numpy as np
-from relatepy.io import HapsFile
+from relatepy.io import BLOCK_SIZE, WINDOWS_PER_SECTION, HapsFile
 from ..utils import resource_usage
 from ..relatepy import paint as _paint
 
 LOWER_RESCALING_THRESHOLD = 1e-10
 UPPER_RESCALING_THRESHOLD = 1e10
+# lazy vectors are materialized before their scale under- or overflows
+MAX_LOG_SCALE = 200.0
 
 
 class FastPainting:
-    def __init__(self, nobs: int, theta: float = 0.001) -> None:
+    def __init__(
+        self, nobs: int, theta: float = 0.001, container: bool = False
+    ) -> None:
+        """
+        Parameters
+        ----------
+        nobs : int
+        theta : float, optional
+            by default 0.001
+        container : bool, optional
+            Write all windows into one `PaintingContainer` instead of a file
+            per window, by default False
+        """
         assert theta < 1.0
+        self.container = container
         self.theta = theta
         self.ntheta = ntheta = 1.0 - theta
         self.Nminusone = nobs - 1.0
@@ -22,22 +38,21 @@ class FastPainting:
         self.log_ntheta = np.log(ntheta)
         self.log_small = np.log(0.01)
 
-    def paint_stepping_stones(
-        self, data: HapsFile, chunk_index, k, paint_dir: pathlib.Path
-    ):
+    def _sites(self, data: HapsFile, chunk_index, k):
+        """Derived sites of `k` and the transition quantities between them."""
         if data.data.n_obs < 100:
             warnings.warn(f"Sample number `{data.data.n_obs}` is too small.")
         window_boundaries = data.window_boundaries[chunk_index]
-        num_windows = len(window_boundaries) - 1
         if window_boundaries[-1] != data.L:
             raise ValueError("")
         last_snp: np.uint32 = data.L - 1
-        derived_k = np.flatnonzero(data.data.X[k] == 1)
+        # only the derived sites of `k` are read, which matters for backed data
+        haplotype_k = np.asarray(data.data.X[k])
+        derived_k = np.flatnonzero(haplotype_k == 1)
         if 0 not in derived_k:
             derived_k = np.append(0, derived_k)
         if last_snp not in derived_k:
             derived_k = np.append(derived_k, last_snp)
-        num_derived_sites = len(derived_k)
         r_sum = np.clip(
             [_.sum() for _ in np.split(data.r, derived_k[1:])], 0, -np.log(0.01)
         )
@@ -47,6 +62,45 @@ class FastPainting:
         i = np.searchsorted(derived_k, window_boundaries[1:-1])
         boundary_snp_begin = np.append(0, derived_k[i])
         boundary_snp_end = np.append(window_boundaries[1:-1], last_snp)
+        return (
+            haplotype_k,
+            derived_k,
+            r_prob,
+            nor_x_theta,
+            boundary_snp_begin,
+            boundary_snp_end,
+        )
+
+    def _derived(self, data: HapsFile, haplotype_k, derived_k, reverse=False):
+        """Whether haplotypes are ancestral where `k` is derived, site by site
+
+        Haplotypes are read in blocks of `BLOCK_SIZE` SNPs, as by
+        `HapsFile.derived_counts`, so backed data is read sequentially and only
+        one block is held in memory.
+        """
+        X = data.data.X
+        starts = range(0, data.L, BLOCK_SIZE)
+        for start in reversed(starts) if reverse else starts:
+            sites = derived_k[(derived_k >= start) & (derived_k < start + BLOCK_SIZE)]
+            if not len(sites):
+                continue
+            block = np.asarray(X[:, start : start + BLOCK_SIZE])
+            derived = block[:, sites - start] < haplotype_k[sites]
+            yield from (derived[:, ::-1] if reverse else derived).T
+
+    def paint_stepping_stones(
+        self, data: HapsFile, chunk_index, k, paint_dir: pathlib.Path
+    ):
+        (
+            haplotype_k,
+            derived_k,
+            r_prob,
+            nor_x_theta,
+            boundary_snp_begin,
+            boundary_snp_end,
+        ) = self._sites(data, chunk_index, k)
+        num_windows = len(boundary_snp_begin)
+        num_derived_sites = len(derived_k)
         alpha = np.zeros((num_windows, data.N), dtype=np.float32)
         beta = np.zeros((num_windows, data.N), dtype=np.float32)
         logscales_alpha = np.zeros(num_windows, dtype=np.float32)
@@ -62,10 +116,10 @@ class FastPainting:
         # I am alternating between two rows, to keep the previous and the current values
         alpha_aux = np.zeros((2, data.N), dtype=np.double)
         logscale: list = [0.0, -nor_x_theta[0]]
-        derived = data.data.X < data.data.X[k]
         it_boundary_snp_begin = 0
         alpha_sum = self.ntheta / r_prob[0] * (1 - r_prob[0])
-        for i, snp in enumerate(derived_k):
+        forward_sites = self._derived(data, haplotype_k, derived_k)
+        for i, (snp, derived_i) in enumerate(zip(derived_k, forward_sites)):
             # precalculated quantities
             aux_index = i % 2
             aux_index_prev = 1 - aux_index
@@ -76,14 +130,14 @@ class FastPainting:
                 logscale[aux_index] = logscale[aux_index_prev] + nor_x_theta[i]
                 alpha_aux[aux_index] = alpha_aux[aux_index_prev] + r * alpha_sum
                 alpha_aux[aux_index] *= np.where(
-                    derived[:, snp], self.theta / self.ntheta, 1
+                    derived_i, self.theta / self.ntheta, 1
                 )
             else:
                 r = 1
                 logscale[aux_index_prev] = logscale[aux_index]
                 logscale[aux_index] += np.log(self.ntheta / self.Nminusone * alpha_sum)
                 alpha_aux[aux_index] = np.where(
-                    derived[:, snp], self.theta / self.ntheta, 1
+                    derived_i, self.theta / self.ntheta, 1
                 )
             alpha_aux[aux_index, k] = 0.0
             alpha_sum = alpha_aux[aux_index].sum()
@@ -115,7 +169,9 @@ class FastPainting:
         logscale = [normalizing_constant, normalizing_constant]
         beta_aux = np.zeros((2, data.N), dtype=np.double)
         beta_aux[aux_index] = 1.0
-        beta_sum = np.where(derived[:, last_snp], self.theta, self.ntheta).sum() - self.ntheta
+        backward_sites = self._derived(data, haplotype_k, derived_k, reverse=True)
+        derived_i = next(backward_sites)
+        beta_sum = np.where(derived_i, self.theta, self.ntheta).sum() - self.ntheta
         rit_boundarySNP_end = len(boundary_snp_end) - 1
         for i, snp in enumerate(reversed(derived_k)):
             last = i == 0
@@ -124,6 +180,7 @@ class FastPainting:
             aux_index_prev = 1 - aux_index
             
             if not last:
+                derived_i = next(backward_sites)
                 if r_prob[i] < 1.0:
                     r = r_prob[i] / ((1.0 - r_prob[i]) * self.Nminusone)
                     # inner loop of backwards algorithm
@@ -131,10 +188,10 @@ class FastPainting:
                     beta_aux[aux_index] = (
                         beta_aux[aux_index_prev]
                         + r * beta_sum
-                        / np.where(derived[:, snp], self.theta, self.ntheta)
+                        / np.where(derived_i, self.theta, self.ntheta)
                     )
                     beta_aux[aux_index] *= np.where(
-                        derived[:, snp], self.theta/self.ntheta, 1
+                        derived_i, self.theta/self.ntheta, 1
                     )
                 else:
                     logscale[aux_index_prev] = logscale[aux_index]
@@ -142,7 +199,7 @@ class FastPainting:
                         self.ntheta / self.Nminusone * alpha_sum
                     )
                 beta_aux[aux_index, k] = 0
-                beta_sum = (np.where(derived[:, snp], self.theta, self.ntheta) * beta_aux[aux_index]).sum()
+                beta_sum = (np.where(derived_i, self.theta, self.ntheta) * beta_aux[aux_index]).sum()
                 if (
                     beta_sum < LOWER_RESCALING_THRESHOLD
                     or beta_sum > UPPER_RESCALING_THRESHOLD
@@ -163,17 +220,334 @@ class FastPainting:
                     if rit_boundarySNP_end == -1:
                         break
 
-        # Dump to file
-        for i in range(num_windows):
+        self._dump(
+            paint_dir,
+            k,
+            data.window_boundaries[chunk_index],
+            (alpha, boundary_snp_begin, logscales_alpha),
+            (beta, boundary_snp_end, logscales_beta),
+        )
+
+    def _dump(self, paint_dir: pathlib.Path, k, window_boundaries, forward, backward):
+        alpha, boundary_snp_begin, logscales_alpha = forward
+        beta, boundary_snp_end, logscales_beta = backward
+        records = []
+        for i in range(len(window_boundaries) - 1):
             startinterval = window_boundaries[i]
             endinterval = window_boundaries[i + 1] - 1
-            pfile = paint_dir / f"relate_{i}.bin"
-            with pfile.open("ab") as fp:
-                fp.write(
-                    np.array([startinterval, endinterval], dtype=np.int32).tobytes()
-                )
-                dump_to_file(fp, alpha[i], boundary_snp_begin[i], logscales_alpha[i])
-                dump_to_file(fp, beta[i], boundary_snp_end[i], logscales_beta[i])
+            fp = io.BytesIO()
+            fp.write(np.array([startinterval, endinterval], dtype=np.int32).tobytes())
+            dump_to_file(fp, alpha[i], boundary_snp_begin[i], logscales_alpha[i])
+            dump_to_file(fp, beta[i], boundary_snp_end[i], logscales_beta[i])
+            records.append(fp.getvalue())
+        if self.container:
+            PaintingContainer(paint_dir).append(k, records)
+        else:
+            for i, record in enumerate(records):
+                with (paint_dir / f"relate_{i}.bin").open("ab") as fp:
+                    fp.write(record)
+
+
+class PaintingContainer:
+    """Paintings of all windows of a chunk in a single file
+
+    Records are appended to ``relate.bin`` in the order they are painted, and
+    ``relate.idx`` holds the window, target haplotype, offset and size of each.
+    Only two files are open at a time whatever the number of windows.
+
+    Containers are only used through the API, ``relate chunk`` and ``relate
+    all`` cap the windows of chunks and paint with the Rust painter, which
+    rejects uncapped chunks. Chunk with ``windows_per_section=None`` in
+    `HapsFile.make_chunks`, paint every target with
+    ``FastPainting(N, container=True)`` into ``chunk_<c>/paint`` and `explode`
+    the container there before building the topology.
+    """
+
+    INDEX_DTYPE = np.dtype(
+        [("window", "<u4"), ("target", "<u4"), ("offset", "<u8"), ("size", "<u8")]
+    )
+
+    def __init__(self, paint_dir: pathlib.Path) -> None:
+        self.path = paint_dir / "relate.bin"
+        self.index_path = paint_dir / "relate.idx"
+
+    def append(self, target: int, records: list[bytes]) -> None:
+        """Append the records of ``target``, one per window."""
+        index = np.zeros(len(records), dtype=self.INDEX_DTYPE)
+        index["window"] = np.arange(len(records))
+        index["target"] = target
+        index["size"] = [len(record) for record in records]
+        with self.path.open("ab") as f:
+            # a record is only indexed once complete
+            index["offset"] = f.tell() + np.cumsum(index["size"]) - index["size"]
+            f.writelines(records)
+        with self.index_path.open("ab") as f:
+            f.write(index.tobytes())
+
+    @property
+    def index(self) -> np.ndarray:
+        return np.fromfile(self.index_path, dtype=self.INDEX_DTYPE)
+
+    def read(self, window: int, target: int) -> bytes:
+        index = self.index
+        (entry,) = index[(index["window"] == window) & (index["target"] == target)]
+        with self.path.open("rb") as f:
+            f.seek(entry["offset"])
+            return f.read(entry["size"])
+
+    def explode(self, output_dir: pathlib.Path | None = None) -> list[pathlib.Path]:
+        """Write the per-window ``relate_<window>.bin`` files read by Relate.
+
+        Windows are written one after another, so the number of windows is
+        not limited by open files either.
+        """
+        output_dir = self.path.parent if output_dir is None else output_dir
+        index = self.index
+        paths = []
+        with self.path.open("rb") as src:
+            for window in np.unique(index["window"]):
+                path = output_dir / f"relate_{window}.bin"
+                with path.open("wb") as dst:
+                    for entry in index[index["window"] == window]:
+                        src.seek(entry["offset"])
+                        dst.write(src.read(entry["size"]))
+                paths.append(path)
+        return paths
+
+
+def carrier_index(data: HapsFile) -> tuple[np.ndarray, np.ndarray]:
+    """Haplotypes carrying the derived allele of every SNP, in CSR layout
+
+    Returns
+    -------
+    tuple[np.ndarray, np.ndarray]
+        ``indptr`` of length L + 1 and ``indices``, the carriers of SNP ``i``
+        are ``indices[indptr[i]:indptr[i + 1]]``
+    """
+    X = data.data.X
+    counts, indices = [], []
+    for start in range(0, data.L, BLOCK_SIZE):
+        block = np.asarray(X[:, start : start + BLOCK_SIZE])
+        snps, haplotypes = np.nonzero(block.T == 1)
+        counts.append(np.bincount(snps, minlength=block.shape[1]))
+        indices.append(haplotypes.astype(np.uint32))
+    indptr = np.zeros(data.L + 1, dtype=np.int64)
+    np.cumsum(np.concatenate(counts), out=indptr[1:])
+    return indptr, np.concatenate(indices)
+
+
+class LazyVector:
+    """Vector ``scale * u + offset`` with O(1) uniform updates
+
+    Only entries set explicitly cost time, the sum is kept up to date. A
+    single entry set since the last uniform update is reproduced exactly.
+    """
+
+    def __init__(self, size: int, offset: float = 0.0) -> None:
+        self.u = np.zeros(size, dtype=np.double)
+        self.scale = 1.0
+        self.offset = offset
+        self.u_sum = 0.0
+        self._exact: dict[int, float] = {}
+
+    def __getitem__(self, index):
+        return self.scale * self.u[index] + self.offset
+
+    def __setitem__(self, index, value):
+        u = (value - self.offset) / self.scale
+        self.u_sum += np.sum(u - self.u[index])
+        self.u[index] = u
+        if np.ndim(index) == 0:
+            self._exact[index] = value
+        else:
+            for exact in self._exact:
+                position = np.flatnonzero(index == exact)
+                if len(position):
+                    self._exact[exact] = np.broadcast_to(value, index.shape)[
+                        position[0]
+                    ]
+
+    def sum(self) -> float:
+        return self.scale * self.u_sum + self.offset * len(self.u)
+
+    def add(self, value: float) -> None:
+        self.offset += value
+        self._exact.clear()
+
+    def multiply(self, factor: float) -> None:
+        self.scale *= factor
+        self.offset *= factor
+        for index in self._exact:
+            self._exact[index] *= factor
+
+    def multiply_except(self, factor: float, index) -> None:
+        """Multiply all entries but ``index`` by ``factor``."""
+        unchanged = self[index]
+        self.multiply(factor)
+        self[index] = unchanged
+
+    def fold(self) -> None:
+        """Fold scale and offset into the entries once the scale drifted away."""
+        if abs(np.log(self.scale)) > MAX_LOG_SCALE:
+            self.u = self.materialize()
+            self.scale, self.offset = 1.0, 0.0
+            self.u_sum = self.u.sum()
+
+    def materialize(self) -> np.ndarray:
+        values = self.scale * self.u + self.offset
+        for index, value in self._exact.items():
+            values[index] = value
+        return values
+
+
+class SparsePainting(FastPainting):
+    """`FastPainting` touching only the carriers of every derived site
+
+    Where ``k`` is derived, haplotypes carrying the derived allele keep their
+    value and all others are multiplied by ``theta / ntheta``. Keeping the
+    uniform factor and the recombination term as lazy scale and offset, a
+    site costs O(carriers) instead of O(N), full vectors are only built at
+    window boundaries.
+    """
+
+    def __init__(
+        self, nobs: int, theta: float = 0.001, container: bool = False
+    ) -> None:
+        super().__init__(nobs, theta, container)
+        self._data = None
+
+    def _carriers(self, data: HapsFile, snp) -> np.ndarray:
+        if self._data is not data:
+            self._data = data
+            self._indptr, self._indices = carrier_index(data)
+        return self._indices[self._indptr[snp] : self._indptr[snp + 1]]
+
+    def paint_stepping_stones(
+        self, data: HapsFile, chunk_index, k, paint_dir: pathlib.Path
+    ):
+        (
+            haplotype_k,
+            derived_k,
+            r_prob,
+            nor_x_theta,
+            boundary_snp_begin,
+            boundary_snp_end,
+        ) = self._sites(data, chunk_index, k)
+        num_windows = len(boundary_snp_begin)
+        num_derived_sites = len(derived_k)
+        theta_ratio = self.theta / self.ntheta
+        # carriers of every site, None where `k` is ancestral and so all
+        # haplotypes are treated alike
+        carriers = [
+            self._carriers(data, snp) if haplotype_k[snp] == 1 else None
+            for snp in derived_k
+        ]
+        alpha = np.zeros((num_windows, data.N), dtype=np.float32)
+        beta = np.zeros((num_windows, data.N), dtype=np.float32)
+        logscales_alpha = np.zeros(num_windows, dtype=np.float32)
+        logscales_beta = np.zeros(num_windows, dtype=np.float32)
+
+        # Forward algorithm
+        alpha_aux = LazyVector(data.N)
+        logscale: list = [0.0, -nor_x_theta[0]]
+        it_boundary_snp_begin = 0
+        alpha_sum = self.ntheta / r_prob[0] * (1 - r_prob[0])
+        for i, snp in enumerate(derived_k):
+            aux_index = i % 2
+            aux_index_prev = 1 - aux_index
+            if r_prob[i] < 1:
+                r = r_prob[i] / ((1 - r_prob[i]) * self.Nminusone)
+                logscale[aux_index] = logscale[aux_index_prev] + nor_x_theta[i]
+                alpha_aux.add(r * alpha_sum)
+                if carriers[i] is not None:
+                    alpha_aux.multiply_except(theta_ratio, carriers[i])
+            else:
+                logscale[aux_index_prev] = logscale[aux_index]
+                logscale[aux_index] += np.log(self.ntheta / self.Nminusone * alpha_sum)
+                alpha_aux = LazyVector(data.N, offset=1.0)
+                if carriers[i] is not None:
+                    alpha_aux.multiply_except(theta_ratio, carriers[i])
+            alpha_aux[k] = 0.0
+            alpha_sum = alpha_aux.sum()
+
+            if (
+                alpha_sum < LOWER_RESCALING_THRESHOLD
+                or alpha_sum > UPPER_RESCALING_THRESHOLD
+            ):
+                alpha_aux.multiply(1 / alpha_sum)
+                logscale[aux_index] += np.log(alpha_sum)
+                alpha_sum = 1.0
+            alpha_aux.fold()
+
+            while (
+                it_boundary_snp_begin != num_windows
+                and boundary_snp_begin[it_boundary_snp_begin] == snp
+            ):
+                alpha[it_boundary_snp_begin] = alpha_aux.materialize()
+                logscales_alpha[it_boundary_snp_begin] = logscale[aux_index]
+                it_boundary_snp_begin += 1
+
+        # Backward algorithm
+        normalizing_constant = np.double(
+            np.log(self.Nminusone) - num_derived_sites * self.log_ntheta
+        )
+        logscale = [normalizing_constant, normalizing_constant]
+        beta_aux = LazyVector(data.N, offset=1.0)
+        num_ancestral = 0 if carriers[-1] is None else data.N - len(carriers[-1])
+        beta_sum = (
+            self.theta * num_ancestral
+            + self.ntheta * (data.N - num_ancestral)
+            - self.ntheta
+        )
+        rit_boundary_snp_end = num_windows - 1
+        for i in reversed(range(num_derived_sites)):
+            snp = derived_k[i]
+            aux_index = i % 2
+            aux_index_prev = 1 - aux_index
+            if i != num_derived_sites - 1:
+                if r_prob[i] < 1.0:
+                    r = r_prob[i] / ((1.0 - r_prob[i]) * self.Nminusone)
+                    logscale[aux_index] = logscale[aux_index_prev] + nor_x_theta[i]
+                    if carriers[i] is not None:
+                        beta_aux.multiply_except(theta_ratio, carriers[i])
+                    beta_aux.add(r * beta_sum / self.ntheta)
+                else:
+                    logscale[aux_index_prev] = logscale[aux_index]
+                    logscale[aux_index_prev] += np.log(
+                        self.ntheta / self.Nminusone * alpha_sum
+                    )
+                beta_aux[k] = 0
+                beta_sum = beta_aux.sum()
+                if carriers[i] is None:
+                    beta_sum *= self.ntheta
+                else:
+                    beta_sum = self.theta * beta_sum + (self.ntheta - self.theta) * (
+                        np.sum(beta_aux[carriers[i]])
+                    )
+                if (
+                    beta_sum < LOWER_RESCALING_THRESHOLD
+                    or beta_sum > UPPER_RESCALING_THRESHOLD
+                ):
+                    beta_aux.multiply(1 / beta_sum)
+                    logscale[aux_index] += np.log(beta_sum)
+                    beta_sum = 1.0
+                beta_aux.fold()
+
+            while (
+                rit_boundary_snp_end >= 0
+                and boundary_snp_end[rit_boundary_snp_end] == snp
+            ):
+                beta[rit_boundary_snp_end] = beta_aux.materialize()
+                logscales_beta[rit_boundary_snp_end] = logscale[aux_index]
+                rit_boundary_snp_end -= 1
+
+        self._dump(
+            paint_dir,
+            k,
+            data.window_boundaries[chunk_index],
+            (alpha, boundary_snp_begin, logscales_alpha),
+            (beta, boundary_snp_end, logscales_beta),
+        )
 
 
 def dump_to_file(f, a, b, l):
@@ -190,4 +564,15 @@ def paint(
     theta: float = 0.001,
     rho: float = 1.0,
 ):
+    num_windows = (
+        int(np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")[2]) - 1
+    )
+    if num_windows > WINDOWS_PER_SECTION:
+        # the Rust painter writes a file per window and has no container
+        raise ValueError(
+            f"Chunk {chunk_index} has {num_windows} windows, the Rust painter "
+            f"supports at most {WINDOWS_PER_SECTION}. Chunks made with "
+            "`windows_per_section=None` can only be painted by `FastPainting` or "
+            "`SparsePainting` into a `PaintingContainer`."
+        )
     _paint(output, chunk_index, theta, rho)
@@ -0,0 +1,168 @@
+"""Progress of long-running stages
+
+Relate runs a stage on a chunk in one call, without a hook between sections.
+Stages are never split to report progress: each call would reseed the RNG of
+``--seed`` and re-read the inputs of the chunk, so results would depend on
+reporting. Building topology and estimating branch lengths therefore report
+when they start and finish. Painting is a single call into Rust, its progress
+is estimated from the size of the painting written so far.
+"""
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable
+
+import click_log
+import numpy as np
+
+from .scratch import painting_size
+
+logger = logging.getLogger(__package__)
+click_log.basic_config(logger)
+
+POLL_INTERVAL = 5.0  # seconds
+
+
+@dataclass(frozen=True)
+class Progress:
+    """Progress of a stage on a chunk
+
+    Attributes
+    ----------
+    stage : str
+        Name of the stage, as in `relatepy.pipeline.checkpoint.STAGES`.
+    chunk_index : int
+        Index of the chunk.
+    done, total : int
+        Targets painted and in total, or 0 or 1 out of 1 for other stages.
+    snps : int
+        SNPs of the chunk processed so far.
+    elapsed : float
+        Seconds since the stage started.
+    """
+
+    stage: str
+    chunk_index: int
+    done: int
+    total: int
+    snps: int
+    elapsed: float
+
+    @property
+    def fraction(self) -> float:
+        return self.done / self.total if self.total else 1.0
+
+    @property
+    def snps_per_second(self) -> float:
+        return self.snps / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def remaining(self) -> float | None:
+        """Estimated seconds until the stage finishes."""
+        if not self.done:
+            return None
+        return self.elapsed * (self.total - self.done) / self.done
+
+
+# called from a background thread while painting
+ProgressCallback = Callable[[Progress], None]
+
+
+class LogProgress:
+    """Log progress at most every ``interval`` seconds per stage and chunk"""
+
+    def __init__(self, interval: float = 60.0) -> None:
+        self.interval = interval
+        self._last: dict[tuple[str, int], float] = {}
+
+    def __call__(self, progress: Progress) -> None:
+        key = (progress.stage, progress.chunk_index)
+        now = time.monotonic()
+        if progress.done < progress.total and (
+            now - self._last.get(key, -self.interval) < self.interval
+        ):
+            return
+        self._last[key] = now
+        remaining = progress.remaining
+        logger.info(
+            f"{progress.stage} of chunk {progress.chunk_index}: "
+            f"{progress.done}/{progress.total} ({progress.fraction:.0%}), "
+            f"{progress.snps_per_second:.1f} SNPs/s"
+            + ("." if remaining is None else f", {remaining:.0f}s left.")
+        )
+
+
+def whole_stage(
+    func: Callable[..., None],
+    stage: str,
+    callback: ProgressCallback,
+    *,
+    output: Path,
+    chunk_index: int,
+    **kwargs,
+) -> None:
+    """Run ``func`` in one call, exactly as without progress, reporting its end."""
+    parameters = np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")
+    start = time.perf_counter()
+    callback(Progress(stage, chunk_index, 0, 1, 0, 0.0))
+    func(output=output, chunk_index=chunk_index, **kwargs)
+    callback(
+        Progress(
+            stage, chunk_index, 1, 1, int(parameters[1]), time.perf_counter() - start
+        )
+    )
+
+
+def watch_painting(
+    func: Callable[..., None],
+    stage: str,
+    callback: ProgressCallback,
+    *,
+    output: Path,
+    chunk_index: int,
+    interval: float = POLL_INTERVAL,
+    **kwargs,
+) -> None:
+    """Run painting, estimating targets done from its disc usage meanwhile."""
+    parameters = np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")
+    N, L_chunk = int(parameters[0]), int(parameters[1])
+    expected = painting_size(output, chunk_index)
+    paint_dir = output / f"chunk_{chunk_index}" / "paint"
+    start = time.perf_counter()
+    finished = threading.Event()
+
+    def report(done: int) -> None:
+        callback(
+            Progress(
+                stage,
+                chunk_index,
+                done,
+                N,
+                L_chunk * done // N,
+                time.perf_counter() - start,
+            )
+        )
+
+    def poll() -> None:
+        while not finished.wait(interval):
+            size = 0
+            for dirpath, _, filenames in os.walk(paint_dir):
+                for filename in filenames:
+                    try:
+                        size += os.stat(os.path.join(dirpath, filename)).st_size
+                    except FileNotFoundError:
+                        pass
+            # the last target is only done when painting returns
+            report(min(N - 1, N * size // expected))
+
+    watcher = threading.Thread(target=poll, daemon=True)
+    watcher.start()
+    try:
+        func(output=output, chunk_index=chunk_index, **kwargs)
+    finally:
+        finished.set()
+        watcher.join()
+    report(N)
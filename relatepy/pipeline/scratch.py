@@ -0,0 +1,107 @@
+import errno
+import logging
+import os
+import shutil
+import time
+from pathlib import Path
+
+import click_log
+import numpy as np
+
+logger = logging.getLogger(__package__)
+click_log.basic_config(logger)
+
+# Temporary files of a chunk, keyed by the last stage reading them.
+CONSUMED_BY = {
+    "build_topology": ("chunk_{c}/paint",),
+    "combine_sections": (
+        "chunk_{c}.hap",
+        "chunk_{c}.dist",
+        "chunk_{c}.rpos",
+        "chunk_{c}.r",
+        "chunk_{c}.state",
+    ),
+}
+POLL_INTERVAL = 10.0  # seconds
+WAIT_TIMEOUT = 3600.0  # seconds
+
+
+def painting_size(output: Path, chunk_index: int) -> int:
+    """Approximate disc usage in bytes of painting a chunk."""
+    parameters = np.fromfile(output / f"parameters_c{chunk_index}.bin", dtype="u4")
+    N, num_windows = int(parameters[0]), int(parameters[2]) - 1
+    return 8 * N**2 * (num_windows + 2)
+
+
+class ScratchSpace:
+    """Directory of temporary files with an optional cap on its size
+
+    Parameters
+    ----------
+    root : Path
+        Working directory of the pipeline.
+    max_size : float | None, optional
+        Cap in GB, by default None, i.e. unlimited.
+    shared : bool, optional
+        Whether other jobs or threads may release files meanwhile (e.g. chunks
+        run with ``--chunk-index`` or on a cluster), by default False, i.e.
+        reserving fails at once if the space is used up.
+    """
+
+    def __init__(
+        self, root: Path, max_size: float | None = None, shared: bool = False
+    ) -> None:
+        self.root = root
+        self.max_size = None if max_size is None else max_size * 1e9
+        self.timeout = WAIT_TIMEOUT if shared else 0.0
+
+    def usage(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                try:
+                    total += os.stat(os.path.join(dirpath, filename)).st_size
+                except FileNotFoundError:  # removed meanwhile
+                    pass
+        return total
+
+    def reserve(self, size: int, timeout: float | None = None) -> None:
+        """Block until ``size`` bytes fit under the cap.
+
+        If the scratch space is shared, other jobs are given up to ``timeout``
+        seconds, by default `WAIT_TIMEOUT`, to release their files.
+        """
+        if self.max_size is None:
+            return
+        if size > self.max_size:
+            raise OSError(
+                errno.ENOSPC,
+                f"Scratch space limit {self.max_size / 1e9}GB is smaller than "
+                f"required {size / 1e9}GB.",
+            )
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        while (usage := self.usage()) + size > self.max_size:
+            if time.monotonic() > deadline:
+                raise OSError(
+                    errno.ENOSPC,
+                    f"Scratch space usage {usage / 1e9}GB leaves no room for "
+                    f"{size / 1e9}GB.",
+                )
+            logger.info(
+                f"Waiting for scratch space: {usage / 1e9}GB used, "
+                f"{size / 1e9}GB required."
+            )
+            time.sleep(POLL_INTERVAL)
+
+    def release(self, stage: str, chunk_index: int) -> list[Path]:
+        """Remove temporary files of a chunk which ``stage`` was the last to read."""
+        removed = []
+        for pattern in CONSUMED_BY.get(stage, ()):
+            path = self.root / pattern.format(c=chunk_index)
+            if path.is_dir():
+                removed.extend(p for p in path.rglob("*") if p.is_file())
+                shutil.rmtree(path)
+            elif path.is_file():
+                removed.append(path)
+                path.unlink()
+        return removed
@@ -0,0 +1,247 @@
+"""Sweeps over the parameters of branch length estimation
+
+Painting, building topology and finding equivalent branches do not depend on
+the mutation rate or coalescence rates. A sweep runs them once per chunk in
+``<output>``, then copies the results without the painting into a working
+directory per point and estimates branch lengths, combines sections and
+finalizes there, in parallel processes. Only the chunk directories are
+copied, the read-only files of the chunks are hard linked where possible.
+
+The topology is built with the effective population size and seed of the
+sweep, the points only set those of branch length estimation.
+"""
+import errno
+import logging
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+
+import click_log
+import pandas as pd
+
+from ..io import CoalescenceRates
+from ..memory import MemoryModel
+from .checkpoint import CHECKPOINT_DIR, Checkpoints
+from .chunk import chunk as chunk_pipeline
+
+logger = logging.getLogger(__package__)
+click_log.basic_config(logger)
+
+TOPOLOGY_STAGES = ("paint", "build_topology", "find_equivalent_branches")
+BRANCH_LENGTH_STAGES = ("get_branch_length", "combine_sections")
+
+
+@dataclass(frozen=True)
+class SweepPoint:
+    """Parameters of branch length estimation written to ``output``
+
+    Parameters
+    ----------
+    output : Path
+        Filename of output without file extension.
+    mutation_rate : float
+        Mutation rate.
+    effective_population_size : float | None, optional
+        Effective population size, by default the one of the sweep.
+    coal : Path | CoalescenceRates | None, optional
+        Coalescence rates, overwrite the effective population size if given.
+    seed : int | None, optional
+        Seed for MCMC in branch lengths estimation, by default the one of the
+        sweep.
+    """
+
+    output: Path
+    mutation_rate: float
+    effective_population_size: float | None = None
+    coal: Path | CoalescenceRates | None = None
+    seed: int | None = None
+
+
+def read_sweep(path: Path) -> list[SweepPoint]:
+    """Read sweep points from a tab separated file with a header
+
+    Columns are ``output`` and ``mutation_rate``, and optionally
+    ``effective_population_size``, ``coal`` and ``seed``. Relative paths are
+    relative to the directory of the file.
+    """
+    table = pd.read_csv(path, sep="\t")
+    points = []
+    for row in table.to_dict("records"):
+        row = {k: v for k, v in row.items() if not pd.isna(v)}
+        points.append(
+            SweepPoint(
+                output=path.parent / row["output"],
+                mutation_rate=float(row["mutation_rate"]),
+                effective_population_size=(
+                    float(row["effective_population_size"])
+                    if "effective_population_size" in row
+                    else None
+                ),
+                coal=path.parent / row["coal"] if "coal" in row else None,
+                seed=int(row["seed"]) if "seed" in row else None,
+            )
+        )
+    return points
+
+
+def run_point(
+    output: Path,
+    point: SweepPoint,
+    num_chunks: int,
+    effective_population_size: float | None,
+    sample_ages: list[float],
+    seed: int | None,
+    annotation: Path | None = None,
+    resume: bool = False,
+    cleanup: bool = False,
+) -> Path:
+    """Estimate branch lengths of a point on a copy of the topology in ``output``."""
+    from . import chunk_stages, finalize
+
+    work = point.output.absolute()
+    checkpoints = Checkpoints(work)
+    if resume and checkpoints.is_done("finalize"):
+        logger.info(f"{point.output} already finalized, skipping.")
+        return point.output
+    if work.exists():
+        if not (resume and checkpoints.is_done("chunk")):
+            raise FileExistsError(
+                errno.EEXIST, "Output of the sweep point already exists", str(work)
+            )
+        # interrupted, estimated again from the topology
+        shutil.rmtree(work)
+    # marks the directory as a point of this sweep before anything is copied
+    checkpoints.mark("chunk")
+
+    def link_or_copy(src: str, dst: str) -> None:
+        # files of the chunk directories are rewritten by branch length
+        # estimation, the files next to them are only read
+        if Path(src).parent != output:
+            shutil.copy2(src, dst)
+            return
+        try:
+            os.link(src, dst)
+        except OSError:  # e.g. on another file system
+            shutil.copy2(src, dst)
+
+    shutil.copytree(
+        output,
+        work,
+        ignore=shutil.ignore_patterns("paint", CHECKPOINT_DIR),
+        copy_function=link_or_copy,
+        dirs_exist_ok=True,
+    )
+    for c in range(num_chunks):
+        stages = chunk_stages(
+            output=work,
+            chunk_index=c,
+            mutation_rate=point.mutation_rate,
+            effective_population_size=(
+                effective_population_size
+                if point.effective_population_size is None
+                else point.effective_population_size
+            ),
+            sample_ages=sample_ages,
+            coal=point.coal,
+            seed=seed if point.seed is None else point.seed,
+        )
+        for stage in BRANCH_LENGTH_STAGES:
+            stages[stage]()
+    with checkpoints.stage("finalize"):
+        finalize(output=work, sample_ages=sample_ages, annotation=annotation)
+    if cleanup:
+        shutil.rmtree(work)
+    return point.output
+
+
+def sweep_pipeline(
+    haps: Path,
+    sample: Path,
+    genetic_map: Path,
+    output: Path,
+    points: list[SweepPoint],
+    effective_population_size: float | None,
+    sample_ages: list[float],
+    dist: Path | None = None,
+    annotation: Path | None = None,
+    use_transitions: bool = True,
+    memory_limit: float = 5,
+    theta: float = 0.001,
+    rho: float = 1,
+    ancestral_state: bool = True,
+    seed: int | None = None,
+    resume: bool = False,
+    memory_model: Path | None = None,
+    engine: str = "rust",
+    jobs: int | None = None,
+    cleanup: bool = False,
+) -> None:
+    from . import chunk_stages, read_parameters
+
+    output = output.absolute()
+    checkpoints = Checkpoints(output)
+    if resume and (output / "parameters.bin").is_file() and checkpoints.chunked(
+        read_parameters(output)[2]
+    ):
+        logger.info("Resuming from existing chunks.")
+    else:
+        with checkpoints.stage("chunk"):
+            chunk_pipeline(
+                haps,
+                sample,
+                genetic_map,
+                output,
+                dist,
+                use_transitions,
+                memory_limit,
+                None if memory_model is None else MemoryModel.load(memory_model),
+                engine=engine,
+            )
+        checkpoints.split_chunks(read_parameters(output)[2])
+    num_chunks = read_parameters(output)[2]
+    for c in range(num_chunks):
+        stages = chunk_stages(
+            output=output,
+            chunk_index=c,
+            mutation_rate=0.0,  # not used by the topology
+            effective_population_size=effective_population_size,
+            sample_ages=sample_ages,
+            theta=theta,
+            rho=rho,
+            ancestral_state=ancestral_state,
+            seed=seed,
+        )
+        pending = checkpoints.pending(c) if resume else TOPOLOGY_STAGES
+        pending = tuple(stage for stage in pending if stage in TOPOLOGY_STAGES)
+        if pending:
+            logger.info(f"Building topology of chunk {c} of {num_chunks - 1}.")
+        for stage in pending:
+            if stage == "paint" and (output / f"chunk_{c}").exists():
+                # painting appends to its files, partial results must not be reused
+                shutil.rmtree(output / f"chunk_{c}")
+            with checkpoints.stage(stage, c):
+                stages[stage]()
+    logger.info(f"Estimating branch lengths of {len(points)} points.")
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(
+                run_point,
+                output,
+                point,
+                num_chunks,
+                effective_population_size,
+                sample_ages,
+                seed,
+                annotation,
+                resume,
+                cleanup,
+            )
+            for point in points
+        ]
+        for future in futures:
+            logger.info(f"Finished {future.result()}.")
+    if cleanup:
+        shutil.rmtree(output)
+    logger.info("Done.")
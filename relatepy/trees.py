@@ -0,0 +1,253 @@
+"""Local trees of Relate's outputs by genomic position"""
+import itertools
+import os
+from collections.abc import Sequence
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from .io import (
+    CoalescenceRates,
+    Mutations,
+    Trees,
+    anc_header,
+    anc_index,
+    read_anc,
+    read_mut,
+    snp_positions,
+    tree_bounds,
+    tree_columns,
+)
+
+CACHE_SIZE = 1024  # decoded trees
+BATCH_SIZE = 1 << 22  # node and group counts per batch of trees
+
+
+class LocalTrees:
+    """Index of the trees of an ``.anc``/``.mut`` pair by position
+
+    Positions are looked up by binary search in the start position of every
+    tree. Trees needed by queries are decoded into node ages once and kept
+    in an LRU cache of ``cache_size`` trees.
+
+    Parameters
+    ----------
+    trees : Trees
+    mutations : Mutations
+    cache_size : int, optional
+        Number of decoded trees kept, by default `CACHE_SIZE`.
+    """
+
+    def __init__(
+        self, trees: Trees, mutations: Mutations, cache_size: int = CACHE_SIZE
+    ) -> None:
+        self.trees = trees
+        self.mutations = mutations
+        self.breakpoints, self._ends = tree_bounds(
+            trees.snp, mutations.snp, mutations.pos
+        )
+        self.decode = lru_cache(maxsize=cache_size)(self._decode)
+
+    @classmethod
+    def read(cls, prefix: os.PathLike, cache: bool = False, **kwargs) -> "LocalTrees":
+        """Read ``<prefix>.anc`` and ``<prefix>.mut``, see `read_anc` for ``cache``."""
+        prefix = os.fspath(prefix)
+        return cls(
+            read_anc(f"{prefix}.anc", cache=cache),
+            read_mut(f"{prefix}.mut", cache=cache),
+            **kwargs,
+        )
+
+    def __len__(self) -> int:
+        return len(self.trees)
+
+    @property
+    def spans(self) -> np.ndarray:
+        """Length in bp of every tree, the last one ends after the last SNP."""
+        return self._ends - self.breakpoints
+
+    def trees_at(self, bp) -> np.ndarray:
+        """Index of the tree at every position, -1 before the first tree."""
+        return np.searchsorted(self.breakpoints, bp, side="right") - 1
+
+    def _decode(self, tree: int) -> tuple[np.ndarray, np.ndarray]:
+        parent = np.asarray(self.trees.parent[tree])
+        branch_length = np.asarray(self.trees.branch_length[tree])
+        age = np.zeros(len(parent))
+        age[: self.trees.num_haplotypes] = self.trees.sample_ages
+        # Relate numbers every parent after its children
+        for node in range(len(parent) - 1):
+            age[parent[node]] = age[node] + branch_length[node]
+        return parent, age
+
+    def ancestors(self, tree: int, node: int) -> list[int]:
+        """Path from ``node`` to the root of a tree, both included."""
+        parent, _ = self.decode(tree)
+        path = [node]
+        while parent[path[-1]] >= 0:
+            path.append(int(parent[path[-1]]))
+        return path
+
+    def tmrca(self, sample_a: int, sample_b: int, bp) -> np.ndarray:
+        """Time to the most recent common ancestor of two haplotypes
+
+        Every distinct tree among the positions is decoded once.
+
+        Parameters
+        ----------
+        sample_a, sample_b : int
+            Indices of haplotypes.
+        bp : array_like
+            Positions.
+
+        Returns
+        -------
+        np.ndarray
+            Age in generations of the most recent common ancestor at every
+            position, NaN before the first tree.
+        """
+        trees, inverse = np.unique(self.trees_at(bp), return_inverse=True)
+        result = np.full(len(trees), np.nan)
+        for i, tree in enumerate(trees):
+            if tree < 0:
+                continue
+            path_a = set(self.ancestors(tree, sample_a))
+            mrca = next(n for n in self.ancestors(tree, sample_b) if n in path_a)
+            result[i] = self.decode(tree)[1][mrca]
+        return result[inverse].reshape(np.shape(bp))
+
+
+def _coalescences(
+    parent: np.ndarray,
+    branch_length: np.ndarray,
+    weights: np.ndarray,
+    sample_ages: np.ndarray,
+    groups: np.ndarray,
+    epochs: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Coalescences and time at risk of pairs of groups in a batch of trees
+
+    Returns arrays of shape (groups, groups, epochs), summed over trees
+    weighted by ``weights``.
+    """
+    num_trees, num_nodes = parent.shape
+    num_haplotypes, num_groups = len(groups), groups.max() + 1
+    trees = np.arange(num_trees)
+    ends = np.append(epochs[1:], np.inf)
+    # haplotypes of every group below a node, nodes come after their children
+    counts = np.zeros((num_trees, num_nodes, num_groups))
+    counts[:, np.arange(num_haplotypes), groups] = 1
+    age = np.zeros((num_trees, num_nodes))
+    age[:, :num_haplotypes] = sample_ages
+    coalescences = np.zeros((num_groups, num_groups, len(epochs)))
+    at_risk = np.zeros_like(coalescences)
+    for node in range(num_nodes - 1):
+        p = parent[:, node]
+        child, sibling = counts[:, node], counts[trees, p]
+        age[trees, p] = age[:, node] + branch_length[:, node]
+        if sibling.any():
+            # ordered pairs between the two subtrees coalesce at the parent
+            pairs = child[:, :, None] * sibling[:, None, :]
+            pairs = (pairs + pairs.transpose(0, 2, 1)) * weights[:, None, None]
+            t = age[trees, p, None]
+            epoch = np.clip(np.searchsorted(epochs, t[:, 0], side="right") - 1, 0, None)
+            coalesced = np.zeros((num_trees, len(epochs)))
+            coalesced[trees, epoch] = 1
+            coalescences += np.einsum("bgh,be->ghe", pairs, coalesced)
+            overlap = np.clip(np.minimum(t, ends) - epochs, 0, None)
+            at_risk += np.einsum("bgh,be->ghe", pairs, overlap)
+        counts[trees, p] += child
+    return coalescences, at_risk
+
+
+def _batch_coalescences(
+    anc: os.PathLike,
+    offset: int,
+    num_trees: int,
+    weights: np.ndarray,
+    sample_ages: np.ndarray,
+    groups: np.ndarray,
+    epochs: np.ndarray,
+) -> tuple[np.ndarray, np.ndarray]:
+    """`_coalescences` of ``num_trees`` trees starting at byte ``offset``."""
+    with open(anc, "rb") as f:
+        f.seek(offset)
+        lines = b"".join(itertools.islice(f, num_trees))
+    columns = tree_columns(lines, len(groups))
+    return _coalescences(
+        columns["parent"],
+        columns["branch_length"],
+        weights,
+        sample_ages,
+        groups,
+        epochs,
+    )
+
+
+def estimate_coal(
+    anc: os.PathLike,
+    mut: os.PathLike,
+    epochs: Sequence[float],
+    groups: Sequence[str] | None = None,
+    jobs: int | None = None,
+) -> CoalescenceRates:
+    """Estimate pairwise coalescence rates per epoch from trees
+
+    The rate of a pair of groups in an epoch is the number of coalescences
+    of pairs of their haplotypes in the epoch over the time these pairs spent
+    uncoalesced in it, both summed over trees weighted by their length in bp.
+    Batches of consecutive trees are read and processed by parallel
+    processes, the calling process only indexes the trees. Time is counted
+    from 0 for ancient samples too.
+
+    Parameters
+    ----------
+    anc, mut : os.PathLike
+        Filenames of Relate's ``.anc`` and ``.mut`` output.
+    epochs : Sequence[float]
+        Start of every epoch in generations, the first one is usually 0.
+    groups : Sequence[str] | None, optional
+        Group of every haplotype, by default all in one group "all".
+    jobs : int | None, optional
+        Number of processes, by default the number of CPUs.
+
+    Returns
+    -------
+    CoalescenceRates
+        Rates of every pair of groups, NaN in epochs without time at risk.
+        Write them with `CoalescenceRates.write`.
+    """
+    with open(anc, "rb") as f:
+        num_haplotypes, sample_ages = anc_header(f)
+    if groups is None:
+        groups = ["all"] * num_haplotypes
+    if len(groups) != num_haplotypes:
+        raise ValueError(f"Got {len(groups)} groups for {num_haplotypes} haplotypes.")
+    names, index = np.unique(np.asarray(groups, dtype=str), return_inverse=True)
+    epochs = np.asarray(epochs, dtype=np.float64)
+    # only the index of trees is held here, workers parse their own trees
+    tree_snp, offsets = anc_index(anc)
+    starts, ends = tree_bounds(tree_snp, *snp_positions(mut))
+    weights = (ends - starts).astype(np.float64)
+    num_nodes = 2 * num_haplotypes - 1
+    batch = max(1, BATCH_SIZE // (num_nodes * len(names)))
+    with ProcessPoolExecutor(jobs) as executor:
+        futures = [
+            executor.submit(
+                _batch_coalescences,
+                anc,
+                offsets[i],
+                len(weights[i : i + batch]),
+                weights[i : i + batch],
+                sample_ages,
+                index,
+                epochs,
+            )
+            for i in range(0, len(weights), batch)
+        ]
+        coalescences = sum(future.result()[0] for future in futures)
+        at_risk = sum(future.result()[1] for future in futures)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = np.where(at_risk > 0, coalescences / at_risk, np.nan)
+    return CoalescenceRates(tuple(names.tolist()), epochs, rates)
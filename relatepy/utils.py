@@ -1,5 +1,9 @@
+import cProfile
+import inspect
 import logging
 import platform
+import threading
+import tracemalloc
 from pathlib import Path
 from contextlib import contextmanager
 from functools import wraps
@@ -11,9 +15,86 @@ import click_log
 
 logger = logging.getLogger(__package__)
 click_log.basic_config(logger)
+# directory of profiles, profiling is disabled if unset
+PROFILE = "RELATEPY_PROFILE"
+# also trace memory allocations while profiling if set
+PROFILE_MEMORY = "RELATEPY_PROFILE_MEMORY"
+TOP_ALLOCATIONS = 25
+_profilers: dict[str, cProfile.Profile] = {}
+# profilers are per thread, memory tracing is process-wide so one thread at a time
+_tracing_owner = threading.Lock()
+_profiling = threading.local()
+
+
+@contextmanager
+def profile(name: str):
+    """Profile the body into ``<name>.pstats`` in the directory of `PROFILE`.
+
+    Repeated bodies of the same name accumulate into one profile, which is
+    written when a body exits. Nested bodies are part of the outermost profile
+    of their thread. Bodies run by other threads meanwhile, e.g. a chunk painted
+    ahead, get their own profile, but memory is traced for one body at a time.
+    """
+    directory = os.getenv(PROFILE)
+    if directory is None or getattr(_profiling, "active", False):
+        yield
+        return
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    profiler = _profilers.setdefault(name, cProfile.Profile())
+    try:
+        profiler.enable()
+    except ValueError:
+        # a profiler of another thread is active where profiling is process-wide
+        logger.warning(f"Another body is being profiled, {name} is not profiled.")
+        yield
+        return
+    _profiling.active = True
+    trace_memory = os.getenv(PROFILE_MEMORY) is not None
+    if trace_memory and not _tracing_owner.acquire(blocking=False):
+        logger.warning(f"Memory of another body is traced, {name} is not traced.")
+        trace_memory = False
+    try:
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+        yield
+    finally:
+        profiler.disable()
+        _profiling.active = False
+        profiler.dump_stats(directory / f"{name}.pstats")
+        if trace_memory:
+            try:
+                _, peak = tracemalloc.get_traced_memory()
+                top = tracemalloc.take_snapshot().compare_to(before, "lineno")
+            finally:
+                _tracing_owner.release()
+            lines = [f"Peak traced memory: {peak / 1e6}Mb."]
+            lines.extend(str(stat) for stat in top[:TOP_ALLOCATIONS])
+            (directory / f"{name}.malloc.txt").write_text("\n".join(lines) + "\n")
+
+
+def profiled(func: Callable) -> Callable:
+    """Profile every call of ``func`` per chunk if it has ``chunk_index``."""
+    signature = inspect.signature(func)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if os.getenv(PROFILE) is None:
+            return func(*args, **kwargs)
+        chunk_index = signature.bind(*args, **kwargs).arguments.get("chunk_index")
+        name = func.__name__
+        with profile(name if chunk_index is None else f"{name}_c{chunk_index}"):
+            return func(*args, **kwargs)
+
+    return wrapper
 
 
 def resource_usage(func: Callable) -> Callable:
+    func = profiled(func)
+
     @wraps(func)
     def wrapper(*args, **kwargs):
         result = func(*args, **kwargs)
@@ -27,6 +108,45 @@ def resource_usage(func: Callable) -> Callable:
     return func if os.getenv("RELATEPY_RESOURCE_USAGE") is None else wrapper
 
 
+def peak_rss() -> int:
+    """Peak resident set size in bytes since start or last `reset_peak_rss`."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return getrusage(RUSAGE_SELF).ru_maxrss * (
+        1 if platform.system() == "Darwin" else 1024
+    )
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size, only supported by Linux."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def prefetch(paths) -> None:
+    """Ask the kernel to read files into the page cache in the background."""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
+
+
 @contextmanager
 def chdir(original_dir, dest_dir):
     try:
@@ -1,21 +1,133 @@
+use numpy::ndarray::{s, ArrayView1, ArrayView2};
+use numpy::{PyReadonlyArray1, PyReadonlyArray2};
+use pyo3::exceptions::PyValueError;
 use pyo3::prelude::*;
-use std::path::PathBuf;
+use std::fs::File;
+use std::io::{self, BufWriter, Write};
+use std::path::{Path, PathBuf};
 use relate::pipelines::{MakeChunks, Paint};
 
-/// Formats the sum of two numbers as string.
+/// Bytes of haplotypes transposed at a time when writing `.hap` files.
+const BLOCK_BYTES: usize = 1 << 20;
+
 #[pyfunction]
-fn make_chunks(haps: PathBuf, sample: PathBuf, map: PathBuf, output: PathBuf, dist: Option<PathBuf>, use_transitions: Option<bool>, memory: Option<f32>) -> PyResult<()> {
+fn make_chunks(py: Python<'_>, haps: PathBuf, sample: PathBuf, map: PathBuf, output: PathBuf, dist: Option<PathBuf>, use_transitions: Option<bool>, memory: Option<f32>) -> PyResult<()> {
     let options = MakeChunks::new(
         haps, sample, map, dist.unwrap_or(PathBuf::from("unspecified")), output, !use_transitions.unwrap_or(true), memory.unwrap_or(5.)
     );
-    Ok(options.execute().unwrap())
+    Ok(py.allow_threads(move || options.execute().unwrap()))
 }
 
 #[pyfunction]
-fn paint(output: PathBuf, chunk_index: usize, theta: f64, rho: f64) -> PyResult<()> {
+fn paint(py: Python<'_>, output: PathBuf, chunk_index: usize, theta: f64, rho: f64) -> PyResult<()> {
     let painting = vec![theta, rho];
     let options = Paint::new(chunk_index, output, painting);
-    Ok(options.execute().unwrap())
+    Ok(py.allow_threads(move || options.execute().unwrap()))
+}
+
+/// Elements of chunk files, written in native byte order like NumPy's `tobytes`.
+trait NeBytes: Copy {
+    fn write_ne<W: Write>(self, out: &mut W) -> io::Result<()>;
+}
+
+macro_rules! impl_ne_bytes {
+    ($($t:ty),*) => {
+        $(impl NeBytes for $t {
+            fn write_ne<W: Write>(self, out: &mut W) -> io::Result<()> {
+                out.write_all(&self.to_ne_bytes())
+            }
+        })*
+    };
+}
+
+impl_ne_bytes!(u32, u64, f64);
+
+/// Write a property of SNPs prefixed by its length, as `DataChunk.dump_properties`.
+fn write_property<T: NeBytes>(path: &Path, values: ArrayView1<T>) -> io::Result<()> {
+    let mut f = BufWriter::new(File::create(path)?);
+    (values.len() as u32).write_ne(&mut f)?;
+    for &value in values.iter() {
+        value.write_ne(&mut f)?;
+    }
+    f.flush()
+}
+
+/// Write haplotypes of shape (N, L_chunk) SNP by SNP as ASCII digits, as `DataChunk.dump`.
+fn write_haplotypes(path: &Path, haplotypes: ArrayView2<u8>) -> io::Result<()> {
+    let (n, l) = haplotypes.dim();
+    let mut f = BufWriter::new(File::create(path)?);
+    (l as u64).write_ne(&mut f)?;
+    (n as u64).write_ne(&mut f)?;
+    let block = (BLOCK_BYTES / n.max(1)).max(1);
+    let mut buffer = vec![0u8; block * n];
+    for start in (0..l).step_by(block) {
+        let end = (start + block).min(l);
+        let view = haplotypes.slice(s![.., start..end]);
+        for (h, haplotype) in view.rows().into_iter().enumerate() {
+            for (snp, &allele) in haplotype.iter().enumerate() {
+                buffer[snp * n + h] = allele.wrapping_add(b'0');
+            }
+        }
+        f.write_all(&buffer[..(end - start) * n])?;
+    }
+    f.flush()
+}
+
+/// Write the chunk files of `HapsFile.dump` from borrowed NumPy arrays.
+///
+/// Nothing is copied on the way in and the GIL is released while writing.
+#[pyfunction]
+#[allow(clippy::too_many_arguments)]
+fn dump_chunks(
+    py: Python<'_>,
+    output: PathBuf,
+    haplotypes: PyReadonlyArray2<u8>,
+    bp: PyReadonlyArray1<u32>,
+    dist: PyReadonlyArray1<u32>,
+    rpos: PyReadonlyArray1<f64>,
+    r: PyReadonlyArray1<f64>,
+    state: PyReadonlyArray1<u32>,
+    section_boundaries: Vec<(usize, usize)>,
+) -> PyResult<()> {
+    let haplotypes = haplotypes.as_array();
+    let (bp, dist, rpos, r, state) = (
+        bp.as_array(),
+        dist.as_array(),
+        rpos.as_array(),
+        r.as_array(),
+        state.as_array(),
+    );
+    let num_snps = haplotypes.ncols();
+    if [bp.len(), dist.len(), r.len(), state.len()].iter().any(|&len| len < num_snps)
+        || rpos.len() < num_snps + 1
+    {
+        return Err(PyValueError::new_err("Properties are shorter than the haplotypes."));
+    }
+    if let Some((start, end)) = section_boundaries
+        .iter()
+        .find(|&&(start, end)| start > end || end > num_snps)
+    {
+        return Err(PyValueError::new_err(format!(
+            "Section ({start}, {end}) is out of {num_snps} SNPs."
+        )));
+    }
+    py.allow_threads(|| -> io::Result<()> {
+        for (c, &(start, end)) in section_boundaries.iter().enumerate() {
+            let stem = output.join(format!("chunk_{c}"));
+            write_property(&stem.with_extension("bp"), bp.slice(s![start..end]))?;
+            write_property(&stem.with_extension("dist"), dist.slice(s![start..end]))?;
+            // positions of both ends of every SNP interval
+            write_property(&stem.with_extension("rpos"), rpos.slice(s![start..end + 1]))?;
+            write_property(&stem.with_extension("r"), r.slice(s![start..end]))?;
+            write_property(&stem.with_extension("state"), state.slice(s![start..end]))?;
+            write_haplotypes(
+                &stem.with_extension("hap"),
+                haplotypes.slice(s![.., start..end]),
+            )?;
+        }
+        Ok(())
+    })?;
+    Ok(())
 }
 
 /// A Python module implemented in Rust.
@@ -23,5 +135,6 @@ fn paint(output: PathBuf, chunk_index: usize, theta: f64, rho: f64) -> PyResult<
 fn relatepy(_py: Python, m: &PyModule) -> PyResult<()> {
     m.add_function(wrap_pyfunction!(make_chunks, m)?)?;
     m.add_function(wrap_pyfunction!(paint, m)?)?;
+    m.add_function(wrap_pyfunction!(dump_chunks, m)?)?;
     Ok(())
-}
\ No newline at end of file
+}
@@ -0,0 +1,46 @@
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+from relatepy.export import export, read_region  # noqa: E402
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_export(tmp_path: Path, format: str):
+    (tmp_path / "example.anc").write_text(
+        "NUM_HAPLOTYPES 3\n"
+        "NUM_TREES 2\n"
+        "0: 3:(2 0 0 1) 3:(2 0 0 1) 4:(5 0 0 3) 4:(3 1 0 1) -1:(0 0 0 3) \n"
+        "2: 3:(1 0 2 3) 4:(4 0 2 3) 3:(1 1 2 3) 4:(3 0 2 3) -1:(0 0 0 3) \n"
+    )
+    (tmp_path / "example.mut").write_text(
+        "snp;pos_of_snp;dist;rs-id;tree_index;branch_indices;is_not_mapping;"
+        "is_flipped;age_begin;age_end;ancestral_allele/alternative_allele;\n"
+        "0;100;100;rs1;0;3;0;0;2;5;A/G;\n"
+        "1;200;100;.;0;2 4;0;0;0;5;A/G;\n"
+        "2;300;100;.;1;2;0;0;0;1;C/T;\n"
+        "3;400;1;.;1;1;0;0;0;4;A/G;\n"
+    )
+    output = tmp_path / "dataset"
+    for chromosome in ["1", "2"]:
+        export(tmp_path / "example", output, format, chromosome, rows_per_file=3)
+    assert len(list((output / "mutations" / "chromosome=1").iterdir())) == 2
+    assert len(list((output / "trees" / "chromosome=1").iterdir())) == 2
+
+    mutations = read_region(output, "mutations", "2", 150, 301, format).to_pydict()
+    assert mutations["pos"] == [200, 300]
+    assert mutations["branches"] == [[2, 4], [2]]
+    assert mutations["ancestral"] == ["A", "C"]
+    assert mutations["chromosome"] == ["2", "2"]
+
+    trees = read_region(output, "trees", "1", 350, 360, format).to_pydict()
+    assert trees["tree"] == [1] * 5
+    assert trees["node"] == [0, 1, 2, 3, 4]
+    assert trees["parent"] == [3, 4, 3, 4, -1]
+    assert trees["branch_length"] == [1, 4, 1, 3, 0]
+    assert (trees["start"][0], trees["end"][0]) == (300, 401)
+    trees = read_region(output, "trees", "1", 299, 300, format).to_pydict()
+    assert (trees["start"][0], trees["end"][0]) == (100, 300)
+    assert len(read_region(output, "trees", "1", 0, 1000, format)) == 10
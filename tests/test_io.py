@@ -1,7 +1,26 @@
+import gzip
 from pathlib import Path
-from relatepy.io import read_haps
+from relatepy.io import (
+    HapsFile,
+    encode_alleles,
+    is_paired,
+    pair,
+    read_coal,
+    read_coal_rates,
+    read_anc,
+    read_haps,
+    read_mut,
+    read_sample,
+    read_vcf,
+    scan_haps,
+)
+from relatepy.utils import PROFILE, PROFILE_MEMORY, profile
+from concurrent.futures import ThreadPoolExecutor
 from struct import calcsize, unpack
+import pstats
+import pytest
 import numpy as np
+import pandas as pd
 
 
 def test_haps(haps_path, sample_path, genetic_map_path, tmp_path: Path):
@@ -63,3 +82,261 @@ def test_haps(haps_path, sample_path, genetic_map_path, tmp_path: Path):
     assert parameters_c0_bin.exists()
     parameters = np.fromfile(parameters_c0_bin, dtype=np.uint32)
     assert parameters[0] == data.N and parameters[1] == data.L
+
+
+def test_data_chunk(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path)
+    (chunk,) = data.chunks
+    assert not hasattr(chunk, "__dict__")
+    for prop in ("bp", "dist", "rpos", "r", "state"):
+        assert isinstance(getattr(chunk, prop), np.ndarray)
+    assert len(chunk.rpos) == chunk.size + 1 == data.L + 1
+    assert (chunk.r == data.r).all() and (chunk.dist == data.dist).all()
+
+
+def test_alleles():
+    codes = encode_alleles(["A", "C", "G", "T", "AT", "N"])
+    assert codes.dtype == np.uint8 and list(codes) == [0, 1, 2, 3, 4, 4]
+    assert [pair(a) for a in "ACGT"] == list("GTAC")
+    assert list(pair(codes)) == [2, 3, 0, 1, 4, 4]
+    assert is_paired("T", "C") and not is_paired("T", "A")
+    assert list(is_paired(codes, encode_alleles(list("GTACAN")))) == [True] * 4 + [
+        False
+    ] * 2
+
+
+def test_transversion_state(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path, use_transitions=False)
+    (chunk,) = data.chunks
+    var = data.data.var
+    expected = [
+        (a, b) not in {("A", "G"), ("G", "A"), ("C", "T"), ("T", "C")}
+        for a, b in zip(var["ancestral"], var["alternative"])
+    ]
+    assert chunk.state.dtype == np.uint32 and (chunk.state == expected).all()
+
+
+def test_sample_ids(tmp_path: Path):
+    sample = tmp_path / "example.sample"
+    sample.write_text(
+        "ID_1 ID_2 missing\n0 0 0\nA A 0\nB C 0\nA D 0\nE E 0\n"
+    )
+    ids = read_sample(sample).ids
+    assert isinstance(ids, np.ndarray)
+    assert list(ids) == ["A", "A(1)", "B", "C", "A(1)", "D", "E", "E(1)"]
+
+
+def test_haps_pushdown(haps_path, sample_path):
+    data = read_haps(haps_path, sample_path)
+    bp = data.data.var["bp_pos"].to_numpy()
+    start, end = bp[len(bp) // 3], bp[len(bp) // 2]
+    individuals = read_sample(sample_path)._data.iloc[[0, 2], 0].tolist()
+    subset = read_haps(haps_path, sample_path, region=(start, end), samples=individuals)
+    in_region = (bp >= start) & (bp <= end)
+    assert subset.N == 4 and subset.L == in_region.sum()
+    assert (subset.data.X == data.data.X[[0, 1, 4, 5]][:, in_region]).all()
+    for column in ("CHR", "ID", "bp_pos", "ancestral", "alternative"):
+        assert (
+            subset.data.var[column].to_numpy()
+            == data.data.var[column].to_numpy()[in_region]
+        ).all()
+
+
+def test_scan_haps_invalid(tmp_path: Path):
+    haps = tmp_path / "example.haps"
+    for genotypes in ("0 1 . 1", "0 1 1 0 1", "0 1 2 0"):
+        haps.write_text(f"1 rs1 10 A G 0 1 1 0\n1 rs2 20 A G {genotypes}\n")
+        with pytest.raises(ValueError, match="SNP rs2"):
+            scan_haps(haps, 4)
+    haps.write_text("1 rs1 10 A G 0 1 1 0\n1 rs2 20 A G 1  0 0 1\n")
+    assert scan_haps(haps, 4)[1].tolist() == [[0, 1], [1, 0], [1, 0], [0, 1]]
+
+
+def test_coal_rates(tmp_path: Path):
+    coal = tmp_path / "example.coal"
+    coal.write_text(
+        "pop1 pop2 \n0 1000 5000 \n"
+        "0 0 0.001 0.002 0.003 \n0 1 1e-4 2e-4 3e-4 \n1 1 0.003 0.004 0.005 \n"
+    )
+    rates = read_coal_rates(coal)
+    assert rates.groups == ("pop1", "pop2") and rates.rates.shape == (2, 2, 3)
+    assert np.isnan(rates.rates[1, 0]).all()
+    table = read_coal(coal)
+    pop1_pop2 = table[(table["group1"] == "pop1") & (table["group2"] == "pop2")]
+    assert (rates.rates[0, 1] == pop1_pop2["haploid.coalescence.rate"]).all()
+    rates.write(tmp_path / "copy.coal")
+    copy = read_coal_rates(tmp_path / "copy.coal")
+    assert np.array_equal(copy.rates, rates.rates, equal_nan=True)
+    assert copy.digest == rates.digest
+
+
+def test_vcf(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    X = data.data.X
+    samples = [f"S{i}" for i in range(data.N // 2)]
+    vcf = tmp_path / "example.vcf.gz"
+    with gzip.open(vcf, "wt") as f:
+        f.write("##fileformat=VCFv4.2\n")
+        f.write(
+            "#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+            + "\t".join(samples)
+            + "\n"
+        )
+        # not a SNP, skipped
+        f.write("1\t1\tindel\tAT\tA\t.\t.\t.\tGT" + "\t0|1" * len(samples) + "\n")
+        for i, (chromosome, snp_id, bp, ref, alt) in enumerate(
+            data.data.var[
+                ["CHR", "ID", "bp_pos", "ancestral", "alternative"]
+            ].itertuples(index=False)
+        ):
+            genotypes = "\t".join(
+                f"{X[2 * j, i]}|{X[2 * j + 1, i]}:30" for j in range(len(samples))
+            )
+            f.write(
+                f"{chromosome:.0f}\t{bp}\t{snp_id}\t{ref}\t{alt}\t.\tPASS\t.\t"
+                f"GT:GQ\t{genotypes}\n"
+            )
+    expected, actual = tmp_path / "haps", tmp_path / "vcf"
+    expected.mkdir()
+    actual.mkdir()
+    data.make_chunks(expected, genetic_map_path, min_memory=0.001)
+    vcf_data = read_vcf(vcf)
+    assert vcf_data.N == data.N and vcf_data.L == data.L
+    vcf_data.make_chunks(actual, genetic_map_path, min_memory=0.001)
+    for path in expected.iterdir():
+        assert (actual / path.name).read_bytes() == path.read_bytes(), path.name
+
+
+def test_backed(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    data.save(tmp_path / "example.h5ad")
+    assert "rpos" not in data.data.uns
+    backed = HapsFile.open(tmp_path / "example.h5ad")
+    assert not isinstance(backed.data.X, np.ndarray)
+    assert backed.N == data.N and backed.L == data.L
+    assert (backed.data.var == data.data.var).all(axis=None)
+    assert (backed.derived_counts() == data.derived_counts()).all()
+    expected, actual = tmp_path / "memory", tmp_path / "backed"
+    expected.mkdir()
+    actual.mkdir()
+    data.make_chunks(expected, genetic_map_path)
+    backed.make_chunks(actual, genetic_map_path)
+    for path in expected.iterdir():
+        assert (actual / path.name).read_bytes() == path.read_bytes(), path.name
+
+
+def test_dump_chunks(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path, use_transitions=False)
+    # overlapping sections of uneven sizes
+    L = data.L
+    data.section_boundaries = ((0, L // 3), (L // 4, 2 * L // 3 + 7), (L // 2, L))
+    data.__dict__.pop("chunks", None)
+    (tmp_path / "rust").mkdir()
+    (tmp_path / "python").mkdir()
+    data.dump(tmp_path / "rust")
+    for chunk in data.chunks:
+        chunk.dump(tmp_path / "python")
+    written = sorted((tmp_path / "python").iterdir())
+    assert len(written) == 3 * 6 and not data.state.all()
+    for path in written:
+        assert (tmp_path / "rust" / path.name).read_bytes() == path.read_bytes()
+
+
+def test_profile(haps_path, sample_path, genetic_map_path, tmp_path: Path, monkeypatch):
+    profile_dir = tmp_path / "profile"
+    monkeypatch.setenv(PROFILE, str(profile_dir))
+    monkeypatch.setenv(PROFILE_MEMORY, "1")
+    read_haps(haps_path, sample_path).make_chunks(tmp_path, genetic_map_path)
+    stats = pstats.Stats(str(profile_dir / "make_chunks.pstats"))
+    assert any(name == "make_chunks" for _, _, name in stats.stats)
+    report = (profile_dir / "make_chunks.malloc.txt").read_text()
+    assert report.startswith("Peak traced memory")
+
+
+def test_profile_threads(tmp_path: Path, monkeypatch):
+    monkeypatch.setenv(PROFILE, str(tmp_path))
+    monkeypatch.setenv(PROFILE_MEMORY, "1")
+
+    def other():
+        with profile("other"):
+            pass
+
+    with profile("owner"), ThreadPoolExecutor(1) as executor:
+        executor.submit(other).result()
+    assert (tmp_path / "owner.pstats").is_file()
+    assert (tmp_path / "owner.malloc.txt").is_file()
+    # profiled in its own thread, memory is only traced for one body at a time
+    assert (tmp_path / "other.pstats").is_file()
+    assert not (tmp_path / "other.malloc.txt").exists()
+
+
+def test_anc_mut(tmp_path: Path):
+    anc, mut = tmp_path / "example.anc", tmp_path / "example.mut"
+    anc.write_text(
+        "NUM_HAPLOTYPES 2\n"
+        "NUM_TREES 2\n"
+        "0: 2:(10.5 1 0 4) 2:(10.5 0 0 9) -1:(0 0 0 9) \n"
+        "5: 2:(3.25 0 5 9) 2:(3.25 2 5 9) -1:(0 0 0 9) \n"
+    )
+    mut.write_text(
+        "snp;pos_of_snp;dist;rs-id;tree_index;branch_indices;is_not_mapping;"
+        "is_flipped;age_begin;age_end;ancestral_allele/alternative_allele;\n"
+        "0;100;50;rs1;0;0;0;0;0;10.5;A/G;\n"
+        "5;600;1;.;1;0 1;1;0;0;3.25;C/T;\n"
+    )
+    for cache in (False, True, True):
+        trees = read_anc(anc, cache=cache)
+        mutations = read_mut(mut, cache=cache)
+        assert trees.num_haplotypes == 2 and len(trees) == 2
+        assert trees.parent.tolist() == [[2, 2, -1], [2, 2, -1]]
+        assert trees.branch_length[1].tolist() == [3.25, 3.25, 0]
+        assert trees.snp_end[0].tolist() == [4, 9, 9]
+        assert trees.tree_index([0, 4, 5, 9]).tolist() == [0, 0, 1, 1]
+        assert mutations.pos.tolist() == [100, 600]
+        assert mutations.branches_of(1).tolist() == [0, 1]
+        assert mutations.is_not_mapping.tolist() == [False, True]
+        assert mutations.alternative.tolist() == [b"G", b"T"]
+        assert mutations.tree_at([50, 100, 599, 600, 10_000]).tolist() == [
+            -1,
+            0,
+            0,
+            1,
+            1,
+        ]
+    # the second read is memory-mapped from the cache
+    assert isinstance(trees.parent, np.memmap)
+    # a stale cache is rewritten
+    mut.write_text(mut.read_text().replace("rs1", "rs2"))
+    assert read_mut(mut, cache=True).rs_id[0] == b"rs2"
+    assert read_mut(mut, cache=True).rs_id[0] == b"rs2"
+
+
+def test_rechunk(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = read_haps(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path, min_memory=0.001)
+    haps = sorted(tmp_path.glob("chunk_*.hap"))
+    written = {path: path.stat().st_mtime_ns for path in haps}
+    rpos = (tmp_path / "chunk_0.rpos").read_bytes()
+
+    genetic_map = pd.read_csv(genetic_map_path, sep=r"\s+")
+    genetic_map.iloc[:, 2] *= 2
+    genetic_map.to_csv(tmp_path / "map.txt", sep=" ", index=False)
+    dist = pd.DataFrame(dict(bp=data.data.var["bp_pos"], dist=data.dist * 2))
+    dist.to_csv(tmp_path / "example.dist", sep=" ", index=False)
+    read_haps(haps_path, sample_path).make_chunks(
+        tmp_path, tmp_path / "map.txt", tmp_path / "example.dist", min_memory=0.001
+    )
+    assert {path: path.stat().st_mtime_ns for path in haps} == written
+    assert (tmp_path / "chunk_0.rpos").read_bytes() != rpos
+    dist = np.fromfile(tmp_path / "chunk_0.dist", dtype="u4")[1:]
+    assert (dist == data.dist[: len(dist)] * 2).all()
+
+    # incomplete chunks are written again
+    size = haps[0].stat().st_size
+    with haps[0].open("r+b") as f:
+        f.truncate(size - 1)
+    data.make_chunks(tmp_path, genetic_map_path, min_memory=0.001)
+    assert haps[0].stat().st_size == size
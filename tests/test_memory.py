@@ -0,0 +1,32 @@
+import numpy as np
+
+from relatepy.memory import MemoryModel
+
+
+def test_memory_model_fit():
+    truth = MemoryModel(1e8, 16.0, 40.0, 10.0, 2.0)
+    rng = np.random.default_rng(0)
+    records = [
+        dict(N=N, window_snps=snps, window_derived=derived, peak_rss=peak)
+        for N, snps, derived in zip(
+            rng.integers(8, 10000, 50),
+            rng.integers(100, 50000, 50),
+            rng.integers(1000, 10**7, 50),
+        )
+        for peak in [truth.predict(N, snps, derived)]
+    ]
+    fitted = MemoryModel.fit(records)
+    assert np.allclose(
+        fitted.predict(2000, 10000, 10**6), truth.predict(2000, 10000, 10**6)
+    )
+
+
+def test_equivalent_memory_limit():
+    default = MemoryModel()
+    assert np.isclose(default.equivalent_memory_limit(1000, 5.0), 5.0)
+    # derived alleles cost twice as much as assumed, so allow half the windows
+    model = MemoryModel(per_derived=8.0)
+    assert np.isclose(
+        model.window_budget(1000, 5.0) / 8.0,
+        default.window_budget(1000, model.equivalent_memory_limit(1000, 5.0)) / 4.0,
+    )
@@ -3,10 +3,23 @@ from tempfile import TemporaryDirectory
 import struct
 
 import numpy as np
+import pytest
 
 from relatepy import all_pipeline
-from relatepy.pipeline.paint import paint
-from relatepy.io import HapsFile
+from relatepy.pipeline import chunk_stages, finalize
+from relatepy.pipeline.checkpoint import STAGES, Checkpoints, chunk_of
+from relatepy.pipeline.chunk import chunk
+from relatepy.pipeline.incremental import IncrementalFinalizer
+from relatepy.pipeline.progress import watch_painting, whole_stage
+from relatepy.pipeline.sweep import SweepPoint, read_sweep, sweep_pipeline
+from relatepy.pipeline.scratch import ScratchSpace
+from relatepy.pipeline.paint import (
+    FastPainting,
+    PaintingContainer,
+    SparsePainting,
+    paint,
+)
+from relatepy.io import WINDOWS_PER_SECTION, HapsFile
 
 
 def test_relate(haps_path, sample_path, genetic_map_path, sample_ages_path):
@@ -23,6 +36,120 @@ def test_relate(haps_path, sample_path, genetic_map_path, sample_ages_path):
         )
 
 
+def test_resume_unchecked(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    # e.g. the output of a run made before checkpoints
+    (tmp_path / "example" / "chunk_0").mkdir(parents=True)
+    with pytest.raises(FileExistsError):
+        all_pipeline(
+            haps=haps_path,
+            sample=sample_path,
+            genetic_map=genetic_map_path,
+            output=tmp_path / "example",
+            mutation_rate=1.25e-8,
+            effective_population_size=30000,
+            sample_ages=[],
+            resume=True,
+        )
+    assert (tmp_path / "example" / "chunk_0").is_dir()
+
+
+def test_sweep(
+    haps_path, sample_path, genetic_map_path, sample_ages_path, tmp_path: Path
+):
+    sweep_pipeline(
+        haps_path,
+        sample_path,
+        genetic_map_path,
+        tmp_path / "topology",
+        [
+            SweepPoint(tmp_path / "low", 1e-8),
+            SweepPoint(tmp_path / "high", 2e-8, seed=2),
+        ],
+        effective_population_size=30000,
+        sample_ages=sample_ages_path,
+        seed=1,
+        jobs=2,
+    )
+    for name in ("low", "high"):
+        assert (tmp_path / f"{name}.anc").is_file()
+        assert not (tmp_path / name / "chunk_0" / "paint").exists()
+
+
+def test_read_sweep(tmp_path: Path):
+    (tmp_path / "sweep.tsv").write_text(
+        "output\tmutation_rate\tseed\tcoal\n"
+        "low\t1.25e-8\t\t\n"
+        "high\t2.5e-8\t3\tpopsize.coal\n"
+    )
+    assert read_sweep(tmp_path / "sweep.tsv") == [
+        SweepPoint(tmp_path / "low", 1.25e-8),
+        SweepPoint(tmp_path / "high", 2.5e-8, coal=tmp_path / "popsize.coal", seed=3),
+    ]
+
+
+def test_relate_distributed(
+    haps_path, sample_path, genetic_map_path, sample_ages_path, tmp_path: Path
+):
+    distributed = pytest.importorskip("distributed")
+    with distributed.LocalCluster(
+        n_workers=2, threads_per_worker=1, resources={"MEMORY": 5}
+    ) as cluster, distributed.Client(cluster) as client:
+        all_pipeline(
+            haps=haps_path,
+            sample=sample_path,
+            genetic_map=genetic_map_path,
+            output=tmp_path / "example",
+            mutation_rate=1.25e-8,
+            effective_population_size=30000,
+            sample_ages=sample_ages_path,
+            seed=1,
+            client=client,
+        )
+    assert (tmp_path / "example.anc").is_file()
+    assert (tmp_path / "example.mut").is_file()
+
+
+def test_cluster_memory():
+    distributed = pytest.importorskip("distributed")
+    from relatepy.pipeline.cluster import check_memory
+
+    with distributed.LocalCluster(
+        n_workers=1, processes=False, resources={"MEMORY": 5}
+    ) as cluster, distributed.Client(cluster) as client:
+        check_memory(client, 5)
+        with pytest.raises(ValueError, match="at most MEMORY=5"):
+            check_memory(client, 8)
+    with distributed.LocalCluster(
+        n_workers=1, processes=False
+    ) as cluster, distributed.Client(cluster) as client:
+        with pytest.raises(ValueError, match="advertises the MEMORY"):
+            check_memory(client, 5)
+
+
+def test_chunk_engines(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    for engine in ("rust", "python"):
+        chunk(
+            haps_path,
+            sample_path,
+            genetic_map_path,
+            tmp_path / engine,
+            memory_limit=0.01,
+            engine=engine,
+        )
+    patterns = ("parameters*.bin", "chunk_*")
+    names = {
+        engine: sorted(
+            p.name for pattern in patterns for p in (tmp_path / engine).glob(pattern)
+        )
+        for engine in ("rust", "python")
+    }
+    assert len(names["rust"]) > 2 and names["rust"] == names["python"]
+    for name in names["rust"]:
+        assert (tmp_path / "python" / name).read_bytes() == (
+            tmp_path / "rust" / name
+        ).read_bytes(), name
+
+
 def test_paint(haps_path, sample_path, genetic_map_path, paint_bin, tmp_path: Path):
     (output_path := tmp_path / "output").mkdir()
     data = HapsFile(haps_path, sample_path)
@@ -50,3 +177,246 @@ def test_paint(haps_path, sample_path, genetic_map_path, paint_bin, tmp_path: Pa
     beta = struct.unpack(fmt, content[offset:offset+size])
     assert (np.array(beta) == 1).all()
     assert paint_bin == content
+
+
+def test_sparse_painting(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    data = HapsFile(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path)
+    for painting in (FastPainting, SparsePainting):
+        (tmp_path / painting.__name__).mkdir()
+        painter = painting(data.N)
+        for k in (0, 1):
+            painter.paint_stepping_stones(data, 0, k, tmp_path / painting.__name__)
+    for path in (tmp_path / "FastPainting").iterdir():
+        # records are made of 4 byte fields
+        expected = np.frombuffer(path.read_bytes(), dtype=np.float32)
+        actual = np.fromfile(tmp_path / "SparsePainting" / path.name, dtype=np.float32)
+        np.testing.assert_allclose(actual, expected, rtol=1e-5)
+
+
+def test_painting_container(
+    haps_path, sample_path, genetic_map_path, tmp_path: Path
+):
+    data = HapsFile(haps_path, sample_path)
+    data.make_chunks(tmp_path, genetic_map_path, windows_per_section=None)
+    for container in (False, True):
+        (paint_dir := tmp_path / f"container_{container}").mkdir()
+        painter = FastPainting(data.N, container=container)
+        for k in (0, 1):
+            painter.paint_stepping_stones(data, 0, k, paint_dir)
+    container = PaintingContainer(tmp_path / "container_True")
+    num_windows = len(data.window_boundaries[0]) - 1
+    assert list(container.index["target"]) == [0] * num_windows + [1] * num_windows
+    (tmp_path / "exploded").mkdir()
+    for path in container.explode(tmp_path / "exploded"):
+        expected = tmp_path / "container_False" / path.name
+        assert path.read_bytes() == expected.read_bytes()
+    last = (tmp_path / "container_False" / "relate_0.bin").read_bytes()
+    assert last.endswith(container.read(0, 1))
+
+
+def test_container_pipeline(haps_path, sample_path, genetic_map_path, tmp_path: Path):
+    # chunks without a window cap are only painted through the API
+    (output := tmp_path / "example").mkdir()
+    data = HapsFile(haps_path, sample_path)
+    data.make_chunks(output, genetic_map_path, windows_per_section=None)
+    painter = FastPainting(data.N, container=True)
+    num_chunks = len(data.section_boundaries)
+    for c in range(num_chunks):
+        (paint_dir := output / f"chunk_{c}" / "paint").mkdir(parents=True)
+        for k in range(data.N):
+            painter.paint_stepping_stones(data, c, k, paint_dir)
+        paths = PaintingContainer(paint_dir).explode()
+        assert len(paths) == len(data.window_boundaries[c]) - 1
+        stages = chunk_stages(
+            output=output,
+            chunk_index=c,
+            mutation_rate=1.25e-8,
+            effective_population_size=30000,
+            sample_ages=None,
+            seed=1,
+        )
+        for stage in STAGES[2:-1]:
+            stages[stage]()
+    finalize(output=output)
+    assert (tmp_path / "example.anc").is_file()
+
+
+def test_paint_uncapped(tmp_path: Path):
+    (tmp_path / "parameters_c0.bin").write_bytes(
+        np.array([4, 1000, WINDOWS_PER_SECTION + 2], dtype="u4").tobytes()
+    )
+    with pytest.raises(ValueError, match="at most"):
+        paint(tmp_path, 0)
+
+
+def test_checkpoints(tmp_path: Path):
+    output = tmp_path / "example"
+    checkpoints = Checkpoints(output)
+    with checkpoints.stage("chunk"):
+        output.mkdir()
+        (output / "parameters.bin").write_bytes(b"\0" * 16)
+        (output / "chunk_0.hap").write_bytes(b"01")
+        (output / "chunk_1.hap").write_bytes(b"10")
+    checkpoints.split_chunks(2)
+    assert checkpoints.chunked(2)
+    assert checkpoints.pending(0) == STAGES[1:]
+    with checkpoints.stage("paint", 0):
+        (output / "chunk_0" / "paint").mkdir(parents=True)
+        (output / "chunk_0" / "paint" / "relate_0.bin").write_bytes(b"\0")
+    assert checkpoints.pending(0) == STAGES[2:]
+    # truncated painting is not trusted
+    (output / "chunk_0" / "paint" / "relate_0.bin").write_bytes(b"")
+    assert checkpoints.pending(0) == STAGES[1:]
+    (output / "chunk_1.hap").unlink()
+    assert not checkpoints.chunked(2)
+
+
+def test_concurrent_checkpoints(tmp_path: Path):
+    output = tmp_path / "example"
+    checkpoints = Checkpoints(output)
+    assert chunk_of("example/chunk_1/paint/relate_0.bin") == 1
+    assert chunk_of("example/parameters_c2.bin") == 2
+    assert chunk_of("example/parameters.bin") is None
+    # painting of chunk 1 ahead must not end up in the markers of chunk 0
+    with checkpoints.stage("build_topology", 0):
+        (output / "chunk_0").mkdir(parents=True)
+        (output / "chunk_0" / "example_c0.anc").write_bytes(b"\0")
+        (output / "chunk_1" / "paint").mkdir(parents=True)
+        (output / "chunk_1" / "paint" / "relate_0.bin").write_bytes(b"\0")
+    (output / "chunk_1" / "paint" / "relate_0.bin").unlink()
+    assert checkpoints.is_done("build_topology", 0)
+    assert not list(checkpoints.root.glob(".*.tmp"))
+
+
+def test_progress(tmp_path: Path):
+    # 4 haplotypes, 100 SNPs in 5 windows
+    np.array([4, 100, 6, 0, 20, 40, 60, 80, 100], dtype="u4").tofile(
+        tmp_path / "parameters_c0.bin"
+    )
+    calls, reports = [], []
+
+    def stage(*, output, chunk_index, first_section, last_section, seed):
+        calls.append((first_section, last_section))
+
+    whole_stage(
+        stage,
+        "build_topology",
+        reports.append,
+        output=tmp_path,
+        chunk_index=0,
+        first_section=1,
+        last_section=4,
+        seed=1,
+    )
+    # called once, as without progress
+    assert calls == [(1, 4)]
+    assert [(r.done, r.total, r.snps) for r in reports] == [(0, 1, 0), (1, 1, 100)]
+
+    def paint(*, output, chunk_index, theta):
+        (output / "chunk_0" / "paint").mkdir(parents=True)
+
+    reports.clear()
+    watch_painting(
+        paint, "paint", reports.append, output=tmp_path, chunk_index=0, theta=0.1
+    )
+    (last,) = reports
+    assert (last.done, last.total, last.snps, last.fraction) == (4, 4, 100, 1.0)
+    assert last.remaining == 0
+
+
+def test_incremental_finalizer(tmp_path: Path):
+    output = tmp_path / "example"
+    output.mkdir()
+    bps = [np.arange(100, 110, dtype="u4"), np.arange(105, 120, dtype="u4")]
+    trees = [[0, 6], [0, 3, 7]]
+    for c, (bp, starts) in enumerate(zip(bps, trees)):
+        (output / f"chunk_{c}.bp").write_bytes(
+            np.uint32(len(bp)).tobytes() + bp.tobytes()
+        )
+        (output / f"chunk_{c}.anc").write_text(
+            "NUM_HAPLOTYPES 2\n"
+            f"NUM_TREES {len(starts)}\n"
+            + "".join(
+                f"{s}: 2:(1.0 0 {s} {s}) 2:(1.0 0 {s} {s}) -1:(0 0 0 0)\n"
+                for s in starts
+            )
+        )
+        (output / f"chunk_{c}.mut").write_text(
+            "snp;pos_of_snp;dist;rs-id;tree_index;branch_indices;is_not_mapping;"
+            "is_flipped;age_begin;age_end;ancestral_allele/alternative_allele;\n"
+            + "".join(
+                f"{i};{pos};1;rs{pos};{tree};0;0;0;0;1;A/G;\n"
+                for i, pos in enumerate(bp)
+                for tree in [sum(s <= i for s in starts) - 1]
+            )
+        )
+        (output / f"chunk_{c}").mkdir()
+    finalizer = IncrementalFinalizer(output, 2)
+    finalizer.append(0)
+    # interrupted after appending, the chunk is appended once on resume
+    finalizer = IncrementalFinalizer(output, 2, resume=True)
+    finalizer.append(0)
+    for c in range(2):
+        finalizer.append(c)
+        removed = finalizer.remove(c)
+        assert not (output / f"chunk_{c}").exists() and not any(
+            p.exists() for p in removed
+        )
+    finalizer.close()
+    IncrementalFinalizer(output, 2, resume=True).close()
+    anc = (tmp_path / "example.anc").read_text().splitlines()
+    assert anc[0] == "NUM_HAPLOTYPES 2" and anc[1].split() == ["NUM_TREES", "4"]
+    assert [int(line.split(":")[0]) for line in anc[2:]] == [0, 6, 10, 12]
+    assert anc[4].startswith("10: 2:(1.0 0 8 8)")
+    mut = (tmp_path / "example.mut").read_text().splitlines()
+    mut = [line.split(";") for line in mut[1:]]
+    assert [int(row[0]) for row in mut] == list(range(20))
+    assert [int(row[1]) for row in mut] == list(range(100, 120))
+    assert [int(row[4]) for row in mut] == [0] * 6 + [1] * 4 + [2] * 2 + [3] * 8
+
+
+def test_incremental_finalize(
+    haps_path, sample_path, genetic_map_path, sample_ages_path, tmp_path: Path
+):
+    for name, incremental_finalize in (("example", False), ("incremental", True)):
+        all_pipeline(
+            haps=haps_path,
+            sample=sample_path,
+            genetic_map=genetic_map_path,
+            output=tmp_path / name,
+            mutation_rate=1.25e-8,
+            effective_population_size=30000,
+            sample_ages=sample_ages_path,
+            seed=1,
+            incremental_finalize=incremental_finalize,
+        )
+    assert (tmp_path / "incremental.mut").read_bytes() == (
+        tmp_path / "example.mut"
+    ).read_bytes()
+    # the number of trees is padded to the width reserved for it
+    expected = (tmp_path / "example.anc").read_text().splitlines()
+    actual = (tmp_path / "incremental.anc").read_text().splitlines()
+    assert actual[1].split() == expected[1].split()
+    assert actual[:1] + actual[2:] == expected[:1] + expected[2:]
+
+
+def test_scratch_space(tmp_path: Path):
+    scratch = ScratchSpace(tmp_path, max_size=1e-6)
+    (tmp_path / "chunk_0" / "paint").mkdir(parents=True)
+    (tmp_path / "chunk_0" / "paint" / "relate_0.bin").write_bytes(b"\0" * 600)
+    (tmp_path / "chunk_0.hap").write_bytes(b"\0" * 100)
+    assert scratch.usage() == 700
+    with pytest.raises(OSError):
+        scratch.reserve(2000)
+    # nothing else can release files, fail at once
+    with pytest.raises(OSError):
+        scratch.reserve(500)
+    with pytest.raises(OSError):
+        ScratchSpace(tmp_path, max_size=1e-6, shared=True).reserve(500, timeout=0)
+    assert scratch.release("paint", 0) == []
+    assert scratch.release("build_topology", 0) == [
+        tmp_path / "chunk_0" / "paint" / "relate_0.bin"
+    ]
+    assert (tmp_path / "chunk_0").is_dir() and scratch.usage() == 100
+    scratch.reserve(500)
@@ -0,0 +1,61 @@
+from pathlib import Path
+
+import numpy as np
+
+from relatepy.io import read_coal_rates
+from relatepy.trees import LocalTrees, estimate_coal
+
+
+def write_example(tmp_path: Path):
+    (tmp_path / "example.anc").write_text(
+        "NUM_HAPLOTYPES 3\n"
+        "NUM_TREES 2\n"
+        "0: 3:(2 0 0 1) 3:(2 0 0 1) 4:(5 0 0 3) 4:(3 1 0 1) -1:(0 0 0 3) \n"
+        "2: 3:(1 0 2 3) 4:(4 0 2 3) 3:(1 1 2 3) 4:(3 0 2 3) -1:(0 0 0 3) \n"
+    )
+    (tmp_path / "example.mut").write_text(
+        "snp;pos_of_snp;dist;rs-id;tree_index;branch_indices;is_not_mapping;"
+        "is_flipped;age_begin;age_end;ancestral_allele/alternative_allele;\n"
+        "0;100;100;.;0;3;0;0;2;5;A/G;\n"
+        "1;200;100;.;0;2;0;0;0;5;A/G;\n"
+        "2;300;100;.;1;2;0;0;0;1;A/G;\n"
+        "3;400;1;.;1;1;0;0;0;4;A/G;\n"
+    )
+
+
+def test_local_trees(tmp_path: Path):
+    write_example(tmp_path)
+    local_trees = LocalTrees.read(tmp_path / "example", cache_size=1)
+    assert len(local_trees) == 2
+    assert local_trees.breakpoints.tolist() == [100, 300]
+    bp = np.array([50, 100, 299, 300, 1000])
+    assert local_trees.trees_at(bp).tolist() == [-1, 0, 0, 1, 1]
+    np.testing.assert_array_equal(local_trees.tmrca(0, 1, bp), [np.nan, 2, 2, 4, 4])
+    np.testing.assert_array_equal(local_trees.tmrca(2, 0, bp[1:]), [5, 5, 1, 1])
+    assert local_trees.tmrca(1, 1, [150]).tolist() == [0]
+    assert local_trees.decode.cache_info().currsize == 1
+
+
+def test_estimate_coal(tmp_path: Path, monkeypatch):
+    write_example(tmp_path)
+    anc, mut = tmp_path / "example.anc", tmp_path / "example.mut"
+    # trees of 200 and 101 bp, with pairs coalescing at ages 2, 5 and 1, 4
+    rates = estimate_coal(anc, mut, [0, 3], jobs=1)
+    assert rates.groups == ("all",)
+    np.testing.assert_allclose(rates.rates[0, 0], [602 / 4614, 1204 / 2004])
+
+    rates = estimate_coal(anc, mut, [0, 3], ["A", "A", "B"], jobs=2)
+    assert rates.groups == ("A", "B")
+    np.testing.assert_allclose(rates.rates[0, 1], [101 / 1604, 501 / 901])
+    np.testing.assert_allclose(rates.rates[0, 1], rates.rates[1, 0])
+
+    # one tree per batch, read by the workers at their offsets
+    monkeypatch.setattr("relatepy.trees.BATCH_SIZE", 1)
+    batched = estimate_coal(anc, mut, [0, 3], ["A", "A", "B"], jobs=2)
+    np.testing.assert_allclose(batched.rates, rates.rates)
+    np.testing.assert_allclose(rates.rates[0, 0], [400 / 1406, 1])
+    assert np.isnan(rates.rates[1, 1]).all()
+    rates.write(tmp_path / "example.coal")
+    np.testing.assert_allclose(
+        read_coal_rates(tmp_path / "example.coal").rates, rates.rates
+    )